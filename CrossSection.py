@@ -0,0 +1,237 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+from DB import DBConnection, unpack_array
+
+# Read the tabulated cross section of one reaction as (NBT, INT, X, Y) like parseTAB1:
+# int64 interpolation ranges and schemes, float64 energies (eV) and cross sections (barns).
+# Packed sections are read with one query, sections stored as rows fall back to the row tables.
+# Returns None if the reaction is not in the database
+def read_cross_section(conn: DBConnection, material_key: int, library_key: int, MT: int) -> tuple:
+    res = conn.execute("SELECT b.compression,b.NBT,b.InterpolationScheme,b.Energy,b.CrossSection FROM CrossSectionInfo i "
+                       "JOIN CrossSectionBlob b ON b.crosssectioninfo_key=i.id WHERE i.MT=%s and i.material_key=%s and i.library_key=%s",
+                       [MT, material_key, library_key])
+    if res:
+        compression, NBT, INT, X, Y = res[0]
+        return (unpack_array(NBT, "<i4", compression).astype(np.int64), unpack_array(INT, "<i4", compression).astype(np.int64),
+                unpack_array(X, "<f8", compression), unpack_array(Y, "<f8", compression))
+
+    res = conn.execute("SELECT id FROM CrossSectionInfo WHERE MT=%s and material_key=%s and library_key=%s",
+                       [MT, material_key, library_key])
+    if not res:
+        return None
+    cs_key = res[0][0]
+    interp = conn.execute("SELECT NBT,InterpolationScheme FROM Interpolation WHERE info_key=%s and MT=%s and MF=3 ORDER BY NBT",
+                          [cs_key, MT])
+    points = conn.execute("SELECT Energy,CrossSection FROM CrossSectionData WHERE crosssectioninfo_key=%s ORDER BY id",
+                          [cs_key])
+    interp = np.array(interp, dtype=np.int64).reshape(-1, 2)
+    points = np.array(points, dtype=np.float64).reshape(-1, 2)
+    return (np.ascontiguousarray(interp[:,0]), np.ascontiguousarray(interp[:,1]),
+            np.ascontiguousarray(points[:,0]), np.ascontiguousarray(points[:,1]))
+
+# ENDF interpolation laws of TAB1 records
+HISTOGRAM = 1
+LIN_LIN = 2
+LIN_LOG = 3
+LOG_LIN = 4
+LOG_LOG = 5
+
+# Evaluate a TAB1 table (NBT, INT, X, Y), as returned by parseTAB1 or read_cross_section, at the energies E.
+# NBT[r] is the 1-based index of the last point of interpolation region r, which uses law INT[r].
+# At a discontinuity (two points with the same X) the value right of it is returned; outside [X[0], X[-1]] it is 0
+def evaluate(table: tuple, E) -> np.ndarray:
+    NBT, INT, X, Y = table
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    E = np.asarray(E, dtype=np.float64)
+    if len(X) < 2:
+        raise Exception("Cannot interpolate a table of %d points" % (len(X)))
+
+    # interval i lies between points i and i+1, it belongs to the first region whose NBT is at least i+2
+    i = np.clip(np.searchsorted(X, E, side='right') - 1, 0, len(X) - 2)
+    laws = np.asarray(INT)
+    if len(laws) > 1:
+        laws = laws[np.minimum(np.searchsorted(NBT, i + 2), len(laws) - 1)]
+
+    result = interpolate(laws, X[i], X[i+1], Y[i], Y[i+1], E)
+
+    outside = (E < X[0]) | (E > X[-1])
+    if outside.any():
+        result = np.where(outside, 0.0, result)
+    return result
+
+# Value at E of the intervals from (X0, Y0) to (X1, Y1) under their interpolation laws, elementwise.
+# laws holds one law for all intervals or one per interval
+def interpolate(laws, X0, X1, Y0, Y1, E) -> np.ndarray:
+    laws = np.asarray(laws)
+    unique = np.unique(laws)
+    result = np.zeros(np.shape(E), dtype=np.float64)
+    for law in unique:
+        if len(unique) == 1:
+            e, x0, x1, y0, y1 = E, X0, X1, Y0, Y1
+        else:
+            mask = laws == law
+            e, x0, x1, y0, y1 = E[mask], X0[mask], X1[mask], Y0[mask], Y1[mask]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if law == HISTOGRAM:
+                # the left value up to the next point, which keeps its own value, e.g. the last point of a table
+                values = np.where(e < x1, y0, y1)
+            elif law == LIN_LIN:
+                values = y0 + (y1 - y0) * ((e - x0) / (x1 - x0))
+            elif law == LIN_LOG:
+                values = y0 + (y1 - y0) * (np.log(e / x0) / np.log(x1 / x0))
+            elif law == LOG_LIN:
+                values = y0 * np.exp(np.log(y1 / y0) * ((e - x0) / (x1 - x0)))
+            elif law == LOG_LOG:
+                values = y0 * np.exp(np.log(y1 / y0) * (np.log(e / x0) / np.log(x1 / x0)))
+            else:
+                raise Exception("Unsupported interpolation law: %s" % (law))
+        # zero width intervals and zero values on log scales take the value of the left point
+        values = np.where(np.isfinite(values), values, y0)
+        if len(unique) == 1:
+            result = values
+        else:
+            result[mask] = values
+    return result
+
+# 16 point Gauss-Legendre rule for log-lin intervals under a weight E^q, q != 0, whose integral has no closed form
+_GAUSS_T, _GAUSS_W = np.polynomial.legendre.leggauss(16)
+
+# integral of exp(r*u) for u from 0 to L
+def _G(r, L):
+    rL = r*L
+    return np.where(np.abs(rL) < 1e-10, L*(1 + rL/2), np.expm1(rL)/np.where(r == 0, 1, r))
+
+# integral of u*exp(r*u) for u from 0 to L
+def _K(r, L):
+    rL = r*L
+    return np.where(np.abs(rL) < 1e-6, L*L*(0.5 + rL/3), (L*np.exp(rL) - _G(r, L))/np.where(r == 0, 1, r))
+
+# Integral from X0 to X1 of the intervals' interpolation (as in interpolate) times the weight E^q, elementwise.
+# With u = ln(E/X0) every law but log-lin integrates in closed form; log-lin does too for q = 0 and uses a
+# 16 point Gauss-Legendre rule otherwise. Where interpolate falls back to the left value, e.g. for negative values
+# or energies on a log scale, the interval integrates the left value too
+def integrate(laws, X0, X1, Y0, Y1, q: float = 0.0) -> np.ndarray:
+    X0, X1, Y0, Y1 = (np.asarray(values, dtype=np.float64) for values in (X0, X1, Y0, Y1))
+    laws = np.broadcast_to(np.asarray(laws), X0.shape)
+    result = np.zeros(X0.shape, dtype=np.float64)
+    wide = X1 > X0
+    for law in np.unique(laws[wide]):
+        mask = wide & (laws == law)
+        x0, x1, y0, y1 = X0[mask], X1[mask], Y0[mask], Y1[mask]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            L = np.log(x1/x0)
+            scale = x0**(q + 1)
+            if law == HISTOGRAM:
+                values = y0*scale*_G(q + 1, L)
+            elif law == LIN_LIN:
+                # y = y0 + slope*x0*(e^u - 1) keeps the terms of the size of the result on narrow intervals
+                values = scale*(y0*_G(q + 1, L) + (y1 - y0)/(x1 - x0)*x0*(_G(q + 2, L) - _G(q + 1, L)))
+            elif law == LIN_LOG:
+                values = scale*(y0*_G(q + 1, L) + (y1 - y0)/L*_K(q + 1, L))
+            elif law == LOG_LOG:
+                values = y0*scale*_G(np.log(y1/y0)/L + q + 1, L)
+            elif law == LOG_LIN:
+                k = np.log(y1/y0)/(x1 - x0)
+                if q == 0:
+                    values = y0*_G(k, x1 - x0)
+                else:
+                    # the rule runs in u, where x^q is smooth over intervals spanning decades
+                    u = L[:, None]*(_GAUSS_T + 1)/2
+                    x = x0[:, None]*np.exp(u)
+                    values = (y0[:, None]*np.exp(k[:, None]*(x - x0[:, None]) + (q + 1)*u)) @ _GAUSS_W*scale*L/2
+            else:
+                raise Exception("Unsupported interpolation law: %s" % (law))
+            # the left value held over the interval, x0 = 0 only integrates for q > -1
+            held = np.where(y0 == 0, 0.0, y0*np.where(x0 > 0, scale*_G(q + 1, L), x1**(q + 1)/(q + 1) if q > -1 else np.inf))
+        result[mask] = np.where(np.isfinite(values), values, held)
+    return result
+
+# Arrays derived from cross sections (union grids, group cross sections...) used recently by this process,
+# least recently used dropped first
+class TableCache():
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._tables)
+
+    def get(self, key: tuple):
+        with self._lock:
+            table = self._tables.get(key)
+            if table is not None:
+                self._tables.move_to_end(key)
+            return table
+
+    def put(self, key: tuple, table) -> None:
+        with self._lock:
+            self._tables[key] = table
+            self._tables.move_to_end(key)
+            while len(self._tables) > self.max_size:
+                self._tables.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+
+# Fractions of an interval (of log x for laws logarithmic in x) at which linearize compares the linear and the
+# exact values; the midpoint is where intervals are split. When the cross section varies a lot across an interval
+# its largest relative error lies off the midpoint and can exceed the largest error at the probes by several per
+# cent, so the probes are held to LINEARIZE_MARGIN of the tolerance
+LINEARIZE_PROBES = np.arange(1, 8)/8
+LINEARIZE_MARGIN = 0.9
+
+# Linearize a TAB1 table like NJOY's RECONR: points are inserted until linear interpolation between neighbours
+# reproduces the table's own laws within the relative tolerance. Intervals are bisected level by level, every
+# interval still failing at once: the exact values at its LINEARIZE_PROBES are compared with the linear ones, and if
+# any differ by more than the tolerance the midpoint (geometric for laws logarithmic in x) is kept and both halves are
+# tested at the next level. Splitting stops after max_levels levels or once an interval is narrower than min_width relative
+# to its energy. Histogram intervals become a constant segment ending in a discontinuity at their upper energy.
+# Returns the table as one lin-lin region (NBT, INT, X, Y)
+def linearize(table: tuple, tolerance: float = 1e-3, max_levels: int = 40, min_width: float = 1e-9) -> tuple:
+    NBT, INT, X, Y = table
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    if len(X) < 2:
+        raise Exception("Cannot interpolate a table of %d points" % (len(X)))
+
+    i = np.arange(len(X) - 1)
+    laws = np.asarray(INT)
+    laws = laws[np.minimum(np.searchsorted(NBT, i + 2), len(laws) - 1)] if len(laws) > 1 else np.full(len(i), laws[0])
+    if np.all(laws == LIN_LIN):
+        return (np.array([len(X)], dtype=np.int64), np.array([LIN_LIN], dtype=np.int64), X, Y)
+
+    # histogram intervals get the value of their lower point again at their upper energy, just before the upper point
+    steps = i[(laws == HISTOGRAM) & (X[1:] > X[:-1]) & (Y[1:] != Y[:-1])]
+    new_x, new_y = [X[steps + 1]], [Y[steps]]
+
+    todo = i[np.isin(laws, (LIN_LOG, LOG_LIN, LOG_LOG)) & (X[1:] > X[:-1])]
+    x0, x1, y0, y1 = X[todo], X[todo + 1], Y[todo], Y[todo + 1]
+    logx = np.isin(laws[todo], (LIN_LOG, LOG_LOG)) & (x0 > 0)
+    for level in range(max_levels):
+        if not len(x0):
+            break
+        t = LINEARIZE_PROBES[:,None]
+        xp = np.where(logx, np.abs(x0)**(1 - t)*np.abs(x1)**t, x0 + t*(x1 - x0))
+        yp = evaluate(table, xp.ravel()).reshape(xp.shape)
+        linear = y0 + (y1 - y0)*((xp - x0)/(x1 - x0))
+        xm, ym = xp[LINEARIZE_PROBES == 0.5][0], yp[LINEARIZE_PROBES == 0.5][0]
+        split = np.any(np.abs(yp - linear) > LINEARIZE_MARGIN*tolerance*np.abs(yp), axis=0)
+        split &= (x1 - x0 > min_width*np.abs(x1)) & (xm > x0) & (xm < x1)
+        xm, ym = xm[split], ym[split]
+        new_x.append(xm)
+        new_y.append(ym)
+        x0, x1 = np.concatenate((x0[split], xm)), np.concatenate((xm, x1[split]))
+        y0, y1 = np.concatenate((y0[split], ym)), np.concatenate((ym, y1[split]))
+        logx = np.concatenate((logx[split], logx[split]))
+
+    # sorted by energy, a histogram's added point before the upper point it shares its energy with,
+    # the points of a discontinuity in their original order
+    order = np.concatenate((2*np.arange(len(X)) + 1, 2*(steps + 1), np.zeros(sum(len(x) for x in new_x[1:]), dtype=np.int64)))
+    X = np.concatenate([X] + new_x)
+    Y = np.concatenate([Y] + new_y)
+    order = np.lexsort((order, X))
+    return (np.array([len(X)], dtype=np.int64), np.array([LIN_LIN], dtype=np.int64), X[order], Y[order])
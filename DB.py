@@ -1,129 +1,779 @@
+import abc
 import configparser
-import mysql.connector
+import os
+import re
+import sqlite3
+import tempfile
+import time
+import zlib
+import numpy as np
 import traceback
 import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from Metrics import metrics
+try:
+    import mysql.connector
+except ImportError:
+    mysql = None
 
 config = configparser.ConfigParser()
 config.read('db.properties')
 
-db_host=config.get("db", "db_host")
-db_name=config.get("db", "db_name")
-db_user=config.get("db", "user")
-db_password=config.get("db", "password")
+# where ingested data is stored: mysql (the MariaDB server below) or sqlite (a local database file)
+backend=config.get("db", "backend", fallback="mysql")
+db_host=config.get("db", "db_host", fallback="localhost")
+db_name=config.get("db", "db_name", fallback="ENDF")
+db_user=config.get("db", "user", fallback="")
+db_password=config.get("db", "password", fallback="")
+sqlite_path=config.get("db", "sqlite_path", fallback="ENDF.sqlite")
+# page cache and memory map size of each SQLite connection
+sqlite_cache_mb=config.getint("db", "sqlite_cache_mb", fallback=256)
+# how bulk_insert loads the large tables: executemany, multirow (large multi-row INSERTs) or infile (LOAD DATA LOCAL INFILE)
+bulk_mode=config.get("db", "bulk_mode", fallback="executemany")
+bulk_batch_size=config.getint("db", "bulk_batch_size", fallback=10000)
+# most Library/Material/GeneralInfo/CrossSectionInfo keys kept by the process-wide key cache
+key_cache_size=config.getint("db", "key_cache_size", fallback=100000)
+# most connections open at once in a process, a thread asking for one more waits up to pool_timeout seconds
+pool_size=config.getint("db", "pool_size", fallback=8)
+pool_timeout=config.getfloat("db", "pool_timeout", fallback=600)
+# idle connections are checked with a round trip before reuse once unused for this many seconds, and replaced if dead
+pool_ping_interval=config.getfloat("db", "pool_ping_interval", fallback=30)
+# how MF3 tables are stored: rows (CrossSectionData and Interpolation rows) or packed (one CrossSectionBlob row per section)
+xs_storage=config.get("db", "xs_storage", fallback="rows")
+# compression of packed arrays: none or zlib
+xs_compression=config.get("db", "xs_compression", fallback="zlib")
 
-class DBConnection():
-    _open_connections = []
-    _id_pool = []
-    _owned_connections = {}
+BULK_MODES = ("executemany", "multirow", "infile")
+XS_STORAGES = ("rows", "packed")
+XS_COMPRESSIONS = ("none", "zlib")
+if xs_storage not in XS_STORAGES:
+    raise Exception("Unknown xs_storage: %s" % (xs_storage))
+if xs_compression not in XS_COMPRESSIONS:
+    raise Exception("Unknown xs_compression: %s" % (xs_compression))
+# client/server errors meaning LOAD DATA LOCAL is not allowed, rather than bad data
+_INFILE_REFUSED = (1148, 2068, 3948)
+# ids SQLite hands out per block, like the increment of MariaDB's id_seq
+SQLITE_ID_BLOCK = 100
+ddl_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ENDF_ddl.sql")
+
+# Translate the MariaDB DDL of ENDF_ddl.sql into SQLite: table options, comments and charsets are dropped,
+# KEYs become CREATE INDEX statements, a single integer primary key becomes the rowid
+# and the id_seq sequence becomes a one row table
+def sqlite_schema(ddl_path: str) -> str:
+    with open(ddl_path, encoding="utf-8") as file:
+        ddl = file.read()
+    statements = []
+    # comments may contain semicolons, statements end with one at the end of a line
+    for statement in re.split(r";+[ \t]*(?:\n|$)", ddl):
+        statement = statement.strip()
+        if statement.upper().startswith("CREATE SEQUENCE"):
+            name = re.search(r"`(\w+)`", statement).group(1)
+            start = re.search(r"start with (\d+)", statement, re.I)
+            statements.append("CREATE TABLE IF NOT EXISTS %s (next_val INTEGER NOT NULL)" % (name))
+            statements.append("INSERT INTO %s SELECT %s WHERE NOT EXISTS (SELECT 1 FROM %s)" % (name, start.group(1) if start else 1, name))
+            continue
+        if not statement.upper().startswith("CREATE TABLE"):
+            continue
+        table = re.search(r"CREATE TABLE `(\w+)`", statement).group(1)
+        body = statement[statement.index("(")+1:statement.rindex(")")]
+        columns, indexes, primary = [], [], None
+        for line in body.split("\n"):
+            line = line.strip().rstrip(",")
+            if not line:
+                continue
+            line = re.sub(r" COMMENT '(?:[^']|'')*'", "", line)
+            line = re.sub(r" (CHARACTER SET|COLLATE) \w+", "", line)
+            line = re.sub(r" (USING BTREE|UNSIGNED)", "", line).replace("`", "")
+            key = re.match(r"(PRIMARY|UNIQUE)? ?KEY (\w+ )?\((.*)\)", line)
+            if key and key.group(1) == "PRIMARY":
+                primary = key.group(3)
+            elif key:
+                indexes.append("CREATE %sINDEX IF NOT EXISTS %s_%s ON %s (%s)" %
+                               ("UNIQUE " if key.group(1) else "", table, key.group(2).strip(), table, key.group(3)))
+            else:
+                columns.append(line)
+        for i, column in enumerate(columns):
+            name, type = column.split()[:2]
+            if primary == name and "int" in type.lower():
+                columns[i] = "%s INTEGER PRIMARY KEY" % (name)
+                primary = None
+        if primary:
+            columns.append("PRIMARY KEY (%s)" % (primary))
+        statements.append("CREATE TABLE IF NOT EXISTS %s (\n  %s\n)" % (table, ",\n  ".join(columns)))
+        statements.extend(indexes)
+    return ";\n".join(statements) + ";\n"
+
+# Render each column as a string array, scalars are repeated for every row
+def _column_text(values: list, nRows: int) -> list:
+    columns = []
+    for value in values:
+        if np.ndim(value) == 0:
+            columns.append(np.full(nRows, str(value)))
+        else:
+            columns.append(np.asarray(value).astype(str))
+    return columns
+
+def _join_columns(columns: list, sep: str) -> np.ndarray:
+    rows = columns[0]
+    for column in columns[1:]:
+        rows = np.char.add(np.char.add(rows, sep), column)
+    return rows
+
+# Packed arrays are the little-endian bytes of the array. zlib compresses them after a byte shuffle
+# (all first bytes of the values, then all second bytes...), which groups the slowly varying exponent bytes
+def pack_array(values, dtype: str, compression: str = None) -> bytes:
+    compression = compression or xs_compression
+    values = np.ascontiguousarray(values, dtype=dtype)
+    if compression == "none":
+        return values.tobytes()
+    if compression == "zlib":
+        shuffled = values.view(np.uint8).reshape(-1, values.itemsize).T
+        return zlib.compress(shuffled.tobytes(), 6)
+    raise Exception("Unknown compression: %s" % (compression))
+
+def unpack_array(blob: bytes, dtype: str, compression: str) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    if compression == "none":
+        return np.frombuffer(blob, dtype=dtype).copy()
+    if compression == "zlib":
+        shuffled = np.frombuffer(zlib.decompress(blob), dtype=np.uint8).reshape(dtype.itemsize, -1)
+        return np.ascontiguousarray(shuffled.T).view(dtype).reshape(-1)
+    raise Exception("Unknown compression: %s" % (compression))
+
+# Natural keys of the dimension tables, normalised so values parsed from a tape and values read back from the DB agree.
+# AWR is stored as decimal(12,9) and ELIS as ELIS_key, rounded to 0.01 eV, which the unique key on Material and
+# the lookup query both match on
+def library_lookup(NLIB, NSUB, NVER, LREL, NFOR) -> tuple:
+    return (int(NLIB), int(NSUB), int(NVER), int(LREL), int(NFOR))
+
+def material_lookup(MAT, AWR, LFI, LIS, LISO, ELIS, STA) -> tuple:
+    return (int(MAT), round(float(AWR), 9), int(LFI), int(LIS), int(LISO), round(float(ELIS), 2), int(STA))
 
+# Bounded LRU cache of (table, natural key) -> id, shared by every connection of the process.
+# It only holds committed rows, keys found or inserted inside a transaction wait in that connection until it commits
+class KeyCache():
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    # id of the key from the pending keys of a transaction if given, else from the cache, counting hits and misses
+    def get(self, table: str, key: tuple, pending: dict = None) -> int:
+        with self._lock:
+            id = pending.get((table, key)) if pending else None
+            if id is None:
+                id = self._keys.get((table, key))
+                if id is not None:
+                    self._keys.move_to_end((table, key))
+            if id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return id
+
+    def __contains__(self, table_key: tuple) -> bool:
+        with self._lock:
+            return table_key in self._keys
+
+    def update(self, keys: dict) -> None:
+        with self._lock:
+            for table_key, id in keys.items():
+                self._keys[table_key] = id
+                self._keys.move_to_end(table_key)
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+
+key_cache = KeyCache(key_cache_size)
+
+# Reserved but unused ids as [start, end) intervals. Threads sharing a pool take ids under its lock,
+# refills happen under the lock too so two threads never reserve for the same shortfall
+class IdPool():
     def __init__(self):
-        self.conn = mysql.connector.connect(host=db_host,
-                                   database=db_name,
-                                   user=db_user,
-                                   password=db_password)
+        self._intervals = deque()
+        self._count = 0
+        self._lock = threading.RLock()
 
-        self.conn.autocommit = False
-        self.conn.sql_mode = 'TRADITIONAL,NO_ENGINE_SUBSTITUTION'
-        self.cursor = self.conn.cursor()
+    def __len__(self) -> int:
+        return self._count
 
-        DBConnection._open_connections.append(self.conn)
+    # Reserve at least nIds more ids with dbconn in one round trip, adjacent blocks are merged into one interval
+    def fill(self, dbconn: 'DBConnection', nIds: int = 1) -> None:
+        with self._lock:
+            with metrics.timer("ids.reserve", nIds):
+                starts, increment = dbconn._reserve_ids(nIds)
+            nBlocks = -(-nIds // increment)
+            starts = sorted(set(starts))
+            for next_val in starts:
+                if self._intervals and self._intervals[-1][1] == next_val:
+                    self._intervals[-1] = (self._intervals[-1][0], next_val+increment)
+                else:
+                    self._intervals.append((next_val, next_val+increment))
+            self._count += len(starts)*increment
+            metrics.record("ids.blocks", 0, len(starts))
+            if len(starts) < nBlocks:
+                self.fill(dbconn, nIds - len(starts)*increment)
+
+    def take(self, dbconn: 'DBConnection', nIds: int) -> np.ndarray:
+        with self._lock:
+            if self._count < nIds:
+                if self._count == 0:
+                    print("INFO: id pool empty, querying for more")
+                self.fill(dbconn, nIds - self._count)
+            ret_ids = np.empty(nIds, dtype=np.int64)
+            filled = 0
+            while filled < nIds:
+                start, end = self._intervals[0]
+                taken = min(end - start, nIds - filled)
+                ret_ids[filled:filled+taken] = np.arange(start, start+taken)
+                filled += taken
+                if start+taken == end:
+                    self._intervals.popleft()
+                else:
+                    self._intervals[0] = (start+taken, end)
+            self._count -= nIds
+            return ret_ids
+
+    def clear(self) -> None:
+        with self._lock:
+            self._intervals = deque()
+            self._count = 0
 
+# Connections are pooled per process: a thread checks one out, which blocks while pool_size connections are
+# checked out, and checks it back in for another thread to reuse. getConnection binds a connection to the calling
+# thread until releaseConnection or close, so code deep in the parser reaches the same connection and transaction.
+# Backends subclass it and implement the abstract methods
+class DBConnection(abc.ABC):
+    # id reservations made by this connection that a rollback undoes, see SQLiteConnection
+    _reservations = 0
+    _open_connections = []
+    # ids shared by every connection of the process, backends whose id reservations are transactional keep their own
+    _ids = IdPool()
+    # idle connections ready for checkout, most recently returned last
+    _idle = deque()
+    _slots = threading.BoundedSemaphore(pool_size)
+    _pool_lock = threading.Lock()
+    _owned_connections = {}
+
+    def __init__(self):
+        self.conn = None
+        self.cursor = None
+        # keys seen by the current transaction, published to key_cache on commit and dropped on rollback.
+        # Only ever added to, so a savepoint just notes how many there are
+        self._pending_keys = {}
+        # rows written by the current transaction
+        self.pending_rows = 0
+        # open savepoints, innermost last, with what to restore when rolling back to them
+        self._savepoints = []
+        self._checked_out = False
+        self._last_used = time.monotonic()
 
     def close(self) -> None:
          if self.conn is not None:
-            if self.cursor is not None:
-                self.cursor.close()
-                self.curosr = None
-            DBConnection._open_connections.remove(self.conn)
-            if threading.get_ident() in DBConnection._owned_connections:
-                del DBConnection._owned_connections[threading.get_ident()]
-            self.conn.close()
+            with DBConnection._pool_lock:
+                if self.conn in DBConnection._open_connections:
+                    DBConnection._open_connections.remove(self.conn)
+                for ident, dbconn in list(DBConnection._owned_connections.items()):
+                    if dbconn is self:
+                        del DBConnection._owned_connections[ident]
+            try:
+                if self.cursor is not None:
+                    self.cursor.close()
+                self.conn.close()
+            except Exception as error:
+                print("WARNING: closing connection: %s" % (error))
+            self.cursor = None
             self.conn = None
+         if self._checked_out:
+            self._checked_out = False
+            DBConnection._slots.release()
 
     def commit(self):
-        self.conn.commit()
+        with metrics.timer("commit", self.pending_rows):
+            self.conn.commit()
+        key_cache.update(self._pending_keys)
+        self._pending_keys = {}
+        self.pending_rows = 0
+        self._savepoints = []
     def rollback(self):
         self.conn.rollback()
+        self._pending_keys = {}
+        self.pending_rows = 0
+        self._savepoints = []
+
+    # Savepoints isolate part of a transaction: rolling back to one undoes only what followed it.
+    # While a savepoint is open a failing statement is not rolled back by execute, the caller rolls back to the savepoint
+    def savepoint(self, name: str) -> None:
+        self.start_transaction()
+        self.execute("SAVEPOINT %s" % (name))
+        self._savepoints.append((name, len(self._pending_keys), self.pending_rows, self._reservations))
+
+    def releaseSavepoint(self, name: str) -> None:
+        self.execute("RELEASE SAVEPOINT %s" % (name))
+        self._popSavepoint(name)
+
+    def rollbackToSavepoint(self, name: str) -> None:
+        self.execute("ROLLBACK TO SAVEPOINT %s" % (name))
+        self.execute("RELEASE SAVEPOINT %s" % (name))
+        _, keys, self.pending_rows, reservations = self._popSavepoint(name)
+        while len(self._pending_keys) > keys:
+            self._pending_keys.popitem()
+        # ids reserved since the savepoint are handed out again
+        if reservations != self._reservations:
+            self._ids.clear()
+
+    def _popSavepoint(self, name: str) -> tuple:
+        while self._savepoints:
+            savepoint = self._savepoints.pop()
+            if savepoint[0] == name:
+                return savepoint
+        raise Exception("No savepoint %s" % (name))
+
+    # id of the row with this natural key if this transaction or the key cache knows it, otherwise None.
+    # The first lookup of a reaction of a material loads the CrossSectionInfo keys of all its reactions
+    def getKey(self, table: str, key: tuple) -> int:
+        if table == "CrossSectionInfo":
+            self._loadReactionKeys(*key[1:])
+        return key_cache.get(table, key, self._pending_keys)
+
+    def cacheKey(self, table: str, key: tuple, id: int) -> None:
+        self._pending_keys[(table, key)] = id
+
+    # Load the CrossSectionInfo keys of a material with one query, unless this transaction or the key cache holds them.
+    # They become pending keys like the ones this transaction finds itself, as the query also sees its own rows
+    def _loadReactionKeys(self, material_key: int, library_key: int) -> None:
+        loaded = ("CrossSectionInfo.material", (material_key, library_key))
+        if loaded in self._pending_keys or loaded in key_cache:
+            return
+        for id, MT in self.execute("SELECT id,MT FROM CrossSectionInfo WHERE material_key=%s and library_key=%s", [material_key, library_key]):
+            self._pending_keys.setdefault(("CrossSectionInfo", (MT, material_key, library_key)), id)
+        self._pending_keys[loaded] = True
+
+    # Load the keys of the dimension tables into key_cache with one query per table, outside of a transaction so
+    # they are all committed. The keys of the reactions of a material are only loaded once one of them is looked up
+    def warmKeyCache(self) -> None:
+        keys = {}
+        for id, material_key, library_key in self.execute("SELECT id,material_key,library_key FROM GeneralInfo"):
+            keys[("GeneralInfo", (material_key, library_key))] = id
+        for id, MAT, AWR, LFI, LIS, LISO, ELIS_key, STA in self.execute("SELECT id,MAT,AWR,LFI,LIS,LISO,ELIS_key,STA FROM Material"):
+            keys[("Material", material_lookup(MAT, AWR, LFI, LIS, LISO, ELIS_key, STA))] = id
+        for id, NLIB, NSUB, NVER, LREL, NFOR in self.execute("SELECT id,NLIB,NSUB,NVER,LREL,NFOR FROM Library"):
+            keys[("Library", library_lookup(NLIB, NSUB, NVER, LREL, NFOR))] = id
+        key_cache.update(keys)
+        print("INFO: key cache warmed with %d keys" % (len(key_cache)))
     #def getCursor(self):
     #    return self.cursor
 
+    @abc.abstractmethod
     def start_transaction(self) -> None:
-        if not self.conn.in_transaction:
-            self.conn.start_transaction(consistent_snapshot=True, isolation_level='READ COMMITTED', readonly=False)
-
+        pass
+    @abc.abstractmethod
     def in_transaction(self) -> bool:
-        return self.conn.in_transaction
-    
+        pass
+    @abc.abstractmethod
     def is_connected(self) -> bool:
-        return self.conn.is_connected()
+        pass
+
+    # Round trip to the server, False if the connection is dead
+    def ping(self) -> bool:
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception as error:
+            print("WARNING: connection failed health check: %s" % (error))
+            return False
+
+    def healthy(self) -> bool:
+        if self.conn is None or not self.is_connected():
+            return False
+        if time.monotonic() - self._last_used > pool_ping_interval:
+            return self.ping()
+        return True
+
+    # Queries are written with %s placeholders, backends using another paramstyle rewrite them here
+    def _sql(self, query: str) -> str:
+        return query
 
     def execute(self,query: str,binds: list = None) -> list:
         res = None
         try:
             if not self.cursor:
                 self.cursor = self.conn.cursor()
-            self.cursor.execute(query,binds)
+            self.cursor.execute(self._sql(query),binds or ())
             res = self.cursor.fetchall()
+            if self.cursor.rowcount > 0 and not query.lstrip()[:6].upper() == "SELECT":
+                self.pending_rows += self.cursor.rowcount
         except Exception as error:
             print("ERROR: executing statement: %s" % (query))
             print("ERROR: with binds: %s" % (binds))
             print(error)
             traceback.print_exc()
-            if self.conn:
+            if self.conn and not self._savepoints:
                 self.rollback()
             raise error
         return res
     
+    # Id of the row select finds, running insert with a new id bound before insert_binds first when it finds none.
+    # insert is an INSERT ... ON DUPLICATE KEY UPDATE id=id of a row of a table with a unique key on what select
+    # looks for, so when another connection inserts the same key meanwhile it waits for that transaction and keeps
+    # the other row, and every connection ends up with the same row. Other errors of the insert are raised, unlike
+    # with INSERT IGNORE. Returns the id and whether this connection inserted the row
+    def insertOrSelect(self, select: str, select_binds: list, insert: str, insert_binds: list) -> tuple:
+        res = self.execute(select, select_binds)
+        if res:
+            return res[0][0], False
+        id = DBConnection.getNextId()
+        self.execute(insert, [id] + list(insert_binds))
+        res = self.execute(select, select_binds)
+        if not res:
+            raise Exception("No row found after inserting with: %s" % (insert))
+        return res[0][0], res[0][0] == id
+
     def executemany(self,query: str,binds: list = None) -> list:
         res = None
         try:
             if not self.cursor:
                 self.cursor = self.conn.cursor()
-            self.cursor.executemany(query,binds)
+            self.cursor.executemany(self._sql(query),binds)
             res = self.cursor.fetchall()
+            self.pending_rows += len(binds)
         except Exception as error:
             print("ERROR: executing statement: %s" % (query))
             print("ERROR: with binds: %s" % (binds))
             print(error)
             traceback.print_exc()
-            if self.conn:
+            if self.conn and not self._savepoints:
                 self.rollback()
             raise error
         return res
 
-    
+
+    # Insert equal length columns (scalars are repeated) into table the fastest way the backend supports
+    def bulk_insert(self, table: str, columns: list, values: list) -> int:
+        nRows = max([len(value) for value in values if np.ndim(value) > 0], default=1)
+        if nRows == 0:
+            return 0
+        with metrics.timer("insert." + table, nRows, sum(np.asarray(value).nbytes for value in values if np.ndim(value) > 0)):
+            self._bulk_load(table, columns, values, nRows)
+        return nRows
+
+    def _bulk_load(self, table: str, columns: list, values: list, nRows: int) -> None:
+        self._insert_executemany(table, columns, values, nRows)
+
+    def _insert_executemany(self, table: str, columns: list, values: list, nRows: int) -> None:
+        query = "INSERT INTO %s(%s) VALUES(%s)" % (table, ",".join(columns), ",".join(["%s"]*len(columns)))
+        data = list(zip(*[[value]*nRows if np.ndim(value) == 0 else np.asarray(value).tolist() for value in values]))
+        for i in range(0,len(data),bulk_batch_size):
+            self.executemany(query, data[i:i+bulk_batch_size])
+
+    def _bulk_error(self, statement: str, error: Exception) -> None:
+        print("ERROR: executing %s" % (statement))
+        print(error)
+        traceback.print_exc()
+        if self.conn and not self._savepoints:
+            self.rollback()
+        raise error
+
+    # Reserve at least nIds new ids, returning the start of each reserved block and the block size
+    @abc.abstractmethod
+    def _reserve_ids(self, nIds: int) -> tuple:
+        pass
+
+    # A healthy connection to the configured backend, reusing an idle one when possible.
+    # Waits up to pool_timeout seconds while pool_size connections are checked out
+    @classmethod
+    def checkout(cls) -> 'DBConnection':
+        if not cls._slots.acquire(timeout=pool_timeout):
+            raise Exception("No database connection free after %.0f s, all %d are in use" % (pool_timeout, pool_size))
+        try:
+            while True:
+                with cls._pool_lock:
+                    dbconn = cls._idle.pop() if cls._idle else None
+                if dbconn is None:
+                    if backend not in BACKENDS:
+                        raise Exception("Unknown backend: %s" % (backend))
+                    dbconn = BACKENDS[backend]()
+                    break
+                if dbconn.healthy():
+                    break
+                print("INFO: replacing dead connection")
+                dbconn.close()
+        except Exception:
+            cls._slots.release()
+            raise
+        dbconn._checked_out = True
+        return dbconn
+
+    # Return a connection to the pool, an unfinished transaction is rolled back
+    @classmethod
+    def checkin(cls, dbconn: 'DBConnection') -> None:
+        if not dbconn._checked_out:
+            return
+        with cls._pool_lock:
+            for ident, owned in list(cls._owned_connections.items()):
+                if owned is dbconn:
+                    del cls._owned_connections[ident]
+        try:
+            if dbconn.conn is not None and dbconn.in_transaction():
+                dbconn.rollback()
+        except Exception as error:
+            print("WARNING: rolling back returned connection: %s" % (error))
+            dbconn.close()
+            return
+        if dbconn.conn is None or not isinstance(dbconn, BACKENDS[backend]):
+            dbconn.close()
+            return
+        dbconn._checked_out = False
+        dbconn._last_used = time.monotonic()
+        with cls._pool_lock:
+            cls._idle.append(dbconn)
+        cls._slots.release()
+
+    # Connection of the calling thread, checked out on first use and kept until releaseConnection or close
     @classmethod
     def getConnection(cls) -> 'DBConnection':
-        dbconn = cls._owned_connections.get(threading.get_ident())
+        ident = threading.get_ident()
+        dbconn = cls._owned_connections.get(ident)
         if dbconn is None or not dbconn.is_connected():
             if dbconn:
                 dbconn.close()
-            dbconn = DBConnection()
-            cls._owned_connections[threading.get_ident()] = dbconn
+            dbconn = cls.checkout()
+            with cls._pool_lock:
+                cls._owned_connections[ident] = dbconn
 
         return dbconn
 
+    # Give the calling thread's connection back to the pool
+    @classmethod
+    def releaseConnection(cls) -> None:
+        dbconn = cls._owned_connections.get(threading.get_ident())
+        if dbconn is not None:
+            cls.checkin(dbconn)
+
+    # The calling thread's connection for the duration of the block, returned to the pool afterwards
+    # unless the thread already held one before
+    @classmethod
+    @contextmanager
+    def connection(cls):
+        held = threading.get_ident() in cls._owned_connections
+        dbconn = cls.getConnection()
+        try:
+            yield dbconn
+        finally:
+            if not held:
+                cls.checkin(dbconn)
+
+    # ids drawn by this connection
+    def idPool(self) -> IdPool:
+        return self._ids
+
     @classmethod
     def getNextId(cls) -> int:
-        if(len(cls._id_pool) == 0):
-            print("INFO: id pool empty, querying for more")
-            cls.fill_pool()
-        return cls._id_pool.pop(0)
+        return int(cls.get_ids(1)[0])
     
     @classmethod
-    def get_ids(cls, nIds: int) -> list:
-        while len(cls._id_pool)<nIds:
-            cls.fill_pool()
-        ret_ids = cls._id_pool[0:nIds]
-        del cls._id_pool[0:nIds]
+    def get_ids(cls, nIds: int) -> np.ndarray:
+        t_begin = time.perf_counter()
+        dbconn = cls.getConnection()
+        ret_ids = dbconn.idPool().take(dbconn, nIds)
+        metrics.record("ids", time.perf_counter() - t_begin, nIds)
         return ret_ids
     
+    # Reserve at least nIds more ids for the calling thread's connection
     @classmethod
-    def fill_pool(cls) -> None:
-        conn = cls.getConnection()
-        res = conn.execute("SELECT NEXTVAL(id_seq),increment from id_seq")
-        #res = cls.singleQuery("SELECT NEXTVAL(id_seq),increment from id_seq")
-        next_val = res[0][0]
-        increment = res[0][1]
-        print("DEBUG: Adding values %d to %d to id pool"  % (next_val,next_val+increment))
-        cls._id_pool.extend(range(next_val,next_val+increment))
\ No newline at end of file
+    def fill_pool(cls, nIds: int = 1) -> None:
+        dbconn = cls.getConnection()
+        dbconn.idPool().fill(dbconn, nIds)
+
+    @classmethod
+    def _clear_pool(cls) -> None:
+        cls._ids.clear()
+
+    # Close the idle connections and those bound to threads, e.g. before switching backend
+    @classmethod
+    def closeAll(cls) -> None:
+        with cls._pool_lock:
+            connections = list(cls._idle) + list(cls._owned_connections.values())
+            cls._idle = deque()
+        for dbconn in connections:
+            dbconn.close()
+
+    # A forked ingestion worker must open its own connection and draw its own ids
+    # rather than share the parent's sockets and id pool
+    @classmethod
+    def _after_fork(cls) -> None:
+        cls._open_connections = []
+        cls._ids = IdPool()
+        cls._idle = deque()
+        cls._slots = threading.BoundedSemaphore(pool_size)
+        cls._pool_lock = threading.Lock()
+        cls._owned_connections = {}
+        # the lock may have been held by another thread of the parent, the cached keys are still valid
+        key_cache._lock = threading.Lock()
+
+# MariaDB server configured by db.properties
+class MySQLConnection(DBConnection):
+    _id_increment = None
+    _block_reserve = False
+    _bulk_mode = bulk_mode if bulk_mode in BULK_MODES else "executemany"
+
+    def __init__(self):
+        super().__init__()
+        if mysql is None:
+            raise Exception("backend mysql needs mysql-connector-python installed")
+        self.conn = mysql.connector.connect(host=db_host,
+                                   database=db_name,
+                                   user=db_user,
+                                   password=db_password,
+                                   allow_local_infile=(MySQLConnection._bulk_mode == "infile"))
+
+        self.conn.autocommit = False
+        self.conn.sql_mode = 'TRADITIONAL,NO_ENGINE_SUBSTITUTION'
+        self.cursor = self.conn.cursor()
+
+        DBConnection._open_connections.append(self.conn)
+
+    def start_transaction(self) -> None:
+        if not self.conn.in_transaction:
+            self.conn.start_transaction(consistent_snapshot=True, isolation_level='READ COMMITTED', readonly=False)
+
+    def in_transaction(self) -> bool:
+        return self.conn.in_transaction
+    
+    def is_connected(self) -> bool:
+        return self.conn.is_connected()
+
+    # Load with the configured bulk_mode. If the server refuses LOAD DATA LOCAL the process falls back to multi-row INSERTs
+    def _bulk_load(self, table: str, columns: list, values: list, nRows: int) -> None:
+        if MySQLConnection._bulk_mode == "infile":
+            try:
+                self._load_infile(table, columns, values, nRows)
+                return
+            except mysql.connector.Error as error:
+                if error.errno not in _INFILE_REFUSED:
+                    self._bulk_error("LOAD DATA LOCAL INFILE into %s" % (table), error)
+                print("WARNING: LOAD DATA LOCAL INFILE refused, using multi-row inserts: %s" % (error))
+                MySQLConnection._bulk_mode = "multirow"
+        if MySQLConnection._bulk_mode == "multirow":
+            self._insert_multirow(table, columns, values, nRows)
+        else:
+            self._insert_executemany(table, columns, values, nRows)
+
+    def _insert_multirow(self, table: str, columns: list, values: list, nRows: int) -> None:
+        rows = _join_columns(_column_text(values, nRows), ",")
+        for i in range(0,nRows,bulk_batch_size):
+            query = "INSERT INTO %s(%s) VALUES (%s)" % (table, ",".join(columns), "),(".join(rows[i:i+bulk_batch_size].tolist()))
+            try:
+                if not self.cursor:
+                    self.cursor = self.conn.cursor()
+                self.cursor.execute(query)
+                self.pending_rows += len(rows[i:i+bulk_batch_size])
+            except Exception as error:
+                self._bulk_error("multi-row INSERT into %s" % (table), error)
+
+    def _load_infile(self, table: str, columns: list, values: list, nRows: int) -> None:
+        rows = _join_columns(_column_text(values, nRows), "\t")
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False) as file:
+            file.write("\n".join(rows.tolist()))
+            file.write("\n")
+        try:
+            if not self.cursor:
+                self.cursor = self.conn.cursor()
+            self.cursor.execute("LOAD DATA LOCAL INFILE %%s INTO TABLE %s (%s)" % (table, ",".join(columns)), [file.name])
+            self.pending_rows += nRows
+        finally:
+            os.remove(file.name)
+
+    # Each NEXTVAL(id_seq) hands out a block of `increment` ids, so one NEXTVAL per block needed is evaluated
+    # over MariaDB's seq_1_to_<n> table. NEXTVAL is atomic, so processes sharing the sequence never get the same block
+    def _reserve_ids(self, nIds: int) -> tuple:
+        if MySQLConnection._id_increment is None:
+            MySQLConnection._id_increment = self.execute("SELECT increment from id_seq")[0][0]
+            MySQLConnection._block_reserve = bool(self.execute("SELECT 1 FROM information_schema.ENGINES WHERE ENGINE='SEQUENCE' and SUPPORT in ('YES','DEFAULT')"))
+        increment = MySQLConnection._id_increment
+        nBlocks = -(-nIds // increment)
+        if nBlocks > 1 and MySQLConnection._block_reserve:
+            res = self.execute("SELECT NEXTVAL(id_seq) FROM seq_1_to_%d" % (nBlocks))
+        else:
+            res = [self.execute("SELECT NEXTVAL(id_seq)")[0] for _ in range(nBlocks)]
+        return [row[0] for row in res], increment
+
+# Embedded SQLite database file with the ENDF_ddl.sql schema, created on first use.
+# Runs in WAL mode with relaxed syncing, writers take the database lock when their transaction starts writing
+class SQLiteConnection(DBConnection):
+    def __init__(self):
+        super().__init__()
+        self.conn = sqlite3.connect(sqlite_path, timeout=600, isolation_level="IMMEDIATE", check_same_thread=False)
+        for pragma in ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY",
+                       "cache_size=-%d" % (sqlite_cache_mb*1024), "mmap_size=%d" % (sqlite_cache_mb*1024*1024)):
+            self.conn.execute("PRAGMA " + pragma)
+        if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE name='id_seq'").fetchall():
+            self.conn.executescript(sqlite_schema(ddl_file))
+        self.cursor = self.conn.cursor()
+        # ids are reserved in the current transaction, so a rollback hands them out again. Until the transaction
+        # commits no other connection may use them, hence an id pool per connection
+        self._reserved = False
+        self._ids = IdPool()
+
+        DBConnection._open_connections.append(self.conn)
+
+    def commit(self):
+        super().commit()
+        self._reserved = False
+    def rollback(self):
+        super().rollback()
+        if self._reserved:
+            self._ids.clear()
+            self._reserved = False
+
+    def start_transaction(self) -> None:
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+
+    def in_transaction(self) -> bool:
+        return self.conn.in_transaction
+
+    def is_connected(self) -> bool:
+        return self.conn is not None
+
+    def _sql(self, query: str) -> str:
+        return query.replace("%s", "?").replace(" ON DUPLICATE KEY UPDATE id=id", " ON CONFLICT DO NOTHING")
+
+    def _reserve_ids(self, nIds: int) -> tuple:
+        increment = SQLITE_ID_BLOCK
+        nBlocks = -(-nIds // increment)
+        self.execute("UPDATE id_seq SET next_val=next_val+%s", [nBlocks*increment])
+        next_val = self.execute("SELECT next_val FROM id_seq")[0][0]
+        self._reserved = True
+        self._reservations += 1
+        start = next_val - nBlocks*increment
+        return [start + i*increment for i in range(nBlocks)], increment
+
+BACKENDS = {"mysql": MySQLConnection, "sqlite": SQLiteConnection}
+
+# Switch the backend of connections opened from now on, e.g. to run the same ingestion against SQLite
+def set_backend(name: str, path: str = None) -> None:
+    global backend, sqlite_path
+    if name not in BACKENDS:
+        raise Exception("Unknown backend: %s" % (name))
+    DBConnection.closeAll()
+    DBConnection._clear_pool()
+    key_cache.clear()
+    backend = name
+    if path is not None:
+        sqlite_path = path
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=DBConnection._after_fork)
@@ -0,0 +1,267 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import CrossSection
+import DB
+from DB import DBConnection, pack_array, unpack_array
+from Metrics import metrics
+
+# Doppler broadening of MF3 cross sections to a higher temperature with the SIGMA1 kernel (Cullen & Weisbin).
+# In the velocity variable x = sqrt(alpha*E), alpha = AWR/(k*(T - T0)), the cross section broadened from T0 to T is
+#   s*(y) = 1/(y^2 sqrt(pi)) * integral over x >= 0 of x^2 s(x) (exp(-(x-y)^2) - exp(-(x+y)^2)) dx
+# A lin-lin table is linear in E = x^2/alpha on each interval, so the integral over an interval is a combination of
+# the moments F_n(a) = 1/sqrt(pi) * integral from a to inf of z^n exp(-z^2) dz, n = 0..4, which have closed forms.
+# Intervals further than CUTOFF from y are skipped. erfc(CUTOFF) is about 1.5e-8, but the kernel is weighted by x^2 so
+# what is left out reaches 2e-6 of the broadened value where y is small. Below the table the cross section is extended
+# as 1/v, above it as constant. Tables are broadened at their own energies
+
+# eV/K
+BOLTZMANN = 8.617333262e-5
+CUTOFF = 4.0
+# interval and energy pairs integrated at once
+PAIR_BATCH = 250000
+
+# erfc is interpolated from a table: cubic Hermite on ERFC_STEP steps over [-ERFC_RANGE, ERFC_RANGE], using its exact
+# derivative, is within 2e-13 of it. Beyond the range erfc is 2 or 0 within 3e-17
+ERFC_RANGE = 6.0
+ERFC_STEP = 1.0/512
+_erfc_x = np.linspace(-ERFC_RANGE, ERFC_RANGE, int(round(2*ERFC_RANGE/ERFC_STEP)) + 1)
+_erfc_y = np.array([math.erfc(t) for t in _erfc_x])
+_erfc_dy = -2/math.sqrt(math.pi)*np.exp(-_erfc_x*_erfc_x)*ERFC_STEP
+
+def _erfc(a: np.ndarray) -> np.ndarray:
+    t = (np.clip(a, -ERFC_RANGE, ERFC_RANGE) + ERFC_RANGE)/ERFC_STEP
+    i = np.minimum(t.astype(np.int64), len(_erfc_x) - 2)
+    s = t - i
+    s2 = s*s
+    s3 = s2*s
+    return ((2*s3 - 3*s2 + 1)*_erfc_y[i] + (s3 - 2*s2 + s)*_erfc_dy[i] +
+            (3*s2 - 2*s3)*_erfc_y[i+1] + (s3 - s2)*_erfc_dy[i+1])
+
+def _moments(a: np.ndarray) -> tuple:
+    F0 = 0.5*_erfc(a)
+    F1 = np.exp(-a*a)/(2*math.sqrt(math.pi))
+    F2 = 0.5*F0 + a*F1
+    F3 = (1 + a*a)*F1
+    F4 = 1.5*F2 + a*a*a*F1
+    return F0, F1, F2, F3, F4
+
+# Integral of x^2 s(x) exp(-(x-y)^2)/sqrt(pi) over [xa, xb], divided by y^2, for the segment s = s0 + m*(E' - E0),
+# given the moments Fa at xa - y and Fb at xb - y. Written around the energy E of y the coefficients stay of the size
+# of the cross section even for large y. y is negative for the exp(-(x+y)^2) term
+def _segment(y, E, Fa: tuple, Fb: tuple, s0, m, E0, alpha: float) -> np.ndarray:
+    P = s0 + m*(E - E0)
+    Q = 2*y*m/alpha
+    R = m/alpha
+    coefficients = (P, Q + 2*P/y, R + 2*Q/y + P/(y*y), 2*R/y + Q/(y*y), R/(y*y))
+    return sum(c*(a - b) for c, a, b in zip(coefficients, Fa, Fb))
+
+# 1/v extension s = K/x on [0, x0] below the table, x^2 s = K*(z + y) in z = x - y
+def _inverse_v(y, K, x0: float) -> np.ndarray:
+    Fa = _moments(-y)
+    Fb = _moments(x0 - y)
+    return K/y*(Fa[0] - Fb[0]) + K/(y*y)*(Fa[1] - Fb[1])
+
+# Broaden a TAB1 table (NBT, INT, X, Y) of a nuclide of mass AWR from T0 to T kelvin. Tables using other laws than
+# lin-lin are linearized to tolerance first. Returns the broadened table as one lin-lin region on the same energies
+def broaden(table: tuple, AWR: float, T: float, T0: float = 0.0, tolerance: float = 1e-3) -> tuple:
+    NBT, INT, X, Y = table
+    if np.any(np.asarray(INT) != CrossSection.LIN_LIN):
+        NBT, INT, X, Y = CrossSection.linearize(table, tolerance)
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    dT = T - T0
+    if dT < 0:
+        raise Exception("Cannot broaden from %g K down to %g K" % (T0, T))
+    if dT == 0 or len(X) < 2:
+        return (np.array([len(X)], dtype=np.int64), np.array([CrossSection.LIN_LIN], dtype=np.int64), X, Y)
+
+    t_begin = time.perf_counter()
+    alpha = AWR/(BOLTZMANN*dT)
+    x = np.sqrt(alpha*np.maximum(X, 0))
+    slopes = np.zeros(len(X) - 1)
+    wide = X[1:] > X[:-1]
+    slopes[wide] = (Y[1:] - Y[:-1])[wide]/(X[1:] - X[:-1])[wide]
+
+    # energies of 0 stay as they are, the kernel is singular there
+    points = np.flatnonzero(X > 0)
+    if not len(points):
+        return (np.array([len(X)], dtype=np.int64), np.array([CrossSection.LIN_LIN], dtype=np.int64), X, Y)
+    E = X[points]
+    broadened = np.zeros(len(points))
+    for sign in (1, -1):
+        y = sign*x[points]
+        # intervals k, between x[k] and x[k+1], within CUTOFF of y
+        lo = np.maximum(np.searchsorted(x, y - CUTOFF, side='right') - 1, 0)
+        hi = np.minimum(np.searchsorted(x, y + CUTOFF, side='left'), len(x) - 1)
+        counts = np.maximum(hi - lo, 0)
+        total = np.cumsum(counts)
+        integral = np.zeros(len(points))
+        for batch in np.split(np.arange(len(points)), np.searchsorted(total, np.arange(PAIR_BATCH, total[-1], PAIR_BATCH))):
+            if not len(batch):
+                continue
+            # the moments at the nodes lo..hi of each energy, shared by the intervals on either side of a node
+            c = counts[batch]
+            nodes = np.repeat(lo[batch] - (np.cumsum(c + 1) - c - 1), c + 1) + np.arange((c + 1).sum())
+            F = _moments(x[nodes] - np.repeat(y[batch], c + 1))
+            a = np.arange(c.sum()) + np.repeat(np.arange(len(batch)), c)
+            j = np.repeat(batch, c)
+            k = nodes[a]
+            integral += np.bincount(j, weights=_segment(y[j], E[j], [Fn[a] for Fn in F], [Fn[a + 1] for Fn in F],
+                                                        Y[k], slopes[k], X[k], alpha), minlength=len(points))
+        if x[0] > 0:
+            integral += _inverse_v(y, Y[0]*x[0], x[0])
+        integral += _segment(y, E, _moments(x[-1] - y), (0, 0, 0, 0, 0), Y[-1], 0.0, X[-1], alpha)
+        broadened += sign*integral
+
+    result = Y.copy()
+    # rounding can leave values just below 0 where a cross section vanishes
+    result[points] = np.maximum(broadened, 0.0)
+    metrics.record("doppler", time.perf_counter() - t_begin, len(X))
+    return (np.array([len(X)], dtype=np.int64), np.array([CrossSection.LIN_LIN], dtype=np.int64), X, result)
+
+def _broaden_job(job: tuple, tolerance: float) -> tuple:
+    key, table, AWR, T0, T = job
+    return key, broaden(table, AWR, T, T0, tolerance), metrics.pop()
+
+# Broaden (key, table, AWR, T0, T) jobs, e.g. every reaction of many materials at several temperatures,
+# across a pool of worker processes. Returns the broadened tables by key
+def broaden_all(jobs: list, workers: int = 1, tolerance: float = 1e-3) -> dict:
+    if workers <= 1:
+        return {key: broaden(table, AWR, T, T0, tolerance) for key, table, AWR, T0, T in jobs}
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for key, table, snapshot in executor.map(_broaden_job, jobs, [tolerance]*len(jobs),
+                                                 chunksize=max(1, len(jobs)//(4*workers))):
+            metrics.merge(snapshot)
+            results[key] = table
+    return results
+
+# Store broadened tables (by MT) as a derived evaluation of the material: one DerivedEvaluation row per TEMP and LDRV,
+# one packed DerivedCrossSection row per reaction. Reactions already stored are kept. Returns the evaluation's id
+def persist_broadened(conn: DBConnection, material_key: int, library_key: int, TEMP: float, LDRV: int, T0: float, tables: dict) -> int:
+    res = conn.execute("SELECT id FROM DerivedEvaluation WHERE material_key=%s and library_key=%s and abs(TEMP-%s)<.05 and LDRV=%s",
+                       [material_key, library_key, TEMP, LDRV])
+    if res:
+        derived_key = res[0][0]
+    else:
+        derived_key = DBConnection.getNextId()
+        conn.execute("INSERT INTO DerivedEvaluation(id,material_key,library_key,TEMP,LDRV,Description) VALUES(%s,%s,%s,%s,%s,%s)",
+                     [derived_key, material_key, library_key, TEMP, LDRV, "Doppler broadened from %g K to %g K" % (T0, TEMP)])
+    for MT, (NBT, INT, X, Y) in sorted(tables.items()):
+        res = conn.execute("SELECT 1 FROM DerivedCrossSection WHERE derived_key=%s and MT=%s", [derived_key, MT])
+        if res:
+            continue
+        blobs = [pack_array(X, "<f8"), pack_array(Y, "<f8")]
+        with metrics.timer("insert.DerivedCrossSection", 1, sum(len(blob) for blob in blobs)):
+            conn.execute("INSERT INTO DerivedCrossSection(derived_key,MT,compression,NP,Energy,CrossSection) VALUES(%s,%s,%s,%s,%s,%s)",
+                         [derived_key, MT, DB.xs_compression, len(X)] + blobs)
+    return derived_key
+
+# Read a broadened cross section as (NBT, INT, X, Y) like read_cross_section, None if it was not persisted
+def read_broadened(conn: DBConnection, material_key: int, library_key: int, MT: int, TEMP: float, LDRV: int = 1) -> tuple:
+    res = conn.execute("SELECT c.compression,c.Energy,c.CrossSection FROM DerivedEvaluation d JOIN DerivedCrossSection c ON c.derived_key=d.id "
+                       "WHERE d.material_key=%s and d.library_key=%s and abs(d.TEMP-%s)<.05 and d.LDRV=%s and c.MT=%s",
+                       [material_key, library_key, TEMP, LDRV, MT])
+    if not res:
+        return None
+    compression, X, Y = res[0]
+    X = unpack_array(X, "<f8", compression)
+    return (np.array([len(X)], dtype=np.int64), np.array([CrossSection.LIN_LIN], dtype=np.int64), X, unpack_array(Y, "<f8", compression))
+
+# Broaden every MF3 reaction of the given materials (all if none are given) in the database to each temperature
+def broaden_database(temperatures: list, mats: list, workers: int, tolerance: float, persist: bool, LDRV: int) -> None:
+    conn = DBConnection.getConnection()
+    query = "SELECT g.material_key,g.library_key,m.MAT,m.AWR,g.TEMP FROM GeneralInfo g JOIN Material m ON m.id=g.material_key"
+    if mats:
+        query += " WHERE m.MAT IN (%s)" % (",".join(["%s"]*len(mats)))
+    jobs = []
+    materials = conn.execute(query, mats or None)
+    for material_key, library_key, MAT, AWR, T0 in materials:
+        for (MT,) in conn.execute("SELECT MT FROM CrossSectionInfo WHERE material_key=%s and library_key=%s ORDER BY MT", [material_key, library_key]):
+            table = CrossSection.read_cross_section(conn, material_key, library_key, MT)
+            if table is None or len(table[2]) < 2:
+                continue
+            for T in temperatures:
+                jobs.append(((material_key, library_key, float(T0), T, MT), table, float(AWR), float(T0), T))
+    print("INFO: broadening %d tables of %d materials to %s K" % (len(jobs), len(materials), ", ".join("%g" % (T) for T in temperatures)))
+
+    t_begin = time.perf_counter()
+    results = broaden_all(jobs, workers, tolerance)
+    elapsed = max(time.perf_counter() - t_begin, 1e-9)
+    points = sum(len(table[2]) for table in results.values())
+    print("INFO: broadened %d points in %.1f s with %d workers (%.0f points/s)" % (points, elapsed, workers, points/elapsed))
+
+    if persist:
+        evaluations = {}
+        for (material_key, library_key, T0, T, MT), table in results.items():
+            evaluations.setdefault((material_key, library_key, T0, T), {})[MT] = table
+        for (material_key, library_key, T0, T), tables in evaluations.items():
+            persist_broadened(conn, material_key, library_key, T, LDRV, T0, tables)
+            conn.commit()
+        print("INFO: persisted %d derived evaluations with LDRV=%d" % (len(evaluations), LDRV))
+
+# Time broaden_all on synthetic tables, linearized beforehand, and report points per second as JSON.
+# The benchmark and generator tools are only needed here, broadening itself does not import them
+def benchmark(args) -> dict:
+    from ENDFBenchmark import git_commit
+    from ENDFGenerator import synthetic_table
+    rng = np.random.default_rng(args.seed)
+    tables = [CrossSection.linearize(synthetic_table(rng, args.points, args.regions), args.tolerance) for _ in range(args.reactions)]
+    jobs = [((r, T), table, args.awr, 0.0, T) for r, table in enumerate(tables) for T in args.temperatures]
+    points = sum(len(job[1][2]) for job in jobs)
+    runs = []
+    for run in range(args.repeat):
+        t_begin = time.perf_counter()
+        broaden_all(jobs, args.workers, args.tolerance)
+        runs.append(time.perf_counter() - t_begin)
+        print("INFO: run %d: %.3f s (%.0f points/s)" % (run, runs[-1], points/max(runs[-1], 1e-9)))
+    best = max(min(runs), 1e-9)
+    return {"benchmark": "Doppler broadening",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": {"reactions": args.reactions, "points": args.points, "regions": args.regions, "awr": args.awr,
+                           "temperatures": args.temperatures, "workers": args.workers, "tolerance": args.tolerance,
+                           "seed": args.seed, "repeat": args.repeat},
+            "tables": len(jobs), "points": points,
+            "seconds": runs, "min": min(runs), "median": statistics.median(runs), "points_per_s": points/best}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Doppler broaden MF3 cross sections in the database, or benchmark broadening on synthetic tables")
+    parser.add_argument("--temperatures", type=float, nargs="+", required=True, help="target temperatures (K)")
+    parser.add_argument("--mat", type=int, nargs="*", default=[], help="MAT numbers to broaden, all materials if not given")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="relative tolerance of the linearization of non lin-lin tables")
+    parser.add_argument("--persist", action="store_true", help="store the results as derived evaluations")
+    parser.add_argument("--ldrv", type=int, default=1, help="LDRV of the derived evaluations")
+    parser.add_argument("--benchmark", action="store_true", help="time broadening of synthetic tables instead")
+    parser.add_argument("--reactions", type=int, default=10)
+    parser.add_argument("--points", type=int, default=20000)
+    parser.add_argument("--regions", type=int, default=3)
+    parser.add_argument("--awr", type=float, default=233.0248)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="file to write the JSON benchmark results to, stdout if not given")
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        broaden_database(args.temperatures, args.mat, args.workers, args.tolerance, args.persist, args.ldrv)
+        sys.exit(0)
+    # progress goes to stderr so stdout only carries the JSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = json.dumps(benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(results + "\n")
+    else:
+        print(results)
@@ -1,102 +1,630 @@
 import os
 import configparser
+import hashlib
+import json
+import queue
+import threading
 import traceback
 import zipfile
-from ENDFParser import ENDFTape, NaNException
-from DB import DBConnection
-
-dats = []
-zips = []
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ENDFParser import ENDFTape, InvalidDataException, formatSectionFilter, parseSectionFilter, withHeaderSection, READ_CHUNK_SIZE
+from DB import DBConnection, key_cache
+import DB
+from Metrics import Metrics, metrics, profiled
+from UnionGrid import UnionGrid, DEFAULT_TOLERANCE as UNION_GRID_TOLERANCE
 
 config = configparser.ConfigParser()
 config.read('ENDF.properties')
 endf_library = config.get("endf", "library_dir")
+# optional MF/MT include filter, e.g. "1:451 3:1,2,18,102"; empty for every section
+section_filter = config.get("endf", "sections", fallback="").strip()
+sections = parseSectionFilter(section_filter) if section_filter else None
+# number of ingestion processes, 1 ingests in this process
+workers = config.getint("endf", "workers", fallback=1)
+# number of processes decoding the materials of one tape in parallel, 1 decodes them in the ingesting process
+tape_workers = config.getint("endf", "tape_workers", fallback=1)
+# skip files whose size, mtime and content hash show they were already persisted without errors
+incremental = config.getboolean("endf", "incremental", fallback=False)
+# directory keeping decoded tapes by content hash so they are reloaded instead of parsed again; empty to disable
+parse_cache_dir = config.get("endf", "parse_cache_dir", fallback="").strip() or None
+# materials are committed in groups once this many are pending, or once their transaction has written commit_rows rows
+commit_materials = config.getint("endf", "commit_materials", fallback=20)
+commit_rows = config.getint("endf", "commit_rows", fallback=1000000)
+# overlap reading, decoding and persisting of tapes in threads joined by bounded queues (see ingest_pipelined)
+pipeline = config.getboolean("endf", "pipeline", fallback=False)
+# items each pipeline queue holds before the stage feeding it waits
+pipeline_depth = config.getint("endf", "pipeline_depth", fallback=8)
+# reader threads of the pipeline, each reads and decompresses whole files or zip members with its own archive handles
+read_workers = config.getint("endf", "read_workers", fallback=1)
+# profilers run around each tape: any of cprofile, tracemalloc (comma separated); empty for none
+profile_modes = set(mode.strip() for mode in config.get("endf", "profile", fallback="").split(",") if mode.strip())
+if not profile_modes <= {"cprofile", "tracemalloc"}:
+    raise Exception("Unknown profile mode: %s" % (", ".join(sorted(profile_modes - {"cprofile", "tracemalloc"}))))
+# directory for the cProfile stats of each tape
+profile_dir = config.get("endf", "profile_dir", fallback="profiles")
+# file the JSON metrics summary of the run is written to, printed when empty
+metrics_file = config.get("endf", "metrics_file", fallback="").strip() or None
+# linearize MF3 tables using other laws than lin-lin to this relative tolerance before they are persisted, 0 keeps them
+linearize_tolerance = config.getfloat("endf", "linearize_tolerance", fallback=0)
+# persist the unionized energy grid of each material's MF3 reactions (see UnionGrid) with a hash table of this many
+# log-energy bins, 0 for none
+union_grid = config.getboolean("endf", "union_grid", fallback=False)
+union_grid_bins = config.getint("endf", "union_grid_bins", fallback=0)
+# relative tolerance the reactions of a union grid are linearized to when linearize_tolerance does not already
+union_grid_tolerance = config.getfloat("endf", "union_grid_tolerance", fallback=UNION_GRID_TOLERANCE)
+
+# zip archives opened by each thread of this process, kept open across its jobs.
+# A ZipFile serialises reads of its members through one file handle, so threads reading in parallel open their own
+_local = threading.local()
+# pool decoding materials for this process's tapes, started on first use
+_tape_executor = None
+
+def tape_executor() -> ProcessPoolExecutor:
+    global _tape_executor
+    if tape_workers > 1 and _tape_executor is None:
+        _tape_executor = ProcessPoolExecutor(max_workers=tape_workers)
+    return _tape_executor
+
+# Process pool initializer: forked workers inherit the parent's warm key cache, spawned ones load their own
+def warm_key_cache() -> None:
+    if not len(key_cache):
+        DBConnection.getConnection().warmKeyCache()
+
+def get_archive(path: str) -> zipfile.ZipFile:
+    archives = _local.__dict__.setdefault("archives", {})
+    archive = archives.get(path)
+    if archive is None:
+        archive = archives[path] = zipfile.ZipFile(path, 'r')
+    return archive
+
+# The ingestion of one file or zip member is tracked in a state dict: the job and its start time, then the tape,
+# its Files row id, the materials persisted so far (and how many of them are not committed yet),
+# whether anything failed and the key cache counters at the start
+
+# Transaction policy: each material is persisted behind a SAVEPOINT, so a failing one is rolled back alone, and
+# materials are committed together once commit_materials of them are pending or commit_rows rows were written.
+# The Files rows of the tapes share these transactions, so a tape's content hash is committed with its last material
+class GroupCommit():
+    def __init__(self):
+        self.materials = 0
+        # states of the tapes with uncommitted changes
+        self.states = []
+
+    def add(self, state: dict) -> None:
+        if not any(pending is state for pending in self.states):
+            self.states.append(state)
+
+    def persisted(self, conn: DBConnection, state: dict) -> None:
+        state["materials"] += 1
+        state["uncommitted"] += 1
+        self.materials += 1
+        if self.materials >= commit_materials or conn.pending_rows >= commit_rows:
+            self.commit(conn)
+
+    def commit(self, conn: DBConnection) -> None:
+        conn.commit()
+        for state in self.states:
+            state["uncommitted"] = 0
+        self.materials = 0
+        self.states = []
+
+    # Roll back the whole transaction, e.g. when the server already dropped it. The tapes it touched lose
+    # their uncommitted materials and Files changes and are marked failed, so they are ingested again next time
+    def lost(self, conn: DBConnection) -> None:
+        conn.rollback()
+        for state in self.states:
+            print("ERROR: rolled back %d uncommitted materials of %s %s" % ((state["uncommitted"],) + state["job"][:2]))
+            state["materials"] -= state["uncommitted"]
+            state["uncommitted"] = 0
+            state["failed"] = True
+            state.pop("file_key", None)
+        self.materials = 0
+        self.states = []
+
+# transactions of this process
+group = GroupCommit()
+
+# Stream the materials of a tape, persisting each one as it is read
+def persist_tape(conn: DBConnection, state: dict) -> None:
+    materials = state["tape"].iterMaterials(tape_executor())
+    while True:
+        try:
+            mat = next(materials)
+        except StopIteration:
+            break
+        except(Exception) as error:
+            record_failure(conn, state, "Parse", error)
+            break
+        persist_material(conn, state, mat)
 
-conn = DBConnection.getConnection()
-
-print("Searching library directory: %s" % (endf_library))
-try:
-    for root, dirs, files in os.walk(endf_library):
-        for name in files:
-            ext = os.path.splitext(name)[1]
-            if ext.lower()==".zip":
-                zips.append(os.path.join(root,name))
-            elif ext.lower()==".dat" or ext.lower()==".txt":
-                dats.append(os.path.join(root,name))
-
-except Exception as error:
-    print("Error while scanning ENDF Library files: %s" % (endf_library))
-    print(type(error))
-    print(error)
-    traceback.print_exc()
-
-print("Found data files: %d\tzip files: %d" % (len(dats),len(zips)))
-try:
+def persist_material(conn: DBConnection, state: dict, mat) -> None:
+    if "file_key" not in state:
+        start_tape(conn, state)
+    group.add(state)
+    try:
+        mat.parse(persistable=True)
+    except(Exception) as error:
+        record_failure(conn, state, "Parse", error)
+        return
+    try:
+        conn.savepoint("material")
+        mat.setFileKey(state["file_key"])
+        if linearize_tolerance > 0:
+            mat.linearize(linearize_tolerance)
+        mat.persist()
+        if union_grid:
+            grid = UnionGrid.fromMaterial(mat, union_grid_bins, union_grid_tolerance)
+            if grid is not None:
+                grid.persist(conn, mat.mat_key, mat.lib_key)
+        conn.releaseSavepoint("material")
+    except(Exception) as error:
+        try:
+            conn.rollbackToSavepoint("material")
+        except(Exception) as rollback_error:
+            print("ERROR: rolling back to savepoint: %s" % (rollback_error))
+            group.lost(conn)
+        # invalid data is rejected by the checks made before anything is written
+        record_failure(conn, state, "Invalid" if isinstance(error, InvalidDataException) else "Persist", error)
+        return
+    group.persisted(conn, state)
+
+# Note the error in the Files row, the file's content hash is then left unset so it is ingested again.
+# What is pending is committed first, so an error here cannot take other materials with it
+def record_failure(conn: DBConnection, state: dict, stage: str, error: Exception) -> None:
+    if isinstance(error, InvalidDataException):
+        print("ERROR: invalid data in %s %s: %s" % (state["job"][:2] + (json.dumps(error.failures),)))
+    else:
+        print(str(error))
+        traceback.print_exception(type(error), error, error.__traceback__)
+    group.commit(conn)
+    if "file_key" not in state:
+        start_tape(conn, state)
+    conn.execute("UPDATE Files set comment=%s where id=%s", [failure_comment(stage, error), state["file_key"]])
+    group.commit(conn)
+    state["failed"] = True
+
+# width of Files.comment
+COMMENT_LENGTH = 2000
+# sections named per reason in the comment of a tape with invalid data, the log lists them all
+COMMENT_SECTIONS = 5
+
+# Comment of a failed tape for its Files row: invalid data is summarized as the number of sections failing
+# each check and the first few of them, anything longer than the column is cut off
+def failure_comment(stage: str, error: Exception) -> str:
+    if isinstance(error, InvalidDataException):
+        reasons = {}
+        for failure in error.failures:
+            reasons.setdefault(failure["reason"], []).append(failure)
+        summaries = []
+        for reason, failures in reasons.items():
+            named = ["MAT %(MAT)s MF %(MF)s MT %(MT)s" % failure for failure in failures[:COMMENT_SECTIONS]]
+            named[0] += " (%s)" % (failures[0]["detail"])
+            if len(failures) > COMMENT_SECTIONS:
+                named.append("...")
+            summaries.append("%s in %d sections: %s" % (reason, len(failures), ", ".join(named)))
+        comment = stage + ": " + "; ".join(summaries)
+    else:
+        comment = stage + ": " + str(error)
+    if len(comment) > COMMENT_LENGTH:
+        comment = comment[:COMMENT_LENGTH - 3] + "..."
+    return comment
+
+def find_files(library: str):
+    dats = []
+    zips = []
+    print("Searching library directory: %s" % (library))
+    try:
+        for root, dirs, files in os.walk(library):
+            for name in files:
+                ext = os.path.splitext(name)[1]
+                if ext.lower()==".zip":
+                    zips.append(os.path.join(root,name))
+                elif ext.lower()==".dat" or ext.lower()==".txt":
+                    dats.append(os.path.join(root,name))
+
+    except Exception as error:
+        print("Error while scanning ENDF Library files: %s" % (library))
+        print(type(error))
+        print(error)
+        traceback.print_exc()
+
+    print("Found data files: %d\tzip files: %d" % (len(dats),len(zips)))
+    return dats, zips
+
+# A job is (path, member, size, mtime, expected_hash): a plain file has member None, a zip member is read from the zip at path.
+# size and mtime come from the file system or the zip directory, so they are known without opening the file.
+# expected_hash is the recorded content hash when only the mtime changed, the file is skipped if its contents still match
+def find_jobs(library: str) -> list:
+    dats, zips = find_files(library)
+    jobs = []
     for dat_file in dats:
-#        break # skip these to test zip parsing
-        filename = dat_file.split(os.sep)[-1]
-        rel_path = dat_file.replace(endf_library,'').replace(os.sep+filename,'')
-        res = conn.execute("SELECT id from Files where name = %s and path = %s and zip_file is null",[filename,rel_path])
-        if res:
-            file_key = res[0][0]
-        else:
-            file_key = DBConnection.getNextId()
-            conn.execute("INSERT INTO Files (id,name,path) VALUES(%s,%s,%s)",[file_key,filename,rel_path])
-
-        print("Parsing file: %s at %s" % (filename,rel_path))
-        tape = ENDFTape(dat_file)
-        tape.parseTape()
-        tape.setFileKey(file_key)
-        for mat in tape.getMaterials():
-            try:
-                mat.persist()
-                conn.commit()
-#            except NaNException:
-            except(Exception) as error:
-                conn.rollback()
-                print(str(error))
-                traceback.print_exc()
-                conn.execute("UPDATE Files set comment=%s where id=%s", ["Persist: "+str(error), file_key])
-                conn.commit()
-        #print("Inserted %d rows from file %s" % (len(data),dat_file))
-    
+        stat = os.stat(dat_file)
+        jobs.append((dat_file, None, stat.st_size, stat.st_mtime, None))
     for zip_file in zips:
-        filename = zip_file.split(os.sep)[-1]
-        rel_path = zip_file.replace(endf_library,'').replace(os.sep+filename,'')
-        archive = zipfile.ZipFile(zip_file, 'r')
-        for dat_file in archive.namelist():
-            res = conn.execute("SELECT id from Files where name = %s and path = %s and zip_file = %s",[dat_file,rel_path, filename])
-            if res:
-                file_key = res[0][0]
-            else: 
-                file_key = DBConnection.getNextId()           
-                conn.execute("INSERT INTO Files (id,name,path,zip_file) VALUES(%s,%s,%s,%s)",[file_key,dat_file,rel_path, filename])
-                conn.commit()
-
-            print("Parsing file: %s in zip %s at %s" % (dat_file,zip_file,rel_path))
-            tape = ENDFTape(dat_file,archive)
+        with zipfile.ZipFile(zip_file, 'r') as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    jobs.append((zip_file, info.filename, info.file_size, time.mktime(info.date_time + (0, 0, -1)), None))
+    return jobs
+
+# (name, path, zip_file) of the Files row of a file or zip member
+def file_names(path: str, member: str) -> tuple:
+    filename = path.split(os.sep)[-1]
+    rel_path = path.replace(endf_library,'').replace(os.sep+filename,'')
+    if member is None:
+        return filename, rel_path, None
+    return member, rel_path, filename
+
+# SHA-256 of the settings changing what ingesting a file persists: the section filter, linearization, union grids
+# and how cross sections are stored. A file is only skipped when it was persisted with the same settings
+def settings_hash() -> str:
+    settings = {"sections": None if sections is None else formatSectionFilter(withHeaderSection(sections)),
+                "linearize_tolerance": linearize_tolerance,
+                "union_grid": [union_grid, union_grid_bins, union_grid_tolerance] if union_grid else None,
+                "xs_storage": DB.xs_storage, "xs_compression": DB.xs_compression if DB.xs_storage == "packed" else None}
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+# Drop the jobs whose Files row records the same size and mtime, the current settings and a content hash, which is
+# only set once every material of the file was persisted. All Files rows are read with one query
+def skip_unchanged(conn: DBConnection, jobs: list) -> list:
+    ingested = {}
+    settings = settings_hash()
+    for name, path, zip_file, size, mtime, content_hash in conn.execute("SELECT name,path,zip_file,size,mtime,content_hash FROM Files WHERE content_hash is not null and settings_hash=%s", [settings]):
+        ingested[(name, path, zip_file)] = (size, mtime, content_hash)
+    changed = []
+    for path, member, size, mtime, _ in jobs:
+        recorded = ingested.get(file_names(path, member))
+        if recorded is None or recorded[0] != size:
+            changed.append((path, member, size, mtime, None))
+        elif recorded[1] != mtime:
+            changed.append((path, member, size, mtime, recorded[2]))
+    print("Skipping %d unchanged files" % (len(jobs) - len(changed)))
+    return changed
+
+def content_hash(path: str, member: str) -> str:
+    digest = hashlib.sha256()
+    with (open(path, "rb") if member is None else get_archive(path).open(member, "r")) as stream:
+        for block in iter(lambda: stream.read(READ_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Parse and persist files or zip members using this process's own connection and id pool, committing what is
+# still pending at the end. The first result carries the metrics recorded by this process meanwhile
+def ingest_batch(jobs: list) -> list:
+    conn = DBConnection.getConnection()
+    results = []
+    for job in jobs:
+        try:
+            results.append(ingest(job))
+        except Exception as error:
+            print("Error while ingesting: %s %s" % job[:2])
+            print(type(error))
+            print(error)
+            traceback.print_exc()
+            group.lost(conn)
+    group.commit(conn)
+    if results:
+        results[0]["metrics"] = metrics.pop()
+    return results
+
+def ingest(job) -> dict:
+    path, member = job[:2]
+    with profiled(os.path.basename(member or path), profile_modes, profile_dir):
+        return _ingest(job)
+
+def _ingest(job) -> dict:
+    path, member, _, _, expected_hash = job
+    state = new_state(job)
+    conn = DBConnection.getConnection()
+    if expected_hash is not None and content_hash(path, member) == expected_hash:
+        return mark_unchanged(conn, state)
+    state["tape"] = make_tape(job)
+    start_tape(conn, state)
+    persist_tape(conn, state)
+    return finish_tape(conn, state)
+
+def new_state(job) -> dict:
+    return {"job": job, "t_begin": time.perf_counter(), "materials": 0, "uncommitted": 0, "failed": False,
+            "key_hits": key_cache.hits, "key_misses": key_cache.misses}
+
+def make_tape(job) -> ENDFTape:
+    path, member = job[:2]
+    name, rel_path, zip_file = file_names(path, member)
+    if member is None:
+        print("Parsing file: %s at %s" % (name,rel_path))
+        return ENDFTape(path, sections=sections, cache_dir=parse_cache_dir)
+    print("Parsing file: %s in zip %s at %s" % (member,path,rel_path))
+    return ENDFTape(member,get_archive(path),sections,parse_cache_dir)
+
+# Find or create the Files row of the job
+def start_tape(conn: DBConnection, state: dict) -> None:
+    name, rel_path, zip_file = file_names(*state["job"][:2])
+    if zip_file is None:
+        res = conn.execute("SELECT id from Files where name = %s and path = %s and zip_file is null",[name,rel_path])
+    else:
+        res = conn.execute("SELECT id from Files where name = %s and path = %s and zip_file = %s",[name,rel_path,zip_file])
+    if res:
+        file_key = res[0][0]
+    else:
+        file_key = DBConnection.getNextId()
+        conn.execute("INSERT INTO Files (id,name,path,zip_file) VALUES(%s,%s,%s,%s)",[file_key,name,rel_path,zip_file])
+        group.add(state)
+    state["file_key"] = file_key
+    if state.get("tape") is not None:
+        state["tape"].setFileKey(file_key)
+
+def finish_tape(conn: DBConnection, state: dict) -> dict:
+    _, _, size, mtime, _ = state["job"]
+    tape = state.get("tape")
+    failed = state["failed"] or tape is None
+    if "file_key" not in state:
+        start_tape(conn, state)
+    conn.execute("UPDATE Files set size=%s, mtime=%s, content_hash=%s, settings_hash=%s where id=%s",
+                 [size, mtime, None if failed else tape.getContentHash(), settings_hash(), state["file_key"]])
+    group.add(state)
+    return {"worker": os.getpid(), "materials": state["materials"], "bytes": size, "seconds": time.perf_counter() - state["t_begin"],
+            "skipped": False,
+            "key_hits": key_cache.hits - state["key_hits"], "key_misses": key_cache.misses - state["key_misses"]}
+
+def mark_unchanged(conn: DBConnection, state: dict) -> dict:
+    path, member, _, mtime, _ = state["job"]
+    name, rel_path, zip_file = file_names(path, member)
+    print("Unchanged contents: %s %s" % (path, member or ''))
+    if zip_file is None:
+        conn.execute("UPDATE Files set mtime=%s where name = %s and path = %s and zip_file is null", [mtime, name, rel_path])
+    else:
+        conn.execute("UPDATE Files set mtime=%s where name = %s and path = %s and zip_file = %s", [mtime, name, rel_path, zip_file])
+    return {"worker": os.getpid(), "materials": 0, "bytes": 0, "seconds": time.perf_counter() - state["t_begin"],
+            "skipped": True, "key_hits": 0, "key_misses": 0}
+
+# Pipelined ingestion
+# Reader threads read (and for zip members decompress) the raw materials of each tape, a parser thread decodes
+# them, in tape_workers processes when there are more than 1, and the calling thread persists them. The stages pass
+# (kind, state, payload) items through queues of pipeline_depth items, a stage running ahead waits for the next one,
+# so the run takes about as long as its slowest stage rather than the sum of all of them. Kinds are
+#   unchanged          the job's contents match its recorded hash
+#   tape, cached       a tape starts, its materials follow as chunks (from the reader) or decoded (from the parse cache)
+#   chunk, material    the raw bytes of a material, a decoded material
+#   end, error         the tape is done, or failed with the payload exception
+# Time spent waiting on the queues is recorded as the pipeline.<stage>.waiting and .blocked metrics.
+# With read_workers readers, reader i reads jobs i, i+read_workers... into its own queue and the parser takes
+# the jobs back in order from them (see JobOrder). zlib releases the GIL, so zip members decompress in parallel
+def ingest_pipelined(jobs: list) -> list:
+    read_queues = [queue.Queue(pipeline_depth) for _ in range(max(1, min(read_workers, len(jobs))))]
+    parsed_queue = queue.Queue(pipeline_depth)
+    readers = [threading.Thread(target=read_stage, args=(jobs[i::len(read_queues)], read_queue), name="reader-%d" % (i), daemon=True)
+               for i, read_queue in enumerate(read_queues)]
+    parser = threading.Thread(target=parse_stage, args=(JobOrder(read_queues), parsed_queue), name="parser", daemon=True)
+    for reader in readers:
+        reader.start()
+    parser.start()
+    results = write_stage(parsed_queue)
+    for reader in readers:
+        reader.join()
+    parser.join()
+    return results
+
+# The items of the readers' queues in job order: job k is read from queue k % len(queues), up to its last item.
+# The first end of queue means there are no jobs left, as the readers were dealt the jobs in turn
+class JobOrder():
+    def __init__(self, queues: list):
+        self.queues = queues
+        self.job = 0
+
+    def get(self):
+        item = self.queues[self.job % len(self.queues)].get()
+        if item is not None and item[0] in ("unchanged", "end", "error"):
+            self.job += 1
+        return item
+
+def _put(stage: str, target: queue.Queue, item) -> None:
+    with metrics.timer("pipeline.%s.blocked" % (stage)):
+        target.put(item)
+
+def _get(stage: str, source):
+    with metrics.timer("pipeline.%s.waiting" % (stage)):
+        return source.get()
+
+def read_stage(jobs: list, target: queue.Queue) -> None:
+    try:
+        for job in jobs:
+            path, member, _, _, expected_hash = job
+            state = new_state(job)
             try:
-                tape.parseTape()
-            except(Exception) as error:
-                conn.execute("UPDATE Files set comment=%s where id=%s", ["Parse: "+str(error), file_key])
-                conn.commit()
+                if expected_hash is not None and content_hash(path, member) == expected_hash:
+                    _put("read", target, ("unchanged", state, None))
+                    continue
+                tape = state["tape"] = make_tape(job)
+                cached = tape.loadCached()
+                if cached is not None:
+                    _put("read", target, ("cached", state, None))
+                    for material in cached:
+                        _put("read", target, ("material", state, material))
+                else:
+                    _put("read", target, ("tape", state, None))
+                    for chunk in tape._rawMaterials():
+                        _put("read", target, ("chunk", state, chunk))
+                _put("read", target, ("end", state, None))
+            except Exception as error:
+                _put("read", target, ("error", state, error))
+    finally:
+        target.put(None)
+
+# Raw materials of the current tape from the reader, up to its end item
+def _tape_chunks(source: JobOrder):
+    while True:
+        kind, _, payload = _get("parse", source)
+        if kind == "chunk":
+            yield payload
+        elif kind == "end":
+            return
+        else:
+            raise payload
+
+def parse_stage(source: JobOrder, target: queue.Queue) -> None:
+    try:
+        while True:
+            item = _get("parse", source)
+            if item is None:
+                break
+            _put("parse", target, item)
+            kind, state, _ = item
+            if kind != "tape":
                 continue
-            tape.setFileKey(file_key)
-            for mat in tape.getMaterials():
+            chunks = _tape_chunks(source)
+            try:
+                for material in state["tape"].decodeMaterials(tape_executor(), chunks=chunks):
+                    # decoded here unless a tape worker already did
+                    material.parse()
+                    _put("parse", target, ("material", state, material))
+                _put("parse", target, ("end", state, None))
+            except Exception as error:
+                # skip what the reader still has of this tape
                 try:
-                    mat.persist()
-                    conn.commit()
-#                except NaNException:
+                    for _ in chunks:
+                        pass
+                except Exception:
+                    pass
+                _put("parse", target, ("error", state, error))
+    finally:
+        target.put(None)
+
+def write_stage(source: queue.Queue) -> list:
+    conn = DBConnection.getConnection()
+    results = []
+    while True:
+        item = _get("write", source)
+        if item is None:
+            break
+        kind, state, payload = item
+        try:
+            if kind == "unchanged":
+                results.append(mark_unchanged(conn, state))
+                continue
+            if "file_key" not in state:
+                start_tape(conn, state)
+            if kind == "material":
+                persist_material(conn, state, payload)
+            elif kind == "error":
+                record_failure(conn, state, "Parse", payload)
+            if kind in ("end", "error"):
+                results.append(finish_tape(conn, state))
+        except Exception as error:
+            print("Error while ingesting: %s %s" % state["job"][:2])
+            print(type(error))
+            print(error)
+            traceback.print_exc()
+            group.lost(conn)
+    group.commit(conn)
+    return results
+
+def report(results: list, elapsed: float, summary: dict) -> None:
+    skipped = sum(1 for result in results if result["skipped"])
+    if skipped:
+        print("Skipped %d files with unchanged contents" % (skipped))
+    results = [result for result in results if not result["skipped"]]
+    per_worker = {}
+    for result in results:
+        totals = per_worker.setdefault(result["worker"], {"files": 0, "materials": 0, "bytes": 0, "seconds": 0})
+        totals["files"] += 1
+        for stat in ("materials", "bytes", "seconds"):
+            totals[stat] += result[stat]
+
+    for worker, totals in sorted(per_worker.items()):
+        busy = max(totals["seconds"], 1e-9)
+        print("Worker %s: %d files, %d materials, %.1f MB in %.1f s (%.2f MB/s, %.2f materials/s)" %
+              (worker, totals["files"], totals["materials"], totals["bytes"]/1e6, totals["seconds"],
+               totals["bytes"]/1e6/busy, totals["materials"]/busy))
+    for stage, stats in summary["stages"].items():
+        if stage.startswith("insert."):
+            print("Inserted %d rows into %s in %.1f s (%.0f rows/s, %.2f MB/s)" %
+                  (stats["rows"], stage[len("insert."):], stats["seconds"], stats["rows_per_s"], stats["bytes_per_s"]/1e6))
+    for stage in ("read", "decode", "ids", "commit"):
+        stats = summary["stages"].get(stage)
+        if stats is not None:
+            print("Stage %s: %d calls, %.1f s (p50 %.4f s, p99 %.4f s, %.0f rows/s)" %
+                  (stage, stats["count"], stats["seconds"], stats["p50_s"], stats["p99_s"], stats["rows_per_s"]))
+    linearized = summary["stages"].get("linearize")
+    if linearized is not None:
+        points = summary["stages"]["linearize.input"]["rows"]
+        print("Linearized %d tables from %d to %d points (x%.2f) in %.1f s" %
+              (linearized["count"], points, linearized["rows"], linearized["rows"]/max(points, 1), linearized["seconds"]))
+    key_hits = sum(result["key_hits"] for result in results)
+    key_misses = sum(result["key_misses"] for result in results)
+    if key_hits or key_misses:
+        print("Key cache: %d hits, %d misses (%.1f%% hit rate)" % (key_hits, key_misses, 100.0*key_hits/(key_hits+key_misses)))
+
+    files = len(results)
+    materials = sum(result["materials"] for result in results)
+    size = sum(result["bytes"] for result in results)
+    elapsed = max(elapsed, 1e-9)
+    print("Ingested %d files, %d materials, %.1f MB in %.1f s with %d workers on %s (%.2f MB/s, %.2f materials/s)" %
+          (files, materials, size/1e6, elapsed, len(per_worker), DB.backend, size/1e6/elapsed, materials/elapsed))
+
+def write_summary(results: list, elapsed: float, summary: dict) -> None:
+    summary = dict(summary, elapsed=elapsed, backend=DB.backend, workers=workers,
+                   files=sum(1 for result in results if not result["skipped"]),
+                   skipped=sum(1 for result in results if result["skipped"]),
+                   materials=sum(result["materials"] for result in results),
+                   bytes=sum(result["bytes"] for result in results))
+    if metrics_file is None:
+        print(json.dumps(summary, indent=2))
+    else:
+        with open(metrics_file, "w") as file:
+            json.dump(summary, file, indent=2)
+        print("Metrics written to %s" % (metrics_file))
+
+def main() -> None:
+    jobs = find_jobs(endf_library)
+    conn = DBConnection.getConnection()
+    conn.warmKeyCache()
+    if incremental:
+        jobs = skip_unchanged(conn, jobs)
+    if workers > 1 and not pipeline:
+        conn.close()
+    results = []
+    t_begin = time.perf_counter()
+    if pipeline:
+        if workers > 1:
+            print("INFO: pipeline ingests in this process, workers is ignored, use tape_workers to decode in parallel")
+        try:
+            with profiled("pipeline", profile_modes, profile_dir):
+                results = ingest_pipelined(jobs)
+        finally:
+            conn.close()
+            if _tape_executor is not None:
+                _tape_executor.shutdown()
+    elif workers > 1:
+        # each batch ends with a commit, batches stay small enough to keep the workers evenly loaded
+        size = max(1, min(commit_materials, len(jobs) // (4*workers)))
+        batches = [jobs[i:i+size] for i in range(0, len(jobs), size)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=warm_key_cache) as executor:
+            futures = {executor.submit(ingest_batch, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                try:
+                    results.extend(future.result())
                 except Exception as error:
-                    conn.rollback()
-                    conn.execute("UPDATE Files set comment=%s where id=%s", ["Persist: "+str(error), file_key])
-                    conn.commit()
-
-except Exception as error:
-    print(type(error))
-    print(error)
-    traceback.print_exc()
-    if conn:
-        conn.rollback()
-finally:
-    conn.close()
\ No newline at end of file
+                    print("Error while ingesting batch: %s %s" % futures[future][0][:2])
+                    print(type(error))
+                    print(error)
+    else:
+        try:
+            results = ingest_batch(jobs)
+        finally:
+            conn.close()
+            if _tape_executor is not None:
+                _tape_executor.shutdown()
+    elapsed = time.perf_counter() - t_begin
+    # totals of the run: what the workers reported plus anything recorded here outside of ingest
+    totals = Metrics()
+    totals.merge(metrics.pop())
+    for result in results:
+        if "metrics" in result:
+            totals.merge(result["metrics"])
+    summary = totals.summary()
+    report(results, elapsed, summary)
+    write_summary(results, elapsed, summary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import CrossSection
+import DB
+from DB import DBConnection
+from ENDFGenerator import write_tape
+from ENDFParser import ENDFTape, ENDFMaterial, InvalidDataException, read_block, index_sections
+
+# Time each stage of ingesting a tape separately and report the results as JSON:
+#   read      split the raw tape into material chunks and validate TPID/TEND
+#   split     view each chunk as records, index its sections and build the material
+#   decode    parse every section
+#   validate  data checks of every MF3 table (see validateTAB1)
+#   ids       allocate one id per CrossSectionData row
+#   insert    bulk insert the CrossSectionData rows and commit
+# and then, apart from the ingestion total,
+#   evaluate  look up --lookups random energies spread over the MF3 tables with CrossSection.evaluate
+# Stages run on a generated tape unless --tape is given. Inserts go to a scratch SQLite database
+# unless --backend mysql is given, in which case they are rolled back rather than committed
+STAGES = ["read", "split", "decode", "validate", "ids", "insert"]
+LOOKUP_STAGES = ["evaluate"]
+
+def run_stages(path: str, lookups: int = 0, seed: int = 0) -> tuple:
+    seconds = {}
+
+    t_begin = time.perf_counter()
+    tape = ENDFTape(path)
+    chunks = list(tape._rawMaterials())
+    seconds["read"] = time.perf_counter() - t_begin
+
+    t_begin = time.perf_counter()
+    materials = []
+    for chunk in chunks:
+        block = read_block(chunk)
+        materials.append(ENDFMaterial(block, index_sections(block)))
+    seconds["split"] = time.perf_counter() - t_begin
+
+    t_begin = time.perf_counter()
+    for material in materials:
+        material.parse()
+    seconds["decode"] = time.perf_counter() - t_begin
+
+    tables = [section for material in materials for file in material.getFiles() for section in file.getSections()
+              if section.getFile() == 3 and section.getParsed()]
+    for material in materials:
+        # tells the sections whether their material gives resonance parameters, see RESONANCE_WARNINGS
+        material.validate()
+    t_begin = time.perf_counter()
+    for section in tables:
+        # decoding already checked the table, check it again to time the checks on their own
+        section.invalid = None
+        failures = section.validate()
+        if failures:
+            raise InvalidDataException(failures)
+    seconds["validate"] = time.perf_counter() - t_begin
+
+    points = sum(len(section.X) for section in tables)
+    conn = DBConnection.getConnection()
+    t_begin = time.perf_counter()
+    ids = DBConnection.get_ids(points)
+    seconds["ids"] = time.perf_counter() - t_begin
+
+    t_begin = time.perf_counter()
+    offset = 0
+    for cs_key, section in enumerate(tables):
+        conn.bulk_insert("CrossSectionData", ["id","crosssectioninfo_key","MT","Energy","CrossSection"],
+                         [ids[offset:offset+len(section.X)], cs_key, section.getMT(), section.X, section.Y])
+        offset += len(section.X)
+    if DB.backend == "sqlite":
+        conn.commit()
+    else:
+        conn.rollback()
+    seconds["insert"] = time.perf_counter() - t_begin
+
+    # energies drawn uniformly in ln(E) over each table's range, outside the timing
+    rng = np.random.default_rng(seed)
+    per_table = -(-lookups // max(len(tables), 1))
+    energies = [np.exp(rng.uniform(np.log(max(section.X[0], 1e-5)), np.log(section.X[-1]), per_table)) for section in tables]
+    t_begin = time.perf_counter()
+    for section, E in zip(tables, energies):
+        CrossSection.evaluate(section.getTable(), E)
+    seconds["evaluate"] = time.perf_counter() - t_begin
+
+    counts = {"materials": len(materials), "sections": sum(len(file.getSections()) for material in materials for file in material.getFiles()),
+              "tables": len(tables), "points": points, "lookups": per_table*len(tables)}
+    return seconds, counts
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def benchmark(args) -> dict:
+    with tempfile.TemporaryDirectory() as scratch:
+        path = args.tape
+        if path is None:
+            path = os.path.join(scratch, "synthetic.dat")
+            t_begin = time.perf_counter()
+            write_tape(path, args.materials, args.reactions, args.points, args.regions, args.seed)
+            print("INFO: generated %s in %.1f s" % (path, time.perf_counter() - t_begin))
+        size = os.path.getsize(path)
+
+        runs = []
+        for run in range(args.repeat):
+            if args.backend == "sqlite":
+                DB.set_backend("sqlite", os.path.join(scratch, "run%d.sqlite" % (run)))
+            else:
+                DB.set_backend(args.backend)
+            seconds, counts = run_stages(path, args.lookups, args.seed)
+            DBConnection.getConnection().close()
+            runs.append(seconds)
+            print("INFO: run %d: %s" % (run, " ".join("%s %.3fs" % (stage, seconds[stage]) for stage in STAGES + LOOKUP_STAGES)))
+
+    stages = {}
+    for stage in STAGES:
+        times = [run[stage] for run in runs]
+        best = max(min(times), 1e-9)
+        stages[stage] = {"seconds": times, "min": min(times), "median": statistics.median(times),
+                         "MB_per_s": size/1e6/best, "points_per_s": counts["points"]/best}
+    for stage in LOOKUP_STAGES:
+        times = [run[stage] for run in runs]
+        stages[stage] = {"seconds": times, "min": min(times), "median": statistics.median(times),
+                         "lookups_per_s": counts["lookups"]/max(min(times), 1e-9)}
+    total = [sum(run[stage] for stage in STAGES) for run in runs]
+    return {"benchmark": "ENDF ingestion stages",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": {"tape": args.tape, "materials": args.materials, "reactions": args.reactions, "points": args.points,
+                           "regions": args.regions, "seed": args.seed, "repeat": args.repeat, "backend": args.backend,
+                           "lookups": args.lookups},
+            "tape": dict(counts, bytes=size),
+            "stages": stages,
+            "total": {"seconds": total, "min": min(total), "median": statistics.median(total)}}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the stages of ENDF ingestion on a synthetic or given tape")
+    parser.add_argument("--tape", help="existing tape to benchmark instead of a generated one")
+    parser.add_argument("--materials", type=int, default=4)
+    parser.add_argument("--reactions", type=int, default=10)
+    parser.add_argument("--points", type=int, default=20000)
+    parser.add_argument("--regions", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--backend", choices=sorted(DB.BACKENDS), default="sqlite")
+    parser.add_argument("--lookups", type=int, default=1000000, help="random energies evaluated in the evaluate stage")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout if not given")
+    args = parser.parse_args()
+
+    # progress goes to stderr so stdout only carries the JSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = json.dumps(benchmark(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(results + "\n")
+    else:
+        print(results)
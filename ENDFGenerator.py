@@ -0,0 +1,122 @@
+import argparse
+import math
+import numpy as np
+
+# Synthetic ENDF-6 tapes for benchmarking: each material has an MF1/MT451 header with its directory
+# and `reactions` MF3 sections of `points` TAB1 points split into `regions` interpolation regions.
+# Energies rise from 1e-5 eV to 20 MeV and cross sections are positive, so every interpolation law is valid
+
+# laws given to the regions of a TAB1 in turn
+REGION_LAWS = [2, 5, 3, 4, 1]
+# MF3 reactions used in turn for the sections of a material
+REACTIONS = [1, 2, 4, 16, 17, 18, 22, 28, 51, 52, 53, 102, 103, 104, 105, 106, 107]
+
+def format_float(value: float) -> str:
+    if value == 0:
+        return " 0.000000+0"
+    mantissa, exponent = ("%.6E" % value).split("E")
+    exponent = int(exponent)
+    if abs(exponent) < 10:
+        return ("%s%+d" % (mantissa, exponent)).rjust(11)
+    mantissa, exponent = ("%.5E" % value).split("E")
+    return ("%s%+d" % (mantissa, int(exponent))).rjust(11)
+
+def format_int(value: int) -> str:
+    return ("%d" % value).rjust(11)
+
+class TapeWriter:
+    def __init__(self, file):
+        self.file = file
+        self.NS = 0
+
+    def record(self, content: str, MAT: int, MF: int, MT: int) -> None:
+        self.NS = self.NS + 1 if MT != 0 else 0
+        self.file.write("%-66.66s%4d%2d%3d%5d\n" % (content, MAT, MF, MT, self.NS % 100000))
+
+    def cont(self, MAT: int, MF: int, MT: int, C1, C2, L1, L2, N1, N2) -> None:
+        self.record(format_float(C1) + format_float(C2) + format_int(L1) + format_int(L2) + format_int(N1) + format_int(N2), MAT, MF, MT)
+
+    def values(self, MAT: int, MF: int, MT: int, values: list, formatter) -> None:
+        for i in range(0, len(values), 6):
+            self.record("".join(formatter(value) for value in values[i:i+6]), MAT, MF, MT)
+
+    def send(self, MAT: int, MF: int) -> None:
+        self.file.write("%66s%4d%2d%3d%5d\n" % ("", MAT, MF, 0, 99999))
+        self.NS = 0
+
+    def fend(self, MAT: int) -> None:
+        self.record("", MAT, 0, 0)
+
+# (NBT, INT, X, Y) of a synthetic cross section
+def synthetic_table(rng: np.random.Generator, points: int, regions: int) -> tuple:
+    X = np.sort(np.exp(rng.uniform(np.log(1e-5), np.log(2e7), points)))
+    X[0], X[-1] = 1e-5, 2e7
+    resonances = rng.uniform(1, 1e5, 8)
+    Y = 10/np.sqrt(X) + 2 + sum(50/(1 + ((X - E0)/(0.01*E0))**2) for E0 in resonances)
+    Y *= rng.uniform(0.95, 1.05, points)
+    regions = max(1, min(regions, points - 1))
+    NBT = np.linspace(0, points, regions + 1).astype(int)[1:]
+    NBT[-1] = points
+    INT = np.array([REGION_LAWS[r % len(REGION_LAWS)] for r in range(regions)])
+    return NBT, INT, X, Y
+
+# Write a material of an MF1/MT451 header with its directory and one MF3 section per MT of the (NBT, INT, X, Y) tables.
+# LRP is the flag of the header telling whether resonance parameters are given in File 2, ELIS the excitation energy
+# of the target
+def write_material(tape: TapeWriter, MAT: int, ZA: float, AWR: float, MTs: list, tables: list, LRP: int = 0, ELIS: float = 0.0) -> None:
+    Z, A = int(ZA // 1000), int(ZA % 1000)
+    NWD = 5
+    NCs = [3 + math.ceil(len(NBT)/3) + math.ceil(len(X)/3) for NBT, _, X, _ in tables]
+
+    NXC = 1 + len(MTs)
+    tape.cont(MAT, 1, 451, ZA, AWR, LRP, 0, 0, 0)
+    tape.cont(MAT, 1, 451, ELIS, 0.0, 0, 0, 0, 6)
+    tape.cont(MAT, 1, 451, 1.0, 2e7, 0, 0, 10, 8)
+    tape.cont(MAT, 1, 451, 0.0, 0.0, 0, 0, NWD, NXC)
+    tape.record("%3d-SYN-%-3d SYNTHETIC" % (Z, A), MAT, 1, 451)
+    for line in range(1, NWD):
+        tape.record(" synthetic benchmark material %d, description line %d" % (MAT, line), MAT, 1, 451)
+    tape.record(" "*22 + format_int(1) + format_int(451) + format_int(4 + NWD + NXC) + format_int(0), MAT, 1, 451)
+    for MT, NC in zip(MTs, NCs):
+        tape.record(" "*22 + format_int(3) + format_int(MT) + format_int(NC) + format_int(0), MAT, 1, 451)
+    tape.send(MAT, 1)
+    tape.fend(MAT)
+
+    for MT, (NBT, INT, X, Y) in zip(MTs, tables):
+        tape.cont(MAT, 3, MT, ZA, AWR, 0, 0, 0, 0)
+        tape.cont(MAT, 3, MT, 0.0, 0.0 if MT < 4 else -1e6, 0, 0, len(NBT), len(X))
+        interp = np.empty(2*len(NBT), dtype=int)
+        interp[0::2], interp[1::2] = NBT, INT
+        tape.values(MAT, 3, MT, interp.tolist(), format_int)
+        XY = np.empty(2*len(X))
+        XY[0::2], XY[1::2] = X, Y
+        tape.values(MAT, 3, MT, XY.tolist(), format_float)
+        tape.send(MAT, 3)
+    tape.fend(MAT)
+    tape.record("", 0, 0, 0)
+
+# Write a tape with `materials` materials of `reactions` MF3 sections of `points` points each
+def write_tape(path: str, materials: int = 1, reactions: int = 3, points: int = 1000, regions: int = 1, seed: int = 0) -> None:
+    if reactions > 5*len(REACTIONS):
+        raise Exception("At most %d reactions per material" % (5*len(REACTIONS)))
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as file:
+        tape = TapeWriter(file)
+        tape.record("Synthetic ENDF-6 tape: %d materials, %d reactions, %d points" % (materials, reactions, points), 1, 0, 0)
+        for m in range(materials):
+            Z = 1 + m % 100
+            A = 2*Z + m // 100
+            MTs = [REACTIONS[r % len(REACTIONS)] + 200*(r // len(REACTIONS)) for r in range(reactions)]
+            write_material(tape, 100 + m, 1000.0*Z + A, A*0.99167, MTs, [synthetic_table(rng, points, regions) for _ in MTs])
+        tape.record("", -1, 0, 0)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic ENDF-6 tape")
+    parser.add_argument("path")
+    parser.add_argument("--materials", type=int, default=1)
+    parser.add_argument("--reactions", type=int, default=3)
+    parser.add_argument("--points", type=int, default=1000)
+    parser.add_argument("--regions", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_tape(args.path, args.materials, args.reactions, args.points, args.regions, args.seed)
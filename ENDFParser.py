@@ -1,11 +1,20 @@
 import math
 from enum import Enum
 import traceback
+import hashlib
 import io
+import json
+import mmap
+import os
+import shutil
+import tempfile
 import time
+from collections import deque
 import numpy as np
-import pandas as pd
-from DB import DBConnection
+from DB import DBConnection, library_lookup, material_lookup, pack_array
+import DB
+import CrossSection
+from Metrics import metrics
 
 BATCH_SIZE = 10000
 
@@ -31,6 +40,13 @@ class NotImplementedYetException(Exception):
 class NaNException(Exception):
     pass
 
+# Sections whose decoded data fails validation (see validateTAB1), failures holds a dict per failed check
+# with the MAT, MF, MT of the section, a reason from INVALID_REASONS and a readable detail
+class InvalidDataException(Exception):
+    def __init__(self, failures: list):
+        super().__init__("; ".join("MAT %(MAT)s MF %(MF)s MT %(MT)s %(reason)s: %(detail)s" % failure for failure in failures))
+        self.failures = failures
+
 class ENDFPersistable:
     def __init__(self):
         self.lib_key = None
@@ -83,46 +99,289 @@ def parse_row(row: str,type_parsers: list) -> list:
 
     return ret
 
+# Fixed-width block decoding
+# A block is an (nRows, 66) uint8 array holding the content columns of consecutive records,
+# each row being six 11 column fields. Whole blocks are decoded with numpy in one pass.
+CONTENT_WIDTH = 66
+FIELD_WIDTH = 11
+_SPACE, _PLUS, _MINUS, _DOT, _ZERO, _NINE = (ord(c) for c in " +-.09")
+_EXP_CHARS = np.array([ord(c) for c in "DdEe"], dtype=np.uint8)
+
+def as_char_block(data) -> np.ndarray:
+    if isinstance(data, np.ndarray) and data.dtype == np.uint8:
+        return data.reshape(-1, data.shape[-1])[:, :CONTENT_WIDTH]
+    if isinstance(data, str):
+        data = [data]
+    lines = np.ascontiguousarray(np.asarray(data, dtype="U%d" % (CONTENT_WIDTH)))
+    # content is read as ISO-8859-1 so every code point fits in a byte
+    block = lines.view(np.uint32).reshape(-1, CONTENT_WIDTH).astype(np.uint8)
+    block[block == 0] = _SPACE
+    return block
+
+def _fields(data, count: int) -> np.ndarray:
+    fields = np.array(as_char_block(data), order='C').reshape(-1, FIELD_WIDTH)
+    if count is not None:
+        fields = fields[:count]
+    return fields
+
+def decode_floats(data, count: int = None) -> np.ndarray:
+    fields = _fields(data, count)
+    nFields = len(fields)
+    fields[np.isin(fields, _EXP_CHARS)] = ord('E')
+    blank = fields == _SPACE
+
+    # squeeze embedded blanks (e.g. "1.234567 +5") to the end of the field
+    nonblank = ~blank
+    n_chars = nonblank.sum(axis=1)
+    first = nonblank.argmax(axis=1)
+    last = FIELD_WIDTH - 1 - nonblank[:, ::-1].argmax(axis=1)
+    gapped = np.nonzero((n_chars > 0) & (n_chars < last - first + 1))[0]
+    if gapped.size:
+        order = np.argsort(blank[gapped], axis=1, kind="stable")
+        fields[gapped] = np.take_along_axis(fields[gapped], order, axis=1)
+        blank[gapped] = fields[gapped] == _SPACE
+
+    # ENDF drops the 'E' of the exponent (1.234567+5): a sign following a digit or '.'
+    # starts the exponent, so shift it right by one column and put an 'E' in front of it
+    prev = fields[:, :-1]
+    after_mantissa = ((prev >= _ZERO) & (prev <= _NINE)) | (prev == _DOT)
+    exp_sign = ((fields[:, 1:] == _PLUS) | (fields[:, 1:] == _MINUS)) & after_mantissa
+    has_exp = exp_sign.any(axis=1)
+    pos = np.where(has_exp, exp_sign.argmax(axis=1) + 1, FIELD_WIDTH)
+
+    cols = np.arange(FIELD_WIDTH)
+    rows = np.arange(nFields)
+    out = np.full((nFields, FIELD_WIDTH+1), _SPACE, dtype=np.uint8)
+    out[rows[:, None], cols + (cols >= pos[:, None])] = fields
+    out[rows[has_exp], pos[has_exp]] = ord('E')
+    out[blank.all(axis=1), 0] = _ZERO
+
+    return out.view("S%d" % (FIELD_WIDTH+1)).ravel().astype(np.float64)
+
+def _to_ints(fields: np.ndarray) -> np.ndarray:
+    fields[(fields == _SPACE).all(axis=1), -1] = _ZERO
+    return fields.view("S%d" % (fields.shape[1])).ravel().astype(np.int64)
+
+def decode_ints(data, count: int = None) -> np.ndarray:
+    return _to_ints(_fields(data, count))
+
+# Record reading
+# Records are 80 columns: 66 of content followed by the MAT(4), MF(2), MT(3) and NS(5) control fields
+RECORD_WIDTH = 80
+READ_CHUNK_SIZE = 16*1024*1024
+SECTION_INDEX_DTYPE = np.dtype([('MAT','i4'),('MF','i4'),('MT','i4'),('start','i8'),('end','i8')])
+_MEND_CONTROL = b"   0 0  0"
+_CR, _LF = ord("\r"), ord("\n")
+
+# Return the records in raw as an (nRecords, 80) uint8 block.
+# Lines of exactly 80 columns are viewed in place, anything else is padded into a new block
+def read_block(raw: bytes) -> np.ndarray:
+    stride = raw.find(b"\n") + 1
+    if stride in (RECORD_WIDTH+1, RECORD_WIDTH+2) and len(raw) % stride == 0:
+        lines = np.frombuffer(raw, dtype=np.uint8).reshape(-1, stride)
+        block = lines[:, :RECORD_WIDTH]
+        if ((lines[:, -1] == _LF).all() and (stride == RECORD_WIDTH+1 or (lines[:, -2] == _CR).all())
+                and not (block[:, CONTENT_WIDTH:] == _SPACE).all(axis=1).any()):
+            return block
+
+    lines = np.array(raw.splitlines(), dtype="S%d" % (RECORD_WIDTH))
+    block = lines.view(np.uint8).reshape(-1, RECORD_WIDTH).copy()
+    block[block == 0] = _SPACE
+    return block[(block != _SPACE).any(axis=1)]
+
+def _decode_column(block: np.ndarray, start: int, stop: int) -> np.ndarray:
+    return _to_ints(np.array(block[:, start:stop], order='C'))
+
+def read_controls(block: np.ndarray):
+    return _decode_column(block, 66, 70), _decode_column(block, 70, 72), _decode_column(block, 72, 75)
+
+def getLine(block: np.ndarray, row: int) -> str:
+    return block[row, :CONTENT_WIDTH].tobytes().decode('ISO-8859-1')
+
+def getLines(block: np.ndarray) -> list:
+    text = np.array(block[:, :CONTENT_WIDTH], order='C').tobytes().decode('ISO-8859-1')
+    return [text[i:i+CONTENT_WIDTH] for i in range(0, len(text), CONTENT_WIDTH)]
+
+# Build the (MAT, MF, MT) -> [start, end) row index of every section in block with one pass over the control columns.
+# block holds whole materials, each ending with its MEND record. Section rows exclude the SEND record.
+def index_sections(block: np.ndarray) -> np.ndarray:
+    MAT, MF, MT = read_controls(block)
+    nRows = len(MT)
+
+    # every record must carry the MAT, MF and MT of the record before it unless that one closed a section, file or material
+    prev_data = MT[:-1] != 0
+    row = np.flatnonzero(prev_data & (MAT[1:] != MAT[:-1]) & (MAT[1:] != 0))
+    if row.size:
+        print("MAT should be %s but found other values at record %s: %s" % (MAT[row[0]], row[0]+1, MAT[row[0]+1]))
+        raise Exception("Bad MAT values")
+    row = np.flatnonzero((prev_data | (MF[:-1] != 0)) & (MF[1:] != MF[:-1]) & (MF[1:] != 0))
+    if row.size:
+        print("MF should be %s but found other values at record %s: %s" % (MF[row[0]], row[0]+1, MF[row[0]+1]))
+        raise Exception("Bad MF values")
+    row = np.flatnonzero(prev_data & (MT[1:] != MT[:-1]) & (MT[1:] != 0))
+    if row.size:
+        print("MT should be %s but found other values at record %s: %s" % (MT[row[0]], row[0]+1, MT[row[0]+1]))
+        raise Exception("Bad MT values")
+    row = np.flatnonzero((MT[:-1] == 0) & (MAT[:-1] != 0) & (MAT[1:] != 0) & (MAT[1:] != MAT[:-1]))
+    if row.size:
+        print("MAT should be %s but found other values at record %s: %s" % (MAT[row[0]], row[0]+1, MAT[row[0]+1]))
+        raise Exception("Bad MAT values")
+
+    # runs of data records lie between consecutive SEND, FEND and MEND records
+    ends = np.flatnonzero(MT == 0)
+    if ends.size == 0 or ends[-1] != nRows-1:
+        raise Exception("Data after last MEND")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    in_use = ends > starts
+    bad = in_use & (MF[ends] == 0)
+    if bad.any():
+        raise Exception("Data after last FEND" if MAT[ends[bad][0]] == 0 else "Data after last SEND")
+
+    index = np.empty(np.count_nonzero(in_use), dtype=SECTION_INDEX_DTYPE)
+    index['start'] = starts[in_use]
+    index['end'] = ends[in_use]
+    index['MAT'] = MAT[index['start']]
+    index['MF'] = MF[index['start']]
+    index['MT'] = MT[index['start']]
+    return index
+
+# Parse an MF/MT include filter such as "1:451 3:1,2,18,102 4" into {MF: {MT, ...}}, a bare MF includes all of its MTs (None)
+def parseSectionFilter(text: str) -> dict:
+    sections = {}
+    for entry in text.replace(';', ' ').split():
+        MF, _, MTs = entry.partition(':')
+        MF = int(MF)
+        if not MTs:
+            sections[MF] = None
+        elif MF not in sections or sections[MF] is not None:
+            sections.setdefault(MF, set()).update(int(MT) for MT in MTs.split(','))
+    return sections
+
+# The filter with MF1/MT451, which persisting a material always needs for its library and material keys
+def withHeaderSection(sections: dict) -> dict:
+    sections = dict(sections)
+    if sections.get(1) is not None:
+        sections[1] = set(sections[1]) | {451}
+    elif 1 not in sections:
+        sections[1] = {451}
+    return sections
+
+# The filter as text parseSectionFilter reads, the same for every text giving the same filter
+def formatSectionFilter(sections: dict) -> str:
+    return " ".join(str(MF) if MTs is None else "%d:%s" % (MF, ",".join(str(MT) for MT in sorted(MTs)))
+                    for MF, MTs in sorted(sections.items()))
+
+# boolean mask of the index entries included by an MF/MT filter
+def selectSections(index: np.ndarray, sections: dict) -> np.ndarray:
+    mask = np.zeros(len(index), dtype=bool)
+    for MF, MTs in sections.items():
+        in_file = index['MF'] == MF
+        if MTs is not None:
+            in_file &= np.isin(index['MT'], list(MTs))
+        mask |= in_file
+    return mask
+
+# return the offset just past the first MEND record found in buf[start:stop], -1 if there is none
+def _find_mend(buf, start: int, stop: int) -> int:
+    pos = buf.find(_MEND_CONTROL, start, stop)
+    while pos != -1:
+        line_start = buf.rfind(b"\n", 0, pos) + 1
+        if pos - line_start == CONTENT_WIDTH:
+            line_end = buf.find(b"\n", pos, stop)
+            return stop if line_end == -1 else line_end + 1
+        pos = buf.find(_MEND_CONTROL, pos + 1, stop)
+    return -1
+
 def parseCONT(row):
     return parse_row(row, [parseFloat,parseFloat,int,int,int,int])
 
+# Decode several consecutive CONT records at once
+# returns C1,C2 as an (n,2) float array and L1,L2,N1,N2 as an (n,4) int array
+def parseCONTs(data):
+    block = as_char_block(data)
+    C = decode_floats(block[:, :2*FIELD_WIDTH]).reshape(-1, 2)
+    L = decode_ints(block[:, 2*FIELD_WIDTH:]).reshape(-1, 4)
+    return C, L
+
 def parseList(data,NC):
-    C = []
-    for row in data.to_list():
-        C.extend(parse_row(row, [parseFloat,parseFloat,parseFloat,parseFloat,parseFloat,parseFloat]))
-    return C[:NC]
+    return decode_floats(data, NC)
 
 def parseTAB1(NR,NP,interp_data,xy_data):
-    NBTINT = []
-    XY = []
-    for row in interp_data.to_list():
-        NBTINT.extend(parse_row(row,[int,int,int,int,int,int]))
-    for row in xy_data.to_list():
-        XY.extend(parse_row(row,[parseFloat,parseFloat,parseFloat,parseFloat,parseFloat,parseFloat]))
-
-    NBT = NBTINT[0::2]
-    INT = NBTINT[1::2]
-    X = XY[0::2]
-    Y = XY[1::2]
-
-    return NBT[:NR], INT[:NR], X[:NP], Y[:NP]
+    NBTINT = decode_ints(interp_data, 2*NR)
+    XY = decode_floats(xy_data, 2*NP)
+
+    NBT = np.ascontiguousarray(NBTINT[0::2])
+    INT = np.ascontiguousarray(NBTINT[1::2])
+    X = np.ascontiguousarray(XY[0::2])
+    Y = np.ascontiguousarray(XY[1::2])
+
+    return NBT, INT, X, Y
+
+# Checks of a TAB1 in the order they are made
+INVALID_REASONS = ("np_mismatch", "nr_mismatch", "nbt_range", "int_code", "nan", "inf", "energy_order", "negative_xs")
+# interpolation laws a TAB1 may use: 1-5 and 6 for charged-particle cross sections
+VALID_INT = (1, 2, 3, 4, 5, 6)
+
+# Vectorized checks of a decoded TAB1, returning a (reason, detail) pair for each failed one:
+# NP points and NR regions, whose NBT breakpoints rise strictly up to NP with valid INT codes,
+# finite values, an energy grid that never decreases (equal energies mark a discontinuity) and no negative values
+# checks only warned about in materials with resolved resonance parameters (LRP=1), whose MF3 may hold negative
+# background cross sections that are added to the contribution computed from the resonance parameters of MF2
+RESONANCE_WARNINGS = ("negative_xs",)
+
+def validateTAB1(NR: int, NP: int, NBT: np.ndarray, INT: np.ndarray, X: np.ndarray, Y: np.ndarray) -> list:
+    invalid = []
+    if len(X) != NP or len(Y) != NP:
+        invalid.append(("np_mismatch", "NP %d but %d energies and %d values" % (NP, len(X), len(Y))))
+    if len(NBT) != NR or len(INT) != NR:
+        invalid.append(("nr_mismatch", "NR %d but %d breakpoints and %d laws" % (NR, len(NBT), len(INT))))
+    elif NR == 0 or NBT[0] < 1 or NBT[-1] != NP or np.any(np.diff(NBT) <= 0):
+        invalid.append(("nbt_range", "breakpoints %s do not rise strictly to NP %d" % (NBT.tolist()[:10], NP)))
+    bad_int = ~np.isin(INT, VALID_INT)
+    if bad_int.any():
+        invalid.append(("int_code", "interpolation laws %s" % (sorted(set(INT[bad_int].tolist())))))
+    nan = np.isnan(X) | np.isnan(Y)
+    if nan.any():
+        invalid.append(("nan", "%d points, first at %d" % (np.count_nonzero(nan), np.argmax(nan))))
+    inf = np.isinf(X) | np.isinf(Y)
+    if inf.any():
+        invalid.append(("inf", "%d points, first at %d" % (np.count_nonzero(inf), np.argmax(inf))))
+    decreasing = np.diff(X) < 0
+    if decreasing.any():
+        invalid.append(("energy_order", "%d decreasing steps, first after point %d" % (np.count_nonzero(decreasing), np.argmax(decreasing))))
+    negative = Y < 0
+    if negative.any():
+        invalid.append(("negative_xs", "%d points, smallest %g" % (np.count_nonzero(negative), Y.min())))
+    return invalid
 
 class ENDFSection(ENDFPersistable):
-    def __init__(self, data):
-        self.timings = {"total": 0, "lib": 0, "mat": 0, "gi": 0, "dir": 0, "csinfo": 0, "interp": 0, "csdata": 0}
-        self.material = int(data.iat[0,1])
-        self.file     = int(data.iat[0,2])
-        self.MT       = int(data.iat[0,3])
+    def __init__(self, data, MAT, MF, MT):
+        self.material = int(MAT)
+        self.file     = int(MF)
+        self.MT       = int(MT)
 
         self.mat_key = None
         self.lib_key = None
         self.file_key = None
 
-        bad_MT = data[data['MT']!=self.MT]
-        if len(bad_MT.index>0):
-            print("MT should be %s but found other values: %s" % (self.MT, bad_MT))
-            raise Exception("Bad MT values")
-        
+        # records are decoded by parse, which is called before any decoded field is read; parsed is None until then
+        self.data = data
+        self.parsed = None
+        # failed data checks of an MF3 table, made once after decoding (see checks)
+        self.invalid = None
+        # set by the material, True when it gives resolved resonance parameters (LRP=1)
+        self.resonances = False
+
+    # persist only supports these sections, others are not decoded for it
+    @staticmethod
+    def isPersistable(MF, MT):
+        return (MF == 1 and MT == 451) or MF == 3
+
+    def parse(self):
+        if self.parsed is not None:
+            return self.parsed
+        t_begin = time.perf_counter()
+        data = self.data
         self.parsed = True
         idx = Incrementor(0)
         
@@ -130,56 +389,55 @@ class ENDFSection(ENDFPersistable):
             if self.file == 1: # General Information
                 # Descriptive Data and Directory
                 if self.MT == 451: 
-                    self.ZA, self.AWR, self.LRP, self.LFI, self.NLIB, self.NMOD = parseCONT(data.iat[idx.inc(),0])
-                    self.ELIS, self.STA, self.LIS, self.LISO, _, self.NFOR = parseCONT(data.iat[idx.inc(),0])
-                    self.AWI, self.EMAX, self.LREL, _, self.NSUB, self.NVER = parseCONT(data.iat[idx.inc(),0])
-                    self.TEMP, _, self.LDRV, _, self.NWD, self.NXC = parseCONT(data.iat[idx.inc(),0])
+                    self.ZA, self.AWR, self.LRP, self.LFI, self.NLIB, self.NMOD = parseCONT(getLine(data, idx.inc()))
+                    self.ELIS, self.STA, self.LIS, self.LISO, _, self.NFOR = parseCONT(getLine(data, idx.inc()))
+                    self.AWI, self.EMAX, self.LREL, _, self.NSUB, self.NVER = parseCONT(getLine(data, idx.inc()))
+                    self.TEMP, _, self.LDRV, _, self.NWD, self.NXC = parseCONT(getLine(data, idx.inc()))
 
                     self.desc = ""
                     self.section_data = []
 
-                    self.desc = '\n'.join(data.iloc[idx.inc(self.NWD):idx.value,0])
+                    self.desc = '\n'.join(getLines(data[idx.inc(self.NWD):idx.value]))
                     #for i in range(0,self.NWD):
                     #    self.desc = self.desc + '\n' + data.iat[idx+i,0]
                     #idx += self.NWD
 
 
-                    for _ in range(0,self.NXC):
-                        _, _, MF, MT, NC, MOD = parseCONT(data.iat[idx.inc(),0])
-                        self.section_data.append([MF,MT,NC,MOD])
-                    #idx += self.NXC
+                    if self.NXC > 0:
+                        _, directory = parseCONTs(data[idx.inc(self.NXC):idx.value])
+                        self.section_data = directory.tolist()
 
                 # 452: Number of Neutrons per Fission
                 # 456: Number of Prompt Neutrons per Fission
                 elif self.MT == 452 or self.MT == 456:
-                    self.ZA, self.AWR, _, self.LNU, _, _ = parseCONT(data.iat[idx.inc(),0])
+                    self.ZA, self.AWR, _, self.LNU, _, _ = parseCONT(getLine(data, idx.inc()))
                     if self.LNU == 1:
-                        _, _, _, _, self.NC, _ = parseCONT(data.iat[1,0])
-                        self.C = parseList(data.iloc[idx.inc(math.ceil(self.NC/6)):idx.value, 0],self.NC)
+                        _, _, _, _, self.NC, _ = parseCONT(getLine(data, 1))
+                        self.C = parseList(data[idx.inc(math.ceil(self.NC/6)):idx.value],self.NC)
                     elif self.LNU == 2:
-                        _, _, _, _, self.NR, self.NP = parseCONT(data.iat[idx.inc(),0])
+                        _, _, _, _, self.NR, self.NP = parseCONT(getLine(data, idx.inc()))
                         interp_lines = math.ceil(self.NR/3)
-                        interp_data = data.iloc[idx.inc(interp_lines):idx.value, 0]
+                        interp_data = data[idx.inc(interp_lines):idx.value]
                         xy_lines = math.ceil(self.NP/3)
-                        xy_data = data.iloc[idx.inc(xy_lines):idx.value, 0]
+                        xy_data = data[idx.inc(xy_lines):idx.value]
                         self.NBT, self.INT, self.X, self.Y = parseTAB1(self.NR,self.NP, interp_data, xy_data)
                     else:
                         raise Exception("Invalid LNU option for MF=%s MT=%s, LNU: %s" % (self.file,self.MT,self.LNU))
                     
                 # Delayed Neutron Data
                 elif self.MT == 455:
-                    self.ZA, self.AWR, self.LDG, self.LNU, _, _ = parseCONT(data.iat[idx.inc(),0])
+                    self.ZA, self.AWR, self.LDG, self.LNU, _, _ = parseCONT(getLine(data, idx.inc()))
                     if self.LDG == 0:
-                        _, _, _, _, self.NNF, _ = parseCONT(data.iat[idx.inc(),0])
-                        self.decay_constant = parseList(data.iloc[idx.inc(math.ceil(self.NNF/6)):idx.value, 0],self.NNF)
-                        _, _, _, _, self.NR, self.NP = parseCONT(data.iat[idx.inc(),0])
+                        _, _, _, _, self.NNF, _ = parseCONT(getLine(data, idx.inc()))
+                        self.decay_constant = parseList(data[idx.inc(math.ceil(self.NNF/6)):idx.value],self.NNF)
+                        _, _, _, _, self.NR, self.NP = parseCONT(getLine(data, idx.inc()))
                         if self.LNU == 1:
-                            self.Vd = parseList(data.iloc[idx.inc():idx.value, 0],1)
+                            self.Vd = parseList(data[idx.inc():idx.value],1)
                         elif self.LNU == 2:
                             interp_lines = math.ceil(self.NR/3)
-                            interp_data = data.iloc[idx.inc(interp_lines):idx.value, 0]
+                            interp_data = data[idx.inc(interp_lines):idx.value]
                             xy_lines = math.ceil(self.NP/3)
-                            xy_data = data.iloc[idx.inc(xy_lines):idx.value, 0]
+                            xy_data = data[idx.inc(xy_lines):idx.value]
                             self.NBT, self.INT, self.X, self.Y = parseTAB1(self.NR,self.NP,interp_data,xy_data)
                         else:
                             raise Exception("Invalid LNU value: LNU=%s" % (self.LNU))
@@ -191,41 +449,41 @@ class ENDFSection(ENDFPersistable):
 
                 #  Components of Energy Release Due to Fission
                 elif self.MT == 458:
-                    self.ZA, self.AWR, _, self.LFC, _, self.NFC = parseCONT(data.iat[idx.inc(),0])
-                    _, _, _, self.NPLY, self.N1, self.N2 = parseCONT(data.iat[idx.inc(),0])
-                    self.C = parseList(data.iloc[idx.inc(math.ceil(self.N1/6)):idx.value, 0],self.N1)
+                    self.ZA, self.AWR, _, self.LFC, _, self.NFC = parseCONT(getLine(data, idx.inc()))
+                    _, _, _, self.NPLY, self.N1, self.N2 = parseCONT(getLine(data, idx.inc()))
+                    self.C = parseList(data[idx.inc(math.ceil(self.N1/6)):idx.value],self.N1)
 
                     if self.LFC == 1:
                         self.EIFC = []
                         for _ in range (0,self.NFC):
-                            _, _, LDRV, IFC, NR, NP = parseCONT(data.iat[idx.inc(),0])
+                            _, _, LDRV, IFC, NR, NP = parseCONT(getLine(data, idx.inc()))
 
                             interp_lines = math.ceil(NR/3)
-                            interp_data = data.iloc[idx.inc(interp_lines):idx.value, 0]
+                            interp_data = data[idx.inc(interp_lines):idx.value]
                             xy_lines = math.ceil(NP/3)
-                            xy_data = data.iloc[idx.inc(xy_lines):idx.value, 0]
+                            xy_data = data[idx.inc(xy_lines):idx.value]
 
                             NBT, INT, X, Y = parseTAB1(NR,NP,interp_data,xy_data)
                             self.EIFC.append([LDRV, IFC, NR, NP, NBT, INT, X, Y])
 
                 #  Delayed Photon Data
                 elif self.MT == 460:
-                    self.ZA, self.AWR, self.LO, _,  self.NG, _ = parseCONT(data.iat[idx.inc(),0])
+                    self.ZA, self.AWR, self.LO, _,  self.NG, _ = parseCONT(getLine(data, idx.inc()))
                     if self.LO == 1:
                         self.T = []
                         for _ in range (0,self.NG):
-                            E, _, iNG, _, NR, NP = parseCONT(data.iat[idx.inc(),0])
+                            E, _, iNG, _, NR, NP = parseCONT(getLine(data, idx.inc()))
 
                             interp_lines = math.ceil(NR/3)
-                            interp_data = data.iloc[idx.inc(interp_lines):idx.value, 0]
+                            interp_data = data[idx.inc(interp_lines):idx.value]
                             xy_lines = math.ceil(NP/3)
-                            xy_data = data.iloc[idx.inc(xy_lines):idx.value, 0]
+                            xy_data = data[idx.inc(xy_lines):idx.value]
 
                             NBT, INT, X, Y = parseTAB1(NR,NP,interp_data,xy_data)
                             self.T.append([E, iNG, NR, NP, NBT, INT, X, Y])
                     elif self.LO == 2:
-                        _, _, _, _, _, self.NNF = parseCONT(data.iat[idx.inc(),0])
-                        self.C = parseList(data.iloc[idx.inc(math.ceil(self.NNF/6)):idx.value, 0],self.NNF)
+                        _, _, _, _, _, self.NNF = parseCONT(getLine(data, idx.inc()))
+                        self.C = parseList(data[idx.inc(math.ceil(self.NNF/6)):idx.value],self.NNF)
 
                     else:
                         raise Exception("Invalid LO value: LO=%s" % (self.LO))
@@ -234,14 +492,15 @@ class ENDFSection(ENDFPersistable):
             
             # Reaction Cross Sections
             elif self.file == 3:
-                self.ZA, self.AWR, _, _, _, _ = parseCONT(data.iat[idx.inc(),0])
-                self.QM, self.QI, _, self.LR, self.NR, self.NP = parseCONT(data.iat[idx.inc(),0])
+                self.ZA, self.AWR, _, _, _, _ = parseCONT(getLine(data, idx.inc()))
+                self.QM, self.QI, _, self.LR, self.NR, self.NP = parseCONT(getLine(data, idx.inc()))
 
                 interp_lines = math.ceil(self.NR/3)
-                interp_data = data.iloc[idx.inc(interp_lines):idx.value, 0]
+                interp_data = data[idx.inc(interp_lines):idx.value]
                 xy_lines = math.ceil(self.NP/3)
-                xy_data = data.iloc[idx.inc(xy_lines):idx.value, 0]
+                xy_data = data[idx.inc(xy_lines):idx.value]
                 self.NBT, self.INT, self.X, self.Y = parseTAB1(self.NR,self.NP,interp_data,xy_data)
+                self.invalid = validateTAB1(self.NR, self.NP, self.NBT, self.INT, self.X, self.Y)
 
             else:
                 raise NotImplementedYetException("MF: %s MT: %s" % (self.file, self.MT))
@@ -249,65 +508,98 @@ class ENDFSection(ENDFPersistable):
         #TODO Parse other MTs
         except NotImplementedYetException:
             self.parsed = False 
+        except Exception:
+            self.parsed = None
+            raise
+        metrics.record("decode", time.perf_counter() - t_begin, len(data), len(data)*RECORD_WIDTH)
+        self.data = None
+        return self.parsed
             
+    # Failed data checks of the section as dicts of MAT, MF, MT, reason and detail, made once after decoding
+    def validate(self) -> list:
+        return [failure for failure in self.checks() if not self.tolerated(failure)]
+
+    # Failed data checks the section is kept with, see RESONANCE_WARNINGS
+    def warnings(self) -> list:
+        return [failure for failure in self.checks() if self.tolerated(failure)]
+
+    # Every failed data check of an MF3 section, see validateTAB1
+    def checks(self) -> list:
+        if self.file != 3 or not self.parse():
+            return []
+        invalid = self.invalid
+        if invalid is None:
+            # sections loaded from the parse cache are checked on first use
+            invalid = self.invalid = validateTAB1(self.NR, self.NP, self.NBT, self.INT, self.X, self.Y)
+        return [{"MAT": self.material, "MF": self.file, "MT": self.MT, "reason": reason, "detail": detail} for reason, detail in invalid]
+
+    def tolerated(self, failure: dict) -> bool:
+        return self.resonances and failure["reason"] in RESONANCE_WARNINGS
+
     def persist(self):
-        conn = DBConnection.getConnection()
-        if not self.parsed:
+        if not ENDFSection.isPersistable(self.file, self.MT) or not self.parse():
             raise NotImplementedYetException("MF: %s MT: %s" % (self.file, self.MT))
+        failures = self.validate()
+        if failures:
+            raise InvalidDataException(failures)
+        conn = DBConnection.getConnection()
         t_begin = time.perf_counter()
         if self.file == 1 and self.MT == 451:
             #Persist Library
             t_lib_begin = time.perf_counter()
             #print("%s %s %s %s %s" % (self.NLIB.item(0),self.NSUB.item(0),self.NVER.item(0),self.LREL.item(0),self.NFOR.item(0)))
             #raise
-            res = conn.execute("SELECT id FROM Library WHERE NLIB=%s and NSUB=%s and NVER=%s and LREL=%s and NFOR=%s",
-                          [self.NLIB,self.NSUB,self.NVER,self.LREL,self.NFOR])
-            if res:
-                print("Library already exists for NLIB=%s, NSUB=%s, NVER=%s, LREL=%s, NFOR=%s" % (self.NLIB,self.NSUB,self.NVER,self.LREL,self.NFOR))
-                self.lib_key = res[0][0]
-            else:
-                print("Persisting Library")
+            lib_lookup = library_lookup(self.NLIB,self.NSUB,self.NVER,self.LREL,self.NFOR)
+            self.lib_key = conn.getKey("Library", lib_lookup)
+            if self.lib_key is None:
+                # workers may meet the same library at once, the unique key on it keeps one row
                 IPART = str(self.NSUB)[0:-1] if len(str(self.NSUB))>1 else 0
                 ITYPE = str(self.NSUB)[-1:]
-                self.lib_key = DBConnection.getNextId()
-                conn.execute("INSERT INTO Library(id,NLIB,NVER,LREL,NSUB,NFOR,IPART,ITYPE) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
-                               [self.lib_key, self.NLIB, self.NVER, self.LREL, self.NSUB, self.NFOR, IPART, ITYPE])
-            self.timings["lib"] = time.perf_counter() - t_lib_begin
+                self.lib_key, inserted = conn.insertOrSelect("SELECT id FROM Library WHERE NLIB=%s and NSUB=%s and NVER=%s and LREL=%s and NFOR=%s",
+                                                             [self.NLIB,self.NSUB,self.NVER,self.LREL,self.NFOR],
+                                                             "INSERT INTO Library(id,NLIB,NVER,LREL,NSUB,NFOR,IPART,ITYPE) VALUES (%s,%s,%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE id=id",
+                                                             [self.NLIB, self.NVER, self.LREL, self.NSUB, self.NFOR, IPART, ITYPE])
+                if inserted:
+                    print("Persisting Library")
+                else:
+                    print("Library already exists for NLIB=%s, NSUB=%s, NVER=%s, LREL=%s, NFOR=%s" % (self.NLIB,self.NSUB,self.NVER,self.LREL,self.NFOR))
+                conn.cacheKey("Library", lib_lookup, self.lib_key)
+            metrics.record("persist.lib", time.perf_counter() - t_lib_begin)
 
             #Persist Material
             t_mat_begin = time.perf_counter()
-            res = conn.execute("SELECT id from Material where MAT=%s and AWR=%s and LFI=%s and LIS=%s and LISO=%s and abs(ELIS-%s)<.05 and STA=%s",
-                           [self.material,self.AWR,self.LFI,self.LIS, self.LISO, self.ELIS, self.STA])
-            if res:
-                self.mat_key = res[0][0]
-            else:
+            mat_lookup = material_lookup(self.material,self.AWR,self.LFI,self.LIS,self.LISO,self.ELIS,self.STA)
+            self.mat_key = conn.getKey("Material", mat_lookup)
+            if self.mat_key is None:
                 A = self.ZA % 1000
                 Z = int(self.ZA/1000)
-                print("Persisting material: MAT: %s AWR: %s LFI: %s LIS: %s LISO: %s ELIS: %s STA: %s" %
-                               (self.material,self.AWR,self.LFI,self.LIS,self.LISO,self.ELIS,self.STA))
-                self.mat_key = DBConnection.getNextId()
-                conn.execute("INSERT INTO Material(id,MAT,Z,A,AWR,LFI,LIS,LISO,ELIS,STA) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-                               [self.mat_key, self.material,Z,A,self.AWR,self.LFI,self.LIS,self.LISO,self.ELIS,self.STA])
-            self.timings["mat"] = time.perf_counter() - t_mat_begin
+                self.mat_key, inserted = conn.insertOrSelect("SELECT id from Material where MAT=%s and AWR=%s and LFI=%s and LIS=%s and LISO=%s and ELIS_key=%s and STA=%s",
+                                                             list(mat_lookup),
+                                                             "INSERT INTO Material(id,MAT,Z,A,AWR,LFI,LIS,LISO,ELIS,ELIS_key,STA) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE id=id",
+                                                             [self.material,Z,A,self.AWR,self.LFI,self.LIS,self.LISO,self.ELIS,mat_lookup[5],self.STA])
+                if inserted:
+                    print("Persisting material: MAT: %s AWR: %s LFI: %s LIS: %s LISO: %s ELIS: %s STA: %s" %
+                                   (self.material,self.AWR,self.LFI,self.LIS,self.LISO,self.ELIS,self.STA))
+                conn.cacheKey("Material", mat_lookup, self.mat_key)
+            metrics.record("persist.mat", time.perf_counter() - t_mat_begin)
 
             #Persist GeneralInfo (MT451)
             t_gi_begin = time.perf_counter()
-            res = conn.execute("SELECT id from GeneralInfo WHERE material_key=%s and library_key=%s",
-                           [self.mat_key, self.lib_key])
-            if res:
-                gi_key = res[0][0]
-            else:
-                gi_key = DBConnection.getNextId()
-                conn.execute("INSERT INTO GeneralInfo(id,material_key,library_key,file_key,LRP,NMOD,AWI,EMAX,TEMP,LDRV,Description) VALUES (%s,%s,%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                               [gi_key,self.mat_key,self.lib_key,self.file_key,self.LRP,self.NMOD,self.AWI,self.EMAX,self.TEMP,self.LDRV,self.desc])
-            self.timings["gi"] = time.perf_counter() - t_gi_begin
+            gi_key = conn.getKey("GeneralInfo", (self.mat_key, self.lib_key))
+            if gi_key is None:
+                gi_key, _ = conn.insertOrSelect("SELECT id from GeneralInfo WHERE material_key=%s and library_key=%s",
+                                                [self.mat_key, self.lib_key],
+                                                "INSERT INTO GeneralInfo(id,material_key,library_key,file_key,LRP,NMOD,AWI,EMAX,TEMP,LDRV,Description) VALUES (%s,%s,%s, %s, %s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE id=id",
+                                                [self.mat_key,self.lib_key,self.file_key,self.LRP,self.NMOD,self.AWI,self.EMAX,self.TEMP,self.LDRV,self.desc])
+                conn.cacheKey("GeneralInfo", (self.mat_key, self.lib_key), gi_key)
+            metrics.record("persist.gi", time.perf_counter() - t_gi_begin)
 
             #Persist file directory
             t_dir_begin = time.perf_counter()
             res = conn.execute("SELECT 1 FROM Directory WHERE general_info_key=%s LIMIT 1",[gi_key])
             if not res:
                 data = []
-                dir_keys = DBConnection.get_ids(len(self.section_data))
+                dir_keys = DBConnection.get_ids(len(self.section_data)).tolist()
                 for i in range(0,len(self.section_data)):
                     dir_key = dir_keys[i]
                     entry = [dir_key,gi_key]
@@ -316,62 +608,91 @@ class ENDFSection(ENDFPersistable):
                 for i in range(0,len(data),BATCH_SIZE):
                     conn.executemany("INSERT INTO Directory(id,general_info_key,MF,MT,NC,Modification) VALUES(%s,%s,%s,%s,%s,%s)",
                                     data[i:i+BATCH_SIZE])
-            self.timings["dir"] = time.perf_counter() - t_dir_begin
+            metrics.record("persist.dir", time.perf_counter() - t_dir_begin)
 
         elif self.file == 3:
             t_csinfo_begin = time.perf_counter()
-            res = conn.execute("SELECT id FROM CrossSectionInfo WHERE MT=%s and material_key=%s and library_key=%s",
-                           [self.MT, self.mat_key,self.lib_key])
-            if res:
-                cs_key = res[0][0]
-            else:
-                cs_key = DBConnection.getNextId()
-                conn.execute("INSERT INTO CrossSectionInfo(id,MT,material_key,library_key,ZA,AWR,QM,QI,LR,NR,NP) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
-                               [cs_key,self.MT,self.mat_key,self.lib_key,self.ZA,self.AWR,self.QM,self.QI,self.LR,self.NR,self.NP])
-            self.timings["csinfo"] = time.perf_counter() - t_csinfo_begin
+            cs_key = conn.getKey("CrossSectionInfo", (self.MT, self.mat_key, self.lib_key))
+            if cs_key is None:
+                # keyed like Library and Material, so workers persisting the same reaction at once share one row
+                cs_key, _ = conn.insertOrSelect("SELECT id FROM CrossSectionInfo WHERE MT=%s and material_key=%s and library_key=%s",
+                                                [self.MT, self.mat_key, self.lib_key],
+                                                "INSERT INTO CrossSectionInfo(id,MT,material_key,library_key,ZA,AWR,QM,QI,LR,NR,NP) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE id=id",
+                                                [self.MT,self.mat_key,self.lib_key,self.ZA,self.AWR,self.QM,self.QI,self.LR,self.NR,self.NP])
+                conn.cacheKey("CrossSectionInfo", (self.MT, self.mat_key, self.lib_key), cs_key)
+            metrics.record("persist.csinfo", time.perf_counter() - t_csinfo_begin)
+
+            if DB.xs_storage == "packed":
+                self.persistPacked(conn, cs_key)
+                metrics.record("persist.section", time.perf_counter() - t_begin)
+                return
 
             t_interp_begin = time.perf_counter()
 
             res = conn.execute("SELECT 1 FROM Interpolation WHERE info_key=%s and MT=%s and MF=%s limit 1",
                            [cs_key,self.MT,self.file])
             if not res:
-                data = []
                 i_keys = DBConnection.get_ids(self.NR)
-                for i in range(0,self.NR):
-                    i_key = i_keys[i]
-                    data.append([i_key,cs_key,self.MT,self.file,self.NBT[i],self.INT[i]])
-                for i in range(0,len(data),BATCH_SIZE):
-                    conn.executemany("INSERT INTO Interpolation(id,info_key,MT,MF,NBT,InterpolationScheme) VALUES(%s,%s,%s,%s,%s,%s)",
-                                       data[i:i+BATCH_SIZE])
-            self.timings["interp"] = time.perf_counter() - t_interp_begin
+                conn.bulk_insert("Interpolation", ["id","info_key","MT","MF","NBT","InterpolationScheme"],
+                                 [i_keys, cs_key, self.MT, self.file, self.NBT, self.INT])
+            metrics.record("persist.interp", time.perf_counter() - t_interp_begin)
 
             t_csdata_begin = time.perf_counter()
             res = conn.execute("SELECT 1 FROM CrossSectionData WHERE crosssectioninfo_key=%s LIMIT 1",
                            [cs_key])
             if not res:
-                data = []
                 csd_keys = DBConnection.get_ids(self.NP)
-                for i in range(0,self.NP):
-                    csd_key = csd_keys[i]
-                    data.append([csd_key,cs_key,self.MT,self.X[i],self.Y[i]])
-                    if (self.X[i] != self.X[i]) or (self.Y[i] != self.Y[i]):
-                        raise NaNException
-                for i in range(0,len(data),BATCH_SIZE):
-                    conn.executemany("INSERT INTO CrossSectionData(id,crosssectioninfo_key,MT,Energy,CrossSection) VALUES(%s,%s,%s,%s,%s)",
-                                       data[i:i+BATCH_SIZE])
-            self.timings["csdata"] = time.perf_counter() - t_csdata_begin
+                conn.bulk_insert("CrossSectionData", ["id","crosssectioninfo_key","MT","Energy","CrossSection"],
+                                 [csd_keys, cs_key, self.MT, self.X, self.Y])
+            metrics.record("persist.csdata", time.perf_counter() - t_csdata_begin, self.NP)
         else:
             raise NotImplementedYetException("MF: %s MT: %s" % (self.file, self.MT))
     
-        self.timings["total"] = time.perf_counter() - t_begin
+        metrics.record("persist.section", time.perf_counter() - t_begin)
+
+    # Store the whole TAB1 of an MF3 section as one CrossSectionBlob row instead of one row per point
+    def persistPacked(self, conn: DBConnection, cs_key: int):
+        t_csdata_begin = time.perf_counter()
+        res = conn.execute("SELECT 1 FROM CrossSectionBlob WHERE crosssectioninfo_key=%s", [cs_key])
+        if not res:
+            blobs = [pack_array(self.NBT, "<i4"), pack_array(self.INT, "<i4"), pack_array(self.X, "<f8"), pack_array(self.Y, "<f8")]
+            with metrics.timer("insert.CrossSectionBlob", 1, sum(len(blob) for blob in blobs)):
+                conn.execute("INSERT INTO CrossSectionBlob(crosssectioninfo_key,compression,NR,NP,NBT,InterpolationScheme,Energy,CrossSection) VALUES(%s,%s,%s,%s,%s,%s,%s,%s)",
+                             [cs_key, DB.xs_compression, int(self.NR), int(self.NP)] + blobs)
+        metrics.record("persist.csblob", time.perf_counter() - t_csdata_begin, self.NP)
+
+    # (NBT, INT, X, Y) of an MF3 section
+    def getTable(self) -> tuple:
+        if self.file != 3 or not self.parse():
+            raise NotImplementedYetException("MF: %s MT: %s" % (self.file, self.MT))
+        return (self.NBT, self.INT, self.X, self.Y)
+
+    # cross section (barns) at the energies E (eV)
+    def evaluate(self, E) -> np.ndarray:
+        return CrossSection.evaluate(self.getTable(), E)
+
+    # Replace an MF3 table by its lin-lin form within the relative tolerance (see CrossSection.linearize).
+    # Tables failing the data checks are left for persist to reject, or kept as they are when only warned about,
+    # e.g. negative values the log laws cannot interpolate. Tables using law 6 are kept as they are
+    def linearize(self, tolerance: float) -> None:
+        if self.file != 3 or not self.parse() or self.checks():
+            return
+        if np.all(self.INT == CrossSection.LIN_LIN) or not np.all(np.isin(self.INT, (1, 2, 3, 4, 5))):
+            return
+        t_begin = time.perf_counter()
+        NP = self.NP
+        self.NBT, self.INT, self.X, self.Y = CrossSection.linearize(self.getTable(), tolerance)
+        self.NR, self.NP = len(self.NBT), len(self.X)
+        self.invalid = validateTAB1(self.NR, self.NP, self.NBT, self.INT, self.X, self.Y)
+        metrics.record("linearize", time.perf_counter() - t_begin, self.NP)
+        metrics.record("linearize.input", 0, NP)
 
-    def getTimings(self):
-        return self.timings
     def getParsed(self):
-        return self.parsed
+        return self.parse()
     def getMT(self):
         return self.MT
     def getSectionData(self):
+        self.parse()
         return self.section_data
     def getFile(self):
         return self.file
@@ -381,35 +702,25 @@ class ENDFSection(ENDFPersistable):
 
 
 class ENDFFile(ENDFPersistable):
-    def __init__(self,data):
-        self.timings = {"total": 0, "lib": 0, "mat": 0, "gi": 0, "dir": 0, "csinfo": 0, "interp": 0, "csdata": 0}
-        self.material = int(data.iat[0,1])
-        self.file     = int(data.iat[0,2])
+    # decoded optionally gives the sections already built (e.g. loaded from a parse cache), in index order
+    def __init__(self, data, index, decoded = None):
+        self.material = int(index['MAT'][0])
+        self.file     = int(index['MF'][0])
 
         self.mat_key = None
         self.lib_key = None
 
-        bad_MF = data[data['MF']!=self.file]
-        if len(bad_MF.index>0):
-            print("MF should be %s but found other values: %s" % (self.file,bad_MF))
-            raise Exception("Bad MF values")
-
-        # Find SENDs in file
-        SENDs = data.index[(data['MAT'] == self.material) & (data['MF']==self.file) & (data['MT']==0)]
-        #print(SENDs)
-        #print(len(data.index))
-        #print(data)
-        if SENDs[-1] != len(data.index)-1:
-            raise Exception("Data after last SEND")
-        
-        #Split file into Sections
-        section_start = 0
+        # Sections are views of the material's records
         self.sections = []
-        for SEND in SENDs:
-            section = data.iloc[section_start : SEND]
-            section.index = range(len(section.index))
-            section_start = SEND+1
-            self.sections.append(ENDFSection(section))
+        if decoded is not None:
+            self.sections = list(decoded)
+            return
+        for MAT, MF, MT, start, end in index.tolist():
+            self.sections.append(ENDFSection(data[start:end], MAT, MF, MT))
+
+    def parse(self):
+        for section in self.sections:
+            section.parse()
 
     def persist(self):
         for section in self.sections:
@@ -422,15 +733,10 @@ class ENDFFile(ENDFPersistable):
                 if self.mat_key is None or self.lib_key is None:
                     self.mat_key = section.getMaterialKey()
                     self.lib_key = section.getLibraryKey()
-                sec_timings = section.getTimings()
-                for timing in self.timings:
-                    self.timings[timing] = self.timings.get(timing) + sec_timings.get(timing)
 
             except NotImplementedYetException:
                 pass
 
-    def getTimings(self):
-        return self.timings
     def getSections(self):
         return self.sections
     def getSection(self,MT):
@@ -447,34 +753,82 @@ class ENDFFile(ENDFPersistable):
 
 
 class ENDFMaterial(ENDFPersistable):
-    def __init__(self, data):
-        self.timings = {"total": 0, "lib": 0, "mat": 0, "gi": 0, "dir": 0, "csinfo": 0, "interp": 0, "csdata": 0}
-        self.material = int(data.iat[0,1])
+    def __init__(self, data, index = None, sections = None, decoded = None):
+        t_begin = time.perf_counter()
+        if index is None:
+            index = index_sections(data)
+        self.material = int(index['MAT'][0])
+        if sections is not None:
+            index = index[selectSections(index, sections)]
+        self.data = data
+        self.index = index
         self.mat_key = None
         self.lib_key = None
-        bad_MAT = data[data['MAT']!=self.material]
-        if len(bad_MAT.index>0):
-            print("MAT should be %s but found other values: %s" % (self.material,bad_MAT))
-            raise Exception("Bad MAT values")
-        
-        # Find FENDs in material
-        FENDs = data.index[(data['MAT'] == self.material) & (data['MF']==0) & (data['MT']==0)]
-        #print(FENDs)
-        #print(len(data.index))
-        #print(data)
-        if FENDs[-1] != len(data.index)-1:
-            raise Exception("Data after last FEND")
-        
+
         #Split MAT into Files
-        file_start = 0
+        file_starts = np.flatnonzero(np.diff(index['MF'])) + 1
         self.files = []
-        for FEND in FENDs:
-            file = data.iloc[file_start : FEND]
-            file.index = range(len(file.index))
-            file_start = FEND+1
-            self.files.append(ENDFFile(file))     
-                
+        if len(index) > 0:
+            bounds = [0] + file_starts.tolist() + [len(index)]
+            for i, file_index in enumerate(np.split(index, file_starts)):
+                file_decoded = None if decoded is None else decoded[bounds[i]:bounds[i+1]]
+                self.files.append(ENDFFile(data, file_index, file_decoded))
+        if decoded is None:
+            metrics.record("split", time.perf_counter() - t_begin, len(data), len(data)*RECORD_WIDTH)
+
+    # Decode every section now and release the records, e.g. before sending the material to another process.
+    # With persistable only the sections persist writes are decoded, so their errors show before anything is written
+    def parse(self, persistable: bool = False):
+        for file in self.files:
+            if not persistable:
+                file.parse()
+                continue
+            for section in file.getSections():
+                if ENDFSection.isPersistable(section.file, section.MT):
+                    section.parse()
+        if not persistable:
+            self.data = None
+
+    # Failed data checks of every section, see ENDFSection.validate. Checks only warned about are printed
+    def validate(self) -> list:
+        sections = [section for file in self.files if file.file == 3 for section in file.getSections()]
+        resonances = self.getLRP() == 1
+        for section in sections:
+            section.parse()
+            section.resonances = resonances
+        t_begin = time.perf_counter()
+        failures = [failure for section in sections for failure in section.validate()]
+        warnings = [warning for section in sections for warning in section.warnings()]
+        metrics.record("validate", time.perf_counter() - t_begin, len(sections))
+        for failure in failures:
+            metrics.record("invalid." + failure["reason"], 0, 1)
+        for warning in warnings:
+            print("WARNING: MAT %(MAT)s MF %(MF)s MT %(MT)s %(reason)s: %(detail)s, kept as LRP=1" % warning)
+            metrics.record("warning." + warning["reason"], 0, 1)
+        return failures
+
+    # LRP of the MF1/MT451 header, None without one
+    def getLRP(self):
+        for file in self.files:
+            if file.file == 1:
+                for section in file.getSections():
+                    if section.MT == 451 and section.parse():
+                        return int(section.LRP)
+        return None
+
+    # Linearize every MF3 table, see ENDFSection.linearize
+    def linearize(self, tolerance: float) -> None:
+        for file in self.files:
+            if file.file == 3:
+                for section in file.getSections():
+                    section.linearize(tolerance)
+
+    # A material with invalid data is rejected as a whole before anything of it is written
     def persist(self):
+        failures = self.validate()
+        if failures:
+            raise InvalidDataException(failures)
+        t_begin = time.perf_counter()
         for file in self.files:
             file.setFileKey(self.file_key)
             if self.mat_key is not None and self.lib_key is not None:
@@ -484,77 +838,210 @@ class ENDFMaterial(ENDFPersistable):
             if self.mat_key is None or self.lib_key is None:
                 self.mat_key = file.getMaterialKey()
                 self.lib_key = file.getLibraryKey()
-            file_timings = file.getTimings()
-            for timing in self.timings:
-                self.timings[timing] = self.timings.get(timing) + file_timings.get(timing)
-        for timing in self.timings:
-            if self.timings.get(timing) > .001:
-                print(f"Persisted {timing} in {self.timings.get(timing):0.4f} seconds")
+        metrics.record("persist.material", time.perf_counter() - t_begin)
 
     def getFiles(self):
         return self.files
     def getMaterial(self):
         return self.material
+    def getIndex(self):
+        return self.index
         
         
 
 class ENDFTape:
-    def __init__(self, filename, archive = None):
+    # sections optionally restricts the tape to an MF/MT include filter (see parseSectionFilter),
+    # MF1/MT451 is always kept since persisting a material needs its library and material keys.
+    # With a cache_dir decoded tapes are kept there (see ParseCacheWriter) and reloaded instead of parsed
+    def __init__(self, filename, archive = None, sections = None, cache_dir = None):
         self.filename = filename
         self.archive = archive
+        self.cache_dir = cache_dir
         self.file_key = None
         self.zip = (archive is not None)
+        self.materials = []
+        self.content_hash = None
+        self.source_hash = None
+        self.sections = None if sections is None else withHeaderSection(sections)
 
-    def parseTape(self):
-        file = None
+    def parseTape(self, executor = None):
         try:
-            self.materials = []
-            if self.zip:
-                file = io.TextIOWrapper(self.archive.open(self.filename, "r"),encoding ='ISO-8859-1')
-            else:
-                file = open(self.filename, "r", encoding ='ISO-8859-1')
-            data = pd.DataFrame(np.genfromtxt(file, dtype="U66,i2,i1,i2,i4", names=['content','MAT','MF','MT','NS'],
-                delimiter=[66,4,2,3,5], comments=None))
-            
-            nRows = len(data.index)
-            
-            #Find TEND indexes
-            TENDs = data.index[(data['MAT']==-1) & (data['MF']==0) & (data['MT']==0)].to_list()
-
-            #Should only be one TEND per tape
-            if len(TENDs)>1:
-                raise Exception("Tape has more than one TEND: %s" % (TENDs))
-            
-            TEND_idx = TENDs[0]
-
-            if TEND_idx!=nRows-1:
-                raise Exception("TEND is not last row in tape")
-
-            self.TPID = data.iloc[0]
-            self.NTAPE = data.iat[0,1]
-
-            tape = data.iloc[1:TEND_idx]
-            tape.index = range(len(tape.index))
-
-            # Find MENDs in tape
-            MENDs = tape.index[(tape['MAT']==0) & (tape['MF']==0) & (tape['MT']==0)]
-            if MENDs[-1] != len(tape.index)-1:
-                raise Exception("Data after last MEND")
-            
-            #Split tape into MATs
-            MAT_start = 0
-            for MEND in MENDs:
-                MAT = tape.iloc[MAT_start : MEND]
-                MAT.index = range(len(MAT.index))
-                MAT_start = MEND+1
-                self.materials.append(ENDFMaterial(MAT))
-
-
+            with metrics.timer("parse") as counts:
+                self.materials = list(self.iterMaterials(executor))
+                counts["rows"] = len(self.materials)
         except IOError:
-            print('Error While Opening File: %s' % (self.filename))  
-        finally:
-            if file is not None:
-                file.close()
+            print('Error While Opening File: %s' % (self.filename))
+
+    # Read the tape one material at a time, only the raw bytes and records of the current material are held.
+    # With an executor (e.g. a ProcessPoolExecutor) materials are decoded in parallel and still yielded in tape order,
+    # each worker is sent only the raw bytes of one material and at most `pending` materials are in flight
+    def iterMaterials(self, executor = None, pending: int = None):
+        cached = self.loadCached()
+        if cached is None:
+            cached = self.decodeMaterials(executor, pending)
+        for material in cached:
+            yield material
+
+    # Materials of the tape from the parse cache, None without a cache_dir or when the tape is not cached yet
+    def loadCached(self):
+        if not self.cache_dir:
+            return None
+        self.source_hash = self._sourceHash()
+        path = parseCachePath(self.cache_dir, self.source_hash, self.sections)
+        cached = loadParseCache(path)
+        if cached is None:
+            return None
+        print("INFO: loading %s from parse cache %s" % (self.filename, path))
+        manifest, arrays = cached
+        self.TPID = manifest["TPID"]
+        self.NTAPE = manifest["NTAPE"]
+        self.content_hash = manifest["content_hash"]
+        return self._cachedMaterials(manifest, arrays)
+
+    def _cachedMaterials(self, manifest: dict, arrays: dict):
+        for entries in manifest["materials"]:
+            with metrics.timer("cache.load", len(entries)):
+                material = cachedMaterial(entries, arrays)
+            material.setFileKey(self.file_key)
+            yield material
+
+    # Decode the tape's materials, storing them in the parse cache when there is a cache_dir.
+    # chunks are the raw materials as yielded by _rawMaterials, read here when not given (e.g. by a reader thread)
+    def decodeMaterials(self, executor = None, pending: int = None, chunks = None):
+        if not self.cache_dir:
+            for material, _ in self._decodedMaterials(executor, pending, chunks):
+                yield material
+            return
+
+        if self.source_hash is None:
+            self.source_hash = self._sourceHash()
+        writer = ParseCacheWriter(parseCachePath(self.cache_dir, self.source_hash, self.sections))
+        try:
+            for material, block in self._decodedMaterials(executor, pending, chunks):
+                writer.add(material, block)
+                yield material
+        except BaseException:
+            writer.abort()
+            raise
+        # the file changed while it was read, what was parsed does not belong under source_hash
+        if self.content_hash != self.source_hash:
+            writer.abort()
+        else:
+            writer.finish(self.TPID, self.NTAPE, self.content_hash)
+
+    # Yield (material, records) pairs for the tape, records being the (n,80) block the material's index refers to
+    def _decodedMaterials(self, executor = None, pending: int = None, chunks = None):
+        if chunks is None:
+            chunks = self._rawMaterials()
+        if executor is None:
+            for chunk in chunks:
+                block = read_block(chunk)
+                material = ENDFMaterial(block, sections=self.sections)
+                material.setFileKey(self.file_key)
+                yield material, block
+            return
+
+        pending = pending or 2*(os.cpu_count() or 1)
+        futures = deque()
+        for chunk in chunks:
+            futures.append((executor.submit(_decodeMaterial, chunk, self.sections), chunk))
+            if len(futures) >= pending:
+                future, chunk = futures.popleft()
+                material, decode_metrics = future.result()
+                metrics.merge(decode_metrics)
+                material.setFileKey(self.file_key)
+                yield material, read_block(chunk)
+        while futures:
+            future, chunk = futures.popleft()
+            material, decode_metrics = future.result()
+            metrics.merge(decode_metrics)
+            material.setFileKey(self.file_key)
+            yield material, read_block(chunk)
+
+    def _sourceHash(self) -> str:
+        digest = hashlib.sha256()
+        with (self.archive.open(self.filename, "r") if self.zip else open(self.filename, "rb")) as stream:
+            for block in iter(lambda: stream.read(READ_CHUNK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    # Yield the raw bytes of each material up to and including its MEND, checking the TPID and TEND records around them
+    def _rawMaterials(self):
+        head = True
+        t_begin = time.perf_counter()
+        for chunk, is_material in self._materialChunks():
+            if head:
+                head = False
+                tpid_end = chunk.find(b"\n") + 1 or len(chunk)
+                TPID = read_block(chunk[:tpid_end])
+                if len(TPID) == 0:
+                    raise Exception("Tape is empty")
+                self.TPID = getLine(TPID, 0)
+                self.NTAPE = int(read_controls(TPID)[0][0])
+                chunk = chunk[tpid_end:]
+
+            if is_material:
+                metrics.record("read", time.perf_counter() - t_begin, 0, len(chunk))
+                yield chunk
+                t_begin = time.perf_counter()
+            else:
+                data = read_block(chunk)
+                MAT, MF, MT = read_controls(data)
+                TENDs = np.flatnonzero((MAT==-1) & (MF==0) & (MT==0)).tolist()
+                if len(TENDs)==0:
+                    if len(data)>0:
+                        raise Exception("Data after last MEND")
+                    raise Exception("Tape has no TEND")
+                #Should only be one TEND per tape
+                if len(TENDs)>1:
+                    raise Exception("Tape has more than one TEND: %s" % (TENDs))
+                if TENDs[0]!=len(data)-1:
+                    raise Exception("TEND is not last row in tape")
+                if TENDs[0]!=0:
+                    raise Exception("Data after last MEND")
+
+    # Split the raw tape at MEND records, yielding (bytes, True) for each material up to and including its MEND
+    # and finally (bytes, False) for whatever follows the last MEND.
+    # Files are memory-mapped, zip members are read in READ_CHUNK_SIZE blocks.
+    # The chunks cover the whole tape, so once it has been read through its SHA-256 is kept in content_hash
+    def _materialChunks(self):
+        digest = hashlib.sha256()
+        if self.zip:
+            with self.archive.open(self.filename, "r") as stream:
+                buf = bytearray()
+                start = scan = 0
+                for block in iter(lambda: stream.read(READ_CHUNK_SIZE), b""):
+                    buf += block
+                    stop = buf.rfind(b"\n") + 1
+                    end = _find_mend(buf, scan, stop)
+                    while end != -1:
+                        chunk = bytes(buf[start:end])
+                        digest.update(chunk)
+                        yield chunk, True
+                        start = end
+                        end = _find_mend(buf, start, stop)
+                    del buf[:start]
+                    scan = max(stop - start, 0)
+                    start = 0
+                digest.update(buf)
+                yield bytes(buf), False
+        else:
+            with open(self.filename, "rb") as file:
+                if file.seek(0, io.SEEK_END) == 0:
+                    raise Exception("Tape is empty")
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    start = 0
+                    end = _find_mend(buf, start, len(buf))
+                    while end != -1:
+                        chunk = buf[start:end]
+                        digest.update(chunk)
+                        yield chunk, True
+                        start = end
+                        end = _find_mend(buf, start, len(buf))
+                    chunk = buf[start:]
+                    digest.update(chunk)
+                    yield chunk, False
+        self.content_hash = digest.hexdigest()
 
     def getFileKey(self):
         return self.file_key
@@ -564,9 +1051,141 @@ class ENDFTape:
             mat.setFileKey(self.file_key)
     def getMaterials(self):
         return self.materials
+    def getContentHash(self):
+        return self.content_hash
     def isZip(self):
         return self.zip
 
+# Parse cache
+# A decoded tape is kept in a directory named after the SHA-256 of its contents (and the section filter, if any).
+# manifest.json holds the TPID, every section with its scalar fields and the position of its arrays,
+# the arrays are raw little-endian files that are memory-mapped on load.
+# MF1/451 and MF3 sections are stored decoded, any other section as its records, which are parsed on access as usual
+PARSE_CACHE_VERSION = 1
+# name -> (dtype, columns) of the cache arrays, 0 columns for 1-d arrays
+_CACHE_ARRAYS = {"records": ("u1", RECORD_WIDTH), "directory": ("<i8", 4),
+                 "NBT": ("<i8", 0), "INT": ("<i8", 0), "X": ("<f8", 0), "Y": ("<f8", 0)}
+_MT451_FIELDS = ["ZA","AWR","LRP","LFI","NLIB","NMOD","ELIS","STA","LIS","LISO","NFOR",
+                 "AWI","EMAX","LREL","NSUB","NVER","TEMP","LDRV","NWD","NXC","desc"]
+_MF3_FIELDS = ["ZA","AWR","QM","QI","LR","NR","NP"]
+
+def parseCachePath(cache_dir: str, content_hash: str, sections: dict = None) -> str:
+    name = content_hash
+    if sections is not None:
+        name += "-" + hashlib.sha1(formatSectionFilter(sections).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, name)
+
+# Writes the materials of a tape to a temporary directory next to path, which is renamed to path once complete
+class ParseCacheWriter:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.tmp = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(path)))
+        self.files = {name: open(os.path.join(self.tmp, name + ".bin"), "wb") for name in _CACHE_ARRAYS}
+        self.lengths = dict.fromkeys(_CACHE_ARRAYS, 0)
+        self.materials = []
+
+    def _append(self, name: str, values) -> list:
+        values = np.ascontiguousarray(values, dtype=_CACHE_ARRAYS[name][0])
+        start = self.lengths[name]
+        self.files[name].write(values.tobytes())
+        self.lengths[name] += len(values)
+        return [start, self.lengths[name]]
+
+    # block is the record block the material's index refers to
+    def add(self, material: ENDFMaterial, block: np.ndarray) -> None:
+        entries = []
+        sections = [section for file in material.getFiles() for section in file.getSections()]
+        for section, (MAT, MF, MT, start, end) in zip(sections, material.getIndex().tolist()):
+            entry = {"MAT": MAT, "MF": MF, "MT": MT}
+            if ENDFSection.isPersistable(MF, MT) and section.parse():
+                fields = _MT451_FIELDS if MF == 1 else _MF3_FIELDS
+                entry["fields"] = {field: getattr(section, field) for field in fields}
+                for field, value in entry["fields"].items():
+                    if isinstance(value, np.generic):
+                        entry["fields"][field] = value.item()
+                if MF == 1:
+                    entry["directory"] = self._append("directory", np.array(section.section_data, dtype=np.int64).reshape(-1, 4))
+                else:
+                    for name in ("NBT", "INT", "X", "Y"):
+                        entry[name] = self._append(name, getattr(section, name))
+            else:
+                entry["records"] = self._append("records", block[start:end])
+            entries.append(entry)
+        self.materials.append(entries)
+
+    def finish(self, TPID: str, NTAPE: int, content_hash: str) -> None:
+        for file in self.files.values():
+            file.close()
+        manifest = {"version": PARSE_CACHE_VERSION, "content_hash": content_hash, "TPID": TPID, "NTAPE": NTAPE,
+                    "lengths": self.lengths, "materials": self.materials}
+        with open(os.path.join(self.tmp, "manifest.json"), "w") as file:
+            json.dump(manifest, file)
+        try:
+            os.rename(self.tmp, self.path)
+        except OSError:
+            # another process cached the same tape first
+            shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def abort(self) -> None:
+        for file in self.files.values():
+            file.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+# (manifest, arrays) of a complete cache directory, None if there is none or it was written by another version
+def loadParseCache(path: str):
+    try:
+        with open(os.path.join(path, "manifest.json")) as file:
+            manifest = json.load(file)
+        if manifest.get("version") != PARSE_CACHE_VERSION:
+            return None
+        arrays = {}
+        for name, (dtype, columns) in _CACHE_ARRAYS.items():
+            length = manifest["lengths"][name]
+            shape = (length, columns) if columns else (length,)
+            if length == 0:
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(os.path.join(path, name + ".bin"), dtype=dtype, mode="r", shape=shape)
+        return manifest, arrays
+    except FileNotFoundError:
+        return None
+    except Exception as error:
+        print("ERROR: ignoring unreadable parse cache %s: %s" % (path, error))
+        return None
+
+# Rebuild a material from its parse cache entries, decoded arrays are read-only views of the memory-mapped files
+def cachedMaterial(entries: list, arrays: dict) -> ENDFMaterial:
+    index = np.zeros(len(entries), dtype=SECTION_INDEX_DTYPE)
+    decoded = []
+    for i, entry in enumerate(entries):
+        MAT, MF, MT = entry["MAT"], entry["MF"], entry["MT"]
+        index[i] = (MAT, MF, MT, 0, 0)
+        if "records" in entry:
+            start, end = entry["records"]
+            decoded.append(ENDFSection(arrays["records"][start:end], MAT, MF, MT))
+            continue
+        section = ENDFSection(None, MAT, MF, MT)
+        for field, value in entry["fields"].items():
+            setattr(section, field, value)
+        if "directory" in entry:
+            start, end = entry["directory"]
+            section.section_data = arrays["directory"][start:end].tolist()
+        else:
+            for name in ("NBT", "INT", "X", "Y"):
+                start, end = entry[name]
+                setattr(section, name, arrays[name][start:end])
+        section.parsed = True
+        decoded.append(section)
+    return ENDFMaterial(None, index, decoded=decoded)
+
+# Worker side of ENDFTape.iterMaterials with an executor, returns the material and the metrics of decoding it
+def _decodeMaterial(chunk: bytes, sections: dict) -> tuple:
+    metrics.clear()
+    material = ENDFMaterial(read_block(chunk), sections=sections)
+    material.parse()
+    return material, metrics.pop()
+
 #tape = ENDFTape("n_9437_94-Pu-239.dat")
 #tape = ENDFTape("n_9034_90-TH-230.dat")
 #tape = ENDFTape("mendl2_all.dat")
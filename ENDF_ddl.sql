@@ -24,7 +24,7 @@ CREATE TABLE `CrossSectionInfo` (
   `NR` smallint(6) NOT NULL,
   `NP` mediumint(9) NOT NULL,
   PRIMARY KEY (`id`),
-  KEY `ix_crosssection_mt_mat_lib` (`MT`,`material_key`,`library_key`)
+  UNIQUE KEY `ux_CrossSectionInfo_natural` (`MT`,`material_key`,`library_key`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;;
 
 CREATE TABLE `GeneralInfo` (
@@ -64,7 +64,8 @@ CREATE TABLE `Library` (
   `ITYPE` tinyint(4) NOT NULL,
   `Definition` varchar(200) DEFAULT NULL,
   `SublibraryName` varchar(200) DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `ux_Library_natural` (`NLIB`,`NSUB`,`NVER`,`LREL`,`NFOR`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;;
 
 CREATE TABLE `Material` (
@@ -77,9 +78,11 @@ CREATE TABLE `Material` (
   `LIS` tinyint(4) UNSIGNED NOT NULL COMMENT 'State number of the target nucleus. The ground state is indicated by LIS=0.',
   `LISO` tinyint(4) NOT NULL COMMENT 'Isomeric state number. The ground state is indicated by LISO=0. LIS is greater than or equal to LISO.',
   `ELIS` float NOT NULL COMMENT 'Excitation energy of the target nucleus relative to 0.0 for the ground state',
+  `ELIS_key` decimal(12,2) NOT NULL COMMENT 'ELIS rounded to 0.01 eV, materials are told apart by it',
   `STA` tinyint(4) NOT NULL COMMENT 'Target stability flag: STA=0, stable nucleus; STA=1 unstable nucleus. If the target is unstable, radioactive decay data should be given in the decay data sub-library (NSUB=4).',
   `Description` varchar(500) DEFAULT NULL,
   PRIMARY KEY (`id`),
+  UNIQUE KEY `ux_Material_natural` (`MAT`,`AWR`,`LFI`,`LIS`,`LISO`,`ELIS_key`,`STA`),
   KEY `ix_MAT` (`MAT`) USING BTREE
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;;
 
@@ -100,7 +103,12 @@ CREATE TABLE `Files` (
   `name` varchar(200) NOT NULL,
   `zip_file` varchar(200) DEFAULT NULL,
   `comment` varchar(2000) DEFAULT NULL,
-  PRIMARY KEY (`id`)
+  `size` bigint(20) DEFAULT NULL COMMENT 'bytes, uncompressed size for zip members',
+  `mtime` double DEFAULT NULL COMMENT 'modification time in seconds since the epoch',
+  `content_hash` char(64) DEFAULT NULL COMMENT 'SHA-256 of the contents, set once every material of the file was persisted without errors',
+  `settings_hash` char(64) DEFAULT NULL COMMENT 'SHA-256 of the section filter, linearization, union grid and storage settings the file was persisted with',
+  PRIMARY KEY (`id`),
+  KEY `ix_Files_name_path` (`name`,`path`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;;
 
 CREATE TABLE `Interpolation` (
@@ -114,3 +122,69 @@ CREATE TABLE `Interpolation` (
   KEY `ix_interp_info_MT_MF` (`info_key`,`MT`,`MF`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;;
 
+CREATE TABLE `CrossSectionBlob` (
+  `crosssectioninfo_key` int(11) NOT NULL,
+  `compression` varchar(10) NOT NULL COMMENT 'none or zlib (byte shuffled)',
+  `NR` smallint(6) NOT NULL,
+  `NP` mediumint(9) NOT NULL,
+  `NBT` blob NOT NULL COMMENT 'int32 little-endian',
+  `InterpolationScheme` blob NOT NULL COMMENT 'int32 little-endian',
+  `Energy` longblob NOT NULL COMMENT 'eV, float64 little-endian',
+  `CrossSection` longblob NOT NULL COMMENT 'barns, float64 little-endian',
+  PRIMARY KEY (`crosssectioninfo_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE `UnionGrid` (
+  `material_key` int(11) NOT NULL,
+  `library_key` int(11) NOT NULL,
+  `compression` varchar(10) NOT NULL COMMENT 'none or zlib (byte shuffled)',
+  `NE` mediumint(9) NOT NULL COMMENT 'points of the unionized energy grid',
+  `NX` smallint(6) NOT NULL COMMENT 'reactions',
+  `NB` mediumint(9) NOT NULL COMMENT 'entries of the log-energy hash table, bins + 1, 0 without one',
+  `Energy` longblob NOT NULL COMMENT 'eV, float64 little-endian',
+  `MT` blob NOT NULL COMMENT 'int32 little-endian',
+  `StartIndex` blob NOT NULL COMMENT 'int32 little-endian, first grid point of each reaction',
+  `CrossSection` longblob NOT NULL COMMENT 'barns, float64 little-endian, each reaction from its start index to the end of the grid',
+  `BinIndex` blob NOT NULL COMMENT 'int32 little-endian, grid interval at the lower edge of each hash bin',
+  PRIMARY KEY (`material_key`,`library_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE `DerivedEvaluation` (
+  `id` int(11) NOT NULL,
+  `material_key` int(11) NOT NULL,
+  `library_key` int(11) NOT NULL,
+  `TEMP` float NOT NULL COMMENT 'Target temperature (Kelvin) the cross sections were Doppler broadened to',
+  `LDRV` smallint(6) NOT NULL COMMENT 'Special derived material flag, LDRV≥ 1 for derived evaluations',
+  `Description` varchar(500) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_DerivedEvaluation_mat_lib` (`material_key`,`library_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE `DerivedCrossSection` (
+  `derived_key` int(11) NOT NULL,
+  `MT` smallint(6) NOT NULL,
+  `compression` varchar(10) NOT NULL COMMENT 'none or zlib (byte shuffled)',
+  `NP` mediumint(9) NOT NULL COMMENT 'points of the lin-lin table',
+  `Energy` longblob NOT NULL COMMENT 'eV, float64 little-endian',
+  `CrossSection` longblob NOT NULL COMMENT 'barns, float64 little-endian',
+  PRIMARY KEY (`derived_key`,`MT`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE `GroupStructure` (
+  `structure` char(64) NOT NULL COMMENT 'SHA-256 of the boundaries as float64 little-endian',
+  `NG` mediumint(9) NOT NULL COMMENT 'groups',
+  `Bounds` blob NOT NULL COMMENT 'eV, float64 little-endian, the NG+1 ascending group boundaries',
+  PRIMARY KEY (`structure`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE `GroupCrossSection` (
+  `material_key` int(11) NOT NULL,
+  `library_key` int(11) NOT NULL,
+  `MT` smallint(6) NOT NULL,
+  `structure` char(64) NOT NULL COMMENT 'GroupStructure of the groups',
+  `weight` varchar(100) NOT NULL COMMENT 'flat, 1/E, E^q or table:<SHA-256 of the weight TAB1>:<linearization tolerance>',
+  `compression` varchar(10) NOT NULL COMMENT 'none or zlib (byte shuffled)',
+  `NG` mediumint(9) NOT NULL COMMENT 'groups',
+  `CrossSection` blob NOT NULL COMMENT 'barns, float64 little-endian, one value per group',
+  PRIMARY KEY (`material_key`,`library_key`,`MT`,`structure`,`weight`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
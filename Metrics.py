@@ -0,0 +1,147 @@
+import cProfile
+import math
+import os
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Per-stage counters and latency histograms of the running process.
+# A stage is a dotted name such as "decode", "ids" or "insert.CrossSectionData", each record adds one call
+# with its duration and the rows and bytes it handled. Gauges keep the largest value seen, e.g. peak memory.
+# Snapshots are plain dicts so worker processes can send theirs back to be merged into the parent's
+
+# latency histogram buckets: bucket i counts calls taking [2^(i-1), 2^i) microseconds, the last one everything longer
+HISTOGRAM_BUCKETS = 32
+PERCENTILES = (50, 90, 99)
+
+def _bucket(seconds: float) -> int:
+    if seconds < 1e-6:
+        return 0
+    return min(int(math.log2(seconds*1e6)) + 1, HISTOGRAM_BUCKETS - 1)
+
+# upper bound in seconds of the bucket holding the given percentile of the calls
+def _percentile(buckets: list, count: int, percentile: int) -> float:
+    target = math.ceil(count*percentile/100)
+    seen = 0
+    for i, calls in enumerate(buckets):
+        seen += calls
+        if seen >= target:
+            return 2**i*1e-6
+    return 2**(len(buckets) - 1)*1e-6
+
+class Metrics():
+    def __init__(self):
+        self._stages = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, rows: int = 0, bytes: int = 0) -> None:
+        with self._lock:
+            metric = self._stages.get(stage)
+            if metric is None:
+                metric = self._stages[stage] = {"count": 0, "seconds": 0.0, "rows": 0, "bytes": 0, "buckets": [0]*HISTOGRAM_BUCKETS}
+            metric["count"] += 1
+            metric["seconds"] += seconds
+            metric["rows"] += int(rows)
+            metric["bytes"] += int(bytes)
+            metric["buckets"][_bucket(seconds)] += 1
+
+    # Time the block as one call of stage, rows and bytes may be set on the yielded dict once known
+    @contextmanager
+    def timer(self, stage: str, rows: int = 0, bytes: int = 0):
+        counts = {"rows": rows, "bytes": bytes}
+        t_begin = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.record(stage, time.perf_counter() - t_begin, counts["rows"], counts["bytes"])
+
+    def gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = max(self._gauges.get(name, value), value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"stages": {stage: dict(metric, buckets=list(metric["buckets"])) for stage, metric in self._stages.items()},
+                    "gauges": dict(self._gauges)}
+
+    # snapshot and reset
+    def pop(self) -> dict:
+        with self._lock:
+            snapshot = {"stages": self._stages, "gauges": self._gauges}
+            self._stages = {}
+            self._gauges = {}
+            return snapshot
+
+    def merge(self, snapshot: dict) -> None:
+        with self._lock:
+            for stage, other in snapshot["stages"].items():
+                metric = self._stages.get(stage)
+                if metric is None:
+                    self._stages[stage] = dict(other, buckets=list(other["buckets"]))
+                    continue
+                for counter in ("count", "seconds", "rows", "bytes"):
+                    metric[counter] += other[counter]
+                metric["buckets"] = [a + b for a, b in zip(metric["buckets"], other["buckets"])]
+            for name, value in snapshot["gauges"].items():
+                self._gauges[name] = max(self._gauges.get(name, value), value)
+
+    # Totals, rates and latency percentiles per stage, ready to be written as JSON
+    def summary(self) -> dict:
+        snapshot = self.snapshot()
+        stages = {}
+        for stage, metric in sorted(snapshot["stages"].items()):
+            seconds = max(metric["seconds"], 1e-9)
+            summary = {"count": metric["count"], "seconds": metric["seconds"], "rows": metric["rows"], "bytes": metric["bytes"],
+                       "rows_per_s": metric["rows"]/seconds, "bytes_per_s": metric["bytes"]/seconds,
+                       "mean_s": metric["seconds"]/max(metric["count"], 1)}
+            for percentile in PERCENTILES:
+                summary["p%d_s" % (percentile)] = _percentile(metric["buckets"], metric["count"], percentile)
+            stages[stage] = summary
+        return {"stages": stages, "gauges": snapshot["gauges"]}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stages = {}
+            self._gauges = {}
+
+metrics = Metrics()
+
+# a forked worker reports only its own work, and must not inherit a lock held by another thread
+def _after_fork() -> None:
+    metrics.__init__()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+# Run the block under cProfile and/or tracemalloc. modes is a set of "cprofile" and "tracemalloc":
+# cProfile stats are written to <directory>/<name>.prof, tracemalloc's peak goes to the memory.peak gauge
+# and the largest allocation sites are printed
+@contextmanager
+def profiled(name: str, modes: set, directory: str = "."):
+    profiler = None
+    if "cprofile" in modes:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    tracing = "tracemalloc" in modes and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, re.sub(r"[^\w.-]", "_", name) + ".prof")
+            profiler.dump_stats(path)
+            print("INFO: profile of %s written to %s" % (name, path))
+        if tracing:
+            _, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics("lineno")[:5]
+            tracemalloc.stop()
+            metrics.gauge("memory.peak", peak)
+            print("INFO: peak traced memory of %s: %.1f MB" % (name, peak/1e6))
+            for stat in top:
+                print("INFO:   %s" % (stat))
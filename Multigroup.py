@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import json
+import sys
+import time
+import numpy as np
+import CrossSection
+import DB
+from DB import DBConnection, pack_array, unpack_array
+from Metrics import metrics
+
+# Group cross sections: the average of a cross section over each energy group [B[g], B[g+1]] weighted by a spectrum w,
+#   s_g = integral of s(E) w(E) dE / integral of w(E) dE
+# Weights are a power E^q, by name flat (q = 0) or 1/E (q = -1), or a tabulated spectrum given as a TAB1.
+# Under a power weight every interval of a table is integrated exactly in its own interpolation law (see
+# CrossSection.integrate). A tabulated weight and the cross section are linearized to the tolerance and their product,
+# quadratic between the points of both, is integrated exactly. Cross sections are 0 outside their table
+WEIGHTS = {"flat": 0.0, "1/E": -1.0}
+
+def structure_key(bounds) -> str:
+    return hashlib.sha256(np.ascontiguousarray(bounds, dtype="<f8").tobytes()).hexdigest()
+
+# Name a weight, as stored with the group cross sections computed with it
+def weight_key(weight, tolerance: float = 1e-3) -> str:
+    if isinstance(weight, str):
+        if weight not in WEIGHTS:
+            raise Exception("Unknown weight: %s" % (weight))
+        return weight
+    if np.isscalar(weight):
+        return "E^%r" % (float(weight))
+    digest = hashlib.sha256()
+    for values, dtype in zip(weight, ("<i4", "<i4", "<f8", "<f8")):
+        digest.update(np.ascontiguousarray(values, dtype=dtype).tobytes())
+    return "table:%s:%g" % (digest.hexdigest(), tolerance)
+
+# Group cross sections of the TAB1 tables (NBT, INT, X, Y) for the ascending group boundaries, as an array of shape
+# (tables, groups). weight is a name of WEIGHTS, an exponent q of E or a TAB1 spectrum
+def collapse(tables: list, bounds, weight="1/E", tolerance: float = 1e-3) -> np.ndarray:
+    bounds = np.asarray(bounds, dtype=np.float64)
+    if len(bounds) < 2 or np.any(np.diff(bounds) <= 0):
+        raise Exception("Group boundaries must rise strictly, got %d boundaries" % (len(bounds)))
+    for table in tables:
+        if len(table[2]) < 2 or table[2][0] <= 0:
+            raise Exception("Cannot collapse a table of %d points starting at %s eV" % (len(table[2]), table[2][0] if len(table[2]) else None))
+    t_begin = time.perf_counter()
+    if isinstance(weight, str):
+        weight = WEIGHTS[weight_key(weight)]
+    if np.isscalar(weight):
+        values = _collapse_power(tables, bounds, float(weight))
+    else:
+        values = _collapse_tabulated(tables, bounds, weight, tolerance)
+    metrics.record("collapse", time.perf_counter() - t_begin, values.size)
+    return values
+
+# Under E^q: the integral of each table up to every boundary is its cumulative integral at the interval holding the
+# boundary plus the part of that interval below it, for all tables and boundaries at once
+def _collapse_power(tables: list, bounds: np.ndarray, q: float) -> np.ndarray:
+    if q <= -1 and bounds[0] <= 0:
+        raise Exception("A weight E^%g needs positive group boundaries" % (q))
+    sizes = np.array([len(table[2]) for table in tables])
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    X = np.concatenate([np.asarray(table[2], dtype=np.float64) for table in tables])
+    Y = np.concatenate([np.asarray(table[3], dtype=np.float64) for table in tables])
+    # the law of each interval, the last point of a table starts no interval of its own
+    laws = np.zeros(len(X), dtype=np.int64)
+    for table, start, size in zip(tables, starts, sizes):
+        NBT, INT = np.asarray(table[0]), np.asarray(table[1])
+        i = np.arange(size - 1)
+        laws[start:start+size-1] = INT[np.minimum(np.searchsorted(NBT, i + 2), len(INT) - 1)] if len(INT) > 1 else INT[0]
+    last = starts + sizes - 1
+    inner = np.ones(len(X) - 1, dtype=bool)
+    inner[last[:-1]] = False
+
+    I = np.zeros(len(X))
+    I[1:][inner] = CrossSection.integrate(laws[:-1][inner], X[:-1][inner], X[1:][inner], Y[:-1][inner], Y[1:][inner], q)
+
+    # cumulative integral of each table from its first point, summed per table since a running sum across tables
+    # would bury the small low energy integrals of one under the total of the one before.
+    # Then the interval of each table holding each boundary, boundaries outside a table are moved to its ends
+    cumulative = np.empty(len(X))
+    e = np.clip(bounds[None, :], X[starts][:, None], X[last][:, None])
+    i = np.empty(e.shape, dtype=np.int64)
+    for r, (start, size) in enumerate(zip(starts, sizes)):
+        cumulative[start:start+size] = np.cumsum(I[start:start+size])
+        i[r] = start + np.clip(np.searchsorted(X[start:start+size], e[r], side='right') - 1, 0, size - 2)
+    e, i = e.ravel(), i.ravel()
+    below = CrossSection.integrate(laws[i], X[i], e, Y[i], CrossSection.interpolate(laws[i], X[i], X[i+1], Y[i], Y[i+1], e), q)
+    total = (cumulative[i] + below).reshape(len(tables), len(bounds))
+
+    with np.errstate(divide='ignore'):
+        if q == -1:
+            flux = np.log(bounds[1:]/bounds[:-1])
+        else:
+            flux = (bounds[1:]**(q + 1) - bounds[:-1]**(q + 1))/(q + 1)
+    return np.diff(total, axis=1)/flux
+
+# Under a tabulated weight: both functions are linear between the points of either and the boundaries, where the
+# integral of their product is (x1 - x0)*(2*s0*w0 + s0*w1 + s1*w0 + 2*s1*w1)/6
+def _collapse_tabulated(tables: list, bounds: np.ndarray, weight: tuple, tolerance: float) -> np.ndarray:
+    weight = CrossSection.linearize(weight, tolerance)
+    wX = np.asarray(weight[2], dtype=np.float64)
+    flux = _group_integrals(np.unique(np.concatenate((wX, bounds))), None, weight, bounds)
+    values = np.zeros((len(tables), len(bounds) - 1))
+    for r, table in enumerate(tables):
+        table = CrossSection.linearize(table, tolerance)
+        X = np.asarray(table[2], dtype=np.float64)
+        grid = np.unique(np.concatenate((X, wX, bounds)))
+        grid = grid[(grid >= max(X[0], bounds[0])) & (grid <= min(X[-1], bounds[-1]))]
+        values[r] = _group_integrals(grid, table, weight, bounds)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return values/flux
+
+# Integral over each group of the linear table (1 if None) times the linear weight on a grid holding the boundaries.
+# The values at both ends of each grid interval come from the table interval holding its middle, so a discontinuity
+# on the grid takes its left and right values on either side
+def _group_integrals(grid: np.ndarray, table: tuple, weight: tuple, bounds: np.ndarray) -> np.ndarray:
+    if len(grid) < 2:
+        return np.zeros(len(bounds) - 1)
+    x0, x1 = grid[:-1], grid[1:]
+    middle = (x0 + x1)/2
+    w0, w1 = _linear_ends(weight, middle, x0, x1)
+    if table is None:
+        products = (x1 - x0)*(w0 + w1)/2
+    else:
+        s0, s1 = _linear_ends(table, middle, x0, x1)
+        products = (x1 - x0)*(2*s0*w0 + s0*w1 + s1*w0 + 2*s1*w1)/6
+    group = np.searchsorted(bounds, middle, side='right') - 1
+    inside = (group >= 0) & (group < len(bounds) - 1)
+    return np.bincount(group[inside], weights=products[inside], minlength=len(bounds) - 1)
+
+def _linear_ends(table: tuple, middle: np.ndarray, x0: np.ndarray, x1: np.ndarray) -> tuple:
+    X = np.asarray(table[2], dtype=np.float64)
+    Y = np.asarray(table[3], dtype=np.float64)
+    i = np.clip(np.searchsorted(X, middle, side='right') - 1, 0, len(X) - 2)
+    outside = (middle < X[0]) | (middle > X[-1])
+    ends = []
+    for e in (x0, x1):
+        ends.append(np.where(outside, 0.0, CrossSection.interpolate(CrossSection.LIN_LIN, X[i], X[i+1], Y[i], Y[i+1], e)))
+    return ends
+
+# Group cross sections by (material_key, library_key, MT, structure_key, weight_key), read-only arrays
+group_cache = CrossSection.TableCache(4096)
+
+# Group cross sections of reactions of a material, by MT, from the cache, the GroupCrossSection table or else
+# collapsed from the cross sections in the database, all reactions missing from both at once. With persist the
+# collapsed ones are stored, the caller commits. Reactions not in the database are left out
+def group_cross_sections(conn: DBConnection, material_key: int, library_key: int, MTs: list, bounds, weight="1/E",
+                         persist: bool = False, tolerance: float = 1e-3) -> dict:
+    bounds = np.asarray(bounds, dtype=np.float64)
+    structure = structure_key(bounds)
+    wkey = weight_key(weight, tolerance)
+    results = {}
+    missing = []
+    for MT in MTs:
+        values = group_cache.get((material_key, library_key, MT, structure, wkey))
+        if values is None:
+            missing.append(MT)
+        else:
+            results[MT] = values
+    if not missing:
+        return results
+
+    stored = read_group_cross_sections(conn, material_key, library_key, missing, structure, wkey)
+    tables = {}
+    for MT in missing:
+        if MT in stored:
+            results[MT] = stored[MT]
+            continue
+        table = CrossSection.read_cross_section(conn, material_key, library_key, MT)
+        if table is not None and len(table[2]) >= 2:
+            tables[MT] = table
+    collapsed = {}
+    if tables:
+        MTs = sorted(tables)
+        collapsed = dict(zip(MTs, collapse([tables[MT] for MT in MTs], bounds, weight, tolerance)))
+        if persist:
+            persist_group_cross_sections(conn, material_key, library_key, collapsed, bounds, structure, wkey)
+    for MT, values in list(stored.items()) + list(collapsed.items()):
+        values.flags.writeable = False
+        results[MT] = values
+        group_cache.put((material_key, library_key, MT, structure, wkey), values)
+    return results
+
+def read_group_cross_sections(conn: DBConnection, material_key: int, library_key: int, MTs: list, structure: str, wkey: str) -> dict:
+    if not MTs:
+        return {}
+    res = conn.execute("SELECT MT,compression,CrossSection FROM GroupCrossSection WHERE material_key=%s and library_key=%s and structure=%s "
+                       "and weight=%s and MT IN (%s)" % ("%s", "%s", "%s", "%s", ",".join(["%s"]*len(MTs))),
+                       [material_key, library_key, structure, wkey] + list(MTs))
+    return {int(MT): unpack_array(values, "<f8", compression) for MT, compression, values in res}
+
+# Store group cross sections by MT as GroupCrossSection rows, and the boundaries once as a GroupStructure row,
+# uncompressed since GroupStructure has no compression column
+def persist_group_cross_sections(conn: DBConnection, material_key: int, library_key: int, values: dict, bounds, structure: str, wkey: str) -> None:
+    res = conn.execute("SELECT 1 FROM GroupStructure WHERE structure=%s", [structure])
+    if not res:
+        conn.execute("INSERT INTO GroupStructure(structure,NG,Bounds) VALUES(%s,%s,%s)",
+                     [structure, len(bounds) - 1, pack_array(bounds, "<f8", "none")])
+    rows = []
+    for MT, groups in sorted(values.items()):
+        rows.append([material_key, library_key, MT, structure, wkey, DB.xs_compression, len(groups), pack_array(groups, "<f8")])
+    existing = set(int(MT) for (MT,) in conn.execute("SELECT MT FROM GroupCrossSection WHERE material_key=%s and library_key=%s and structure=%s and weight=%s",
+                                                     [material_key, library_key, structure, wkey]))
+    rows = [row for row in rows if row[2] not in existing]
+    if rows:
+        with metrics.timer("insert.GroupCrossSection", len(rows), sum(len(row[-1]) for row in rows)):
+            conn.executemany("INSERT INTO GroupCrossSection(material_key,library_key,MT,structure,weight,compression,NG,CrossSection) VALUES(%s,%s,%s,%s,%s,%s,%s,%s)",
+                             rows)
+
+# Group boundaries read from a text file of energies (eV), whitespace separated
+def read_bounds(path: str) -> np.ndarray:
+    with open(path) as file:
+        return np.sort(np.array(file.read().split(), dtype=np.float64))
+
+# Weight read from a text file of energy (eV) and weight pairs, as a lin-lin TAB1
+def read_weight(path: str) -> tuple:
+    with open(path) as file:
+        values = np.array(file.read().split(), dtype=np.float64).reshape(-1, 2)
+    return (np.array([len(values)], dtype=np.int64), np.array([CrossSection.LIN_LIN], dtype=np.int64),
+            np.ascontiguousarray(values[:, 0]), np.ascontiguousarray(values[:, 1]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collapse MF3 cross sections in the database to group cross sections")
+    parser.add_argument("--groups", type=int, default=70, help="groups of equal lethargy width from 1e-5 eV to 20 MeV")
+    parser.add_argument("--bounds", help="file of group boundaries (eV) to use instead of --groups")
+    parser.add_argument("--weight", default="1/E", help="flat, 1/E, an exponent q of E^q or a file of energy and weight pairs")
+    parser.add_argument("--mat", type=int, nargs="*", default=[], help="MAT numbers to collapse, all materials if not given")
+    parser.add_argument("--mt", type=int, nargs="*", default=[], help="MT numbers to collapse, all reactions if not given")
+    parser.add_argument("--tolerance", type=float, default=1e-3, help="relative tolerance of the linearization under a tabulated weight")
+    parser.add_argument("--persist", action="store_true", help="store the group cross sections in the GroupCrossSection table")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout if not given")
+    args = parser.parse_args()
+
+    bounds = read_bounds(args.bounds) if args.bounds else np.geomspace(1e-5, 2e7, args.groups + 1)
+    weight = args.weight
+    if weight not in WEIGHTS:
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = read_weight(weight)
+
+    conn = DBConnection.getConnection()
+    query = "SELECT g.material_key,g.library_key,m.MAT FROM GeneralInfo g JOIN Material m ON m.id=g.material_key"
+    if args.mat:
+        query += " WHERE m.MAT IN (%s)" % (",".join(["%s"]*len(args.mat)))
+    results = {}
+    t_begin = time.perf_counter()
+    reactions = 0
+    for material_key, library_key, MAT in conn.execute(query, args.mat or None):
+        MTs = args.mt or [int(MT) for (MT,) in conn.execute("SELECT MT FROM CrossSectionInfo WHERE material_key=%s and library_key=%s ORDER BY MT",
+                                                            [material_key, library_key])]
+        groups = group_cross_sections(conn, material_key, library_key, MTs, bounds, weight, args.persist, args.tolerance)
+        if args.persist:
+            conn.commit()
+        reactions += len(groups)
+        results["%s/%s" % (MAT, library_key)] = {str(MT): values.tolist() for MT, values in sorted(groups.items())}
+    elapsed = max(time.perf_counter() - t_begin, 1e-9)
+    print("INFO: %d reactions in %d groups in %.2f s (%.0f reactions/s)" % (reactions, len(bounds) - 1, elapsed, reactions/elapsed), file=sys.stderr)
+
+    output = json.dumps({"bounds": bounds.tolist(), "weight": weight_key(weight, args.tolerance), "groups": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
@@ -0,0 +1,244 @@
+import time
+import numpy as np
+import CrossSection
+from DB import DBConnection, pack_array, unpack_array
+import DB
+from Metrics import metrics
+
+# relative tolerance reactions are linearized to when the grid is built
+DEFAULT_TOLERANCE = 1e-3
+
+# Unionized energy grid of a material: the energies of all its MF3 reactions merged into one sorted grid, with
+# every reaction evaluated at those energies. One search for an energy's grid interval then gives the cross
+# sections of all reactions there. A reaction is stored from its start index, the first grid point at or above
+# its threshold, to the end of the grid, all reactions one after the other in a single array.
+# The grid is built from the reactions linearized to a tolerance, so interpolating linearly between grid points
+# reproduces them to that tolerance. An energy where any reaction is discontinuous is kept twice, the first
+# point holding the values left of it and the second the values right of it.
+# The optional hash table splits [E[0], E[-1]] into nBins bins of equal width in ln(E) and keeps the grid interval
+# at the lower edge of each bin, so a search only has to look at the few grid points inside one bin
+class UnionGrid():
+    def __init__(self, E: np.ndarray, MTs: np.ndarray, starts: np.ndarray, XS: np.ndarray, bins: np.ndarray = None):
+        self.E = np.ascontiguousarray(E, dtype=np.float64)
+        self.MTs = np.ascontiguousarray(MTs, dtype=np.int32)
+        self.starts = np.ascontiguousarray(starts, dtype=np.int32)
+        self.XS = np.ascontiguousarray(XS, dtype=np.float64)
+        # offset of each reaction's first value in XS
+        lengths = len(self.E) - self.starts.astype(np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        if len(self.XS) != lengths.sum():
+            raise Exception("Union grid of %d points and %d reactions needs %d values, got %d" %
+                            (len(self.E), len(self.MTs), lengths.sum(), len(self.XS)))
+        self.setBins(bins)
+
+    # Build the grid from TAB1 tables (NBT, INT, X, Y) keyed by MT, as returned by getTable or read_cross_section,
+    # linearizing tables using other laws than lin-lin to the relative tolerance first
+    @classmethod
+    def build(cls, tables: dict, nBins: int = 0, tolerance: float = DEFAULT_TOLERANCE) -> 'UnionGrid':
+        t_begin = time.perf_counter()
+        MTs = sorted(tables)
+        if not MTs:
+            raise Exception("Cannot build a union grid without reactions")
+        if tolerance <= 0:
+            raise Exception("Cannot build a union grid with a linearization tolerance of %s" % (tolerance))
+        linear = {MT: CrossSection.linearize(tables[MT], tolerance) for MT in MTs}
+        E = np.unique(np.concatenate([linear[MT][2] for MT in MTs]))
+        # energies given twice in a table are discontinuities, kept twice in the grid, as is the last energy of a
+        # table ending below the grid's, where it drops to 0
+        repeated = [X[1:][X[1:] == X[:-1]] for X in (linear[MT][2] for MT in MTs)]
+        repeated += [linear[MT][2][-1:] for MT in MTs if linear[MT][2][-1] < E[-1]]
+        E = np.sort(np.concatenate([E, np.unique(np.concatenate(repeated))]))
+        left = np.zeros(len(E), dtype=bool)
+        left[:-1] = E[:-1] == E[1:]
+        starts = np.empty(len(MTs), dtype=np.int32)
+        values = []
+        for r, MT in enumerate(MTs):
+            X, Y = linear[MT][2], linear[MT][3]
+            starts[r] = np.searchsorted(E, X[0])
+            e = E[starts[r]:]
+            below, above = _linear(X, Y, e, 'left'), _linear(X, Y, e, 'right')
+            below[e > X[-1]] = 0.0
+            if X[-1] < E[-1]:
+                above[e >= X[-1]] = 0.0
+            values.append(np.where(left[starts[r]:], below, above))
+        grid = cls(E, np.array(MTs), starts, np.concatenate(values))
+        grid.hash(nBins)
+        metrics.record("union.build", time.perf_counter() - t_begin, len(E), grid.XS.nbytes)
+        return grid
+
+    # Union grid of the parsed MF3 sections of an ENDFMaterial, None if it has none
+    @classmethod
+    def fromMaterial(cls, material, nBins: int = 0, tolerance: float = DEFAULT_TOLERANCE) -> 'UnionGrid':
+        tables = {section.getMT(): section.getTable() for file in material.getFiles() if file.getFile() == 3
+                  for section in file.getSections() if section.getParsed()}
+        if not tables:
+            return None
+        return cls.build(tables, nBins, tolerance)
+
+    # (Re)build the hash table with nBins log-energy bins, 0 removes it
+    def hash(self, nBins: int) -> None:
+        if nBins <= 0:
+            self.setBins(None)
+            return
+        if self.E[0] <= 0:
+            raise Exception("Cannot hash a union grid starting at %s eV on a log scale" % (self.E[0]))
+        edges = np.exp(np.linspace(np.log(self.E[0]), np.log(self.E[-1]), nBins + 1))
+        self.setBins(np.clip(np.searchsorted(self.E, edges, side='right') - 1, 0, len(self.E) - 2))
+
+    def setBins(self, bins: np.ndarray) -> None:
+        self.bins = None if bins is None or len(bins) == 0 else np.ascontiguousarray(bins, dtype=np.int32)
+        if self.bins is not None:
+            self.log_min = np.log(self.E[0])
+            self.log_step = (np.log(self.E[-1]) - self.log_min)/(len(self.bins) - 1)
+
+    # Grid interval i of each energy, clipped to the first and last interval: E[i] <= e < E[i+1] for side 'right',
+    # E[i] < e <= E[i+1] for side 'left'. At a discontinuity these are the intervals right and left of it.
+    # With or without the hash table this is np.searchsorted(E, e, side) - 1, clipped, for every energy
+    def index(self, energies, side: str = 'right') -> np.ndarray:
+        if side not in ('left', 'right'):
+            raise Exception("Unknown side %s" % (side))
+        e = np.asarray(energies, dtype=np.float64)
+        last = len(self.E) - 2
+        if self.bins is None or self.log_step <= 0:
+            return np.clip(np.searchsorted(self.E, e, side=side) - 1, 0, last)
+        # energies of 0 and below go to the first bin, NaN to the last as searchsorted sorts it last
+        with np.errstate(divide='ignore', invalid='ignore'):
+            k = (np.log(np.where(e > 0, e, np.where(np.isnan(e), np.inf, 0.0))) - self.log_min)/self.log_step
+        k = np.clip(np.nan_to_num(k, posinf=len(self.bins), neginf=0.0), 0, len(self.bins) - 2).astype(np.int64)
+        lo = self.bins[k].astype(np.int64)
+        hi = np.minimum(self.bins[k + 1].astype(np.int64) + 1, last + 1)
+        # bisect all energies at once within their bins, a few steps since bins hold few points
+        while True:
+            searching = hi - lo > 1
+            if not searching.any():
+                break
+            mid = (lo + hi) // 2
+            below = searching & ((self.E[mid] < e) if side == 'left' else (self.E[mid] <= e))
+            lo = np.where(below, mid, lo)
+            hi = np.where(searching & ~below, mid, hi)
+        # the bin edges are rounded and may fall on repeated energies, so an energy can end up an interval or two
+        # off its own: step there, to the last interval E[i] <= e (or E[i] < e) holds for
+        while True:
+            if side == 'left':
+                down = (lo > 0) & (self.E[lo] >= e)
+                up = (lo < last) & ~(self.E[lo + 1] >= e)
+            else:
+                down = (lo > 0) & (self.E[lo] > e)
+                up = (lo < last) & ~(self.E[lo + 1] > e)
+            if not (down.any() or up.any()):
+                return lo
+            lo = lo - down + up
+
+    # Cross sections of every reaction at the energies, as an array of shape (reactions, energies), rows in MTs order.
+    # A reaction is 0 below its start index and every reaction is 0 outside the grid. At a discontinuity side picks
+    # the values right of it, as CrossSection.evaluate does, or left of it
+    def lookup(self, energies, side: str = 'right') -> np.ndarray:
+        e = np.asarray(energies, dtype=np.float64)
+        i = self.index(e, side)
+        starts = self.starts.astype(np.int64)[:, None]
+        inside = (i >= starts) & ((e >= self.E[0]) & (e <= self.E[-1]))
+        at = self.offsets[:, None] + np.maximum(i - starts, 0)
+        # a reaction starting at the last grid point has one value, the end of the grid clips onto it
+        last = self.offsets + len(self.E) - self.starts - 1
+        y0 = self.XS[np.minimum(at, last[:, None])]
+        y1 = self.XS[np.minimum(at + 1, last[:, None])]
+        x0, x1 = self.E[i], self.E[i + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = y0 + (y1 - y0)*np.where(x1 > x0, (e - x0)/(x1 - x0), 1.0 if side == 'right' else 0.0)
+        return np.where(inside, values, 0.0)
+
+    # Cross section of one reaction on the whole grid, 0 below its start index
+    def getReaction(self, MT: int) -> np.ndarray:
+        r = np.flatnonzero(self.MTs == MT)
+        if not len(r):
+            raise Exception("MT %s is not in the union grid" % (MT))
+        r = r[0]
+        values = np.zeros(len(self.E))
+        values[self.starts[r]:] = self.XS[self.offsets[r]:self.offsets[r] + len(self.E) - self.starts[r]]
+        return values
+
+    # The grid as a dict of compact arrays, e.g. for np.savez; fromArrays restores it
+    def toArrays(self) -> dict:
+        arrays = {"E": self.E, "MT": self.MTs, "start": self.starts, "XS": self.XS}
+        if self.bins is not None:
+            arrays["bins"] = self.bins
+        return arrays
+
+    @classmethod
+    def fromArrays(cls, arrays) -> 'UnionGrid':
+        return cls(arrays["E"], arrays["MT"], arrays["start"], arrays["XS"], arrays["bins"] if "bins" in arrays else None)
+
+    def save(self, path: str) -> None:
+        np.savez(path, **self.toArrays())
+
+    @classmethod
+    def load(cls, path: str) -> 'UnionGrid':
+        with np.load(path) as arrays:
+            return cls.fromArrays(arrays)
+
+    # Store the grid as one UnionGrid row of packed arrays, unless the material already has one
+    def persist(self, conn: DBConnection, material_key: int, library_key: int) -> None:
+        res = conn.execute("SELECT 1 FROM UnionGrid WHERE material_key=%s and library_key=%s", [material_key, library_key])
+        if res:
+            return
+        bins = self.bins if self.bins is not None else np.empty(0, dtype=np.int32)
+        blobs = [pack_array(self.E, "<f8"), pack_array(self.MTs, "<i4"), pack_array(self.starts, "<i4"),
+                 pack_array(self.XS, "<f8"), pack_array(bins, "<i4")]
+        with metrics.timer("insert.UnionGrid", 1, sum(len(blob) for blob in blobs)):
+            conn.execute("INSERT INTO UnionGrid(material_key,library_key,compression,NE,NX,NB,Energy,MT,StartIndex,CrossSection,BinIndex) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                         [material_key, library_key, DB.xs_compression, len(self.E), len(self.MTs), len(bins)] + blobs)
+
+# Values of the lin-lin table (X, Y) at the energies, left or right of a discontinuity by side,
+# its first and last value outside the table
+def _linear(X: np.ndarray, Y: np.ndarray, e: np.ndarray, side: str) -> np.ndarray:
+    i = np.clip(np.searchsorted(X, e, side=side) - 1, 0, len(X) - 2)
+    x0, x1, y0, y1 = X[i], X[i + 1], Y[i], Y[i + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(x1 > x0, np.clip((e - x0)/(x1 - x0), 0.0, 1.0), 1.0 if side == 'right' else 0.0)
+    return y0 + (y1 - y0)*fraction
+
+# Read the persisted union grid of a material, None if it has none
+def read_union_grid(conn: DBConnection, material_key: int, library_key: int) -> UnionGrid:
+    res = conn.execute("SELECT compression,Energy,MT,StartIndex,CrossSection,BinIndex FROM UnionGrid WHERE material_key=%s and library_key=%s",
+                       [material_key, library_key])
+    if not res:
+        return None
+    compression, E, MTs, starts, XS, bins = res[0]
+    return UnionGrid(unpack_array(E, "<f8", compression), unpack_array(MTs, "<i4", compression), unpack_array(starts, "<i4", compression),
+                     unpack_array(XS, "<f8", compression), unpack_array(bins, "<i4", compression))
+
+# Build the union grid of a material from its cross sections in the database, None if it has no MF3 reactions
+def build_union_grid(conn: DBConnection, material_key: int, library_key: int, nBins: int = 0,
+                     tolerance: float = DEFAULT_TOLERANCE) -> UnionGrid:
+    res = conn.execute("SELECT MT FROM CrossSectionInfo WHERE material_key=%s and library_key=%s ORDER BY MT",
+                       [material_key, library_key])
+    tables = {}
+    for (MT,) in res:
+        table = CrossSection.read_cross_section(conn, material_key, library_key, MT)
+        if table is not None and len(table[2]) >= 2:
+            tables[int(MT)] = table
+    if not tables:
+        return None
+    return UnionGrid.build(tables, nBins, tolerance)
+
+# Union grids used recently by this process, by (material_key, library_key)
+union_grid_cache = CrossSection.TableCache(32)
+
+# Union grid of a material from the cache, the UnionGrid table or else built from its cross sections.
+# A grid whose hash table has another number of bins than asked for is returned as a copy hashed again,
+# the cached grid is shared by the threads of the process and never changed
+def get_union_grid(conn: DBConnection, material_key: int, library_key: int, nBins: int = 0,
+                   tolerance: float = DEFAULT_TOLERANCE) -> UnionGrid:
+    key = (material_key, library_key)
+    grid = union_grid_cache.get(key)
+    if grid is None:
+        grid = read_union_grid(conn, material_key, library_key)
+        if grid is None:
+            grid = build_union_grid(conn, material_key, library_key, nBins, tolerance)
+        if grid is None:
+            return None
+        union_grid_cache.put(key, grid)
+    if (0 if grid.bins is None else len(grid.bins) - 1) != max(nBins, 0):
+        grid = UnionGrid(grid.E, grid.MTs, grid.starts, grid.XS)
+        grid.hash(nBins)
+    return grid
@@ -0,0 +1,102 @@
+-- Bring a database created from an older ENDF_ddl.sql up to date, safe to run again.
+-- MariaDB; an SQLite database is upgraded by deleting it, it is created again on first use
+
+-- Files: size, mtime, content hash and ingestion settings of each ingested file for incremental runs.
+-- Files ingested before settings_hash existed have none, so the next incremental run ingests them again
+ALTER TABLE `Files`
+  ADD COLUMN IF NOT EXISTS `size` bigint(20) DEFAULT NULL COMMENT 'bytes, uncompressed size for zip members',
+  ADD COLUMN IF NOT EXISTS `mtime` double DEFAULT NULL COMMENT 'modification time in seconds since the epoch',
+  ADD COLUMN IF NOT EXISTS `content_hash` char(64) DEFAULT NULL COMMENT 'SHA-256 of the contents, set once every material of the file was persisted without errors',
+  ADD COLUMN IF NOT EXISTS `settings_hash` char(64) DEFAULT NULL COMMENT 'SHA-256 of the section filter, linearization, union grid and storage settings the file was persisted with',
+  ADD KEY IF NOT EXISTS `ix_Files_name_path` (`name`,`path`);
+
+-- Material: ELIS rounded to 0.01 eV, which materials are matched on
+ALTER TABLE `Material`
+  ADD COLUMN IF NOT EXISTS `ELIS_key` decimal(12,2) NOT NULL DEFAULT 0 COMMENT 'ELIS rounded to 0.01 eV, materials are told apart by it' AFTER `ELIS`;
+UPDATE `Material` SET `ELIS_key`=round(`ELIS`,2);
+ALTER TABLE `Material` ALTER COLUMN `ELIS_key` DROP DEFAULT;
+
+-- unique natural keys of Library, Material and CrossSectionInfo, so parallel workers share one row per key.
+-- The natural key of Material used to be on ELIS itself, it is created again on ELIS_key.
+-- These fail while duplicates exist, list them with
+--   SELECT NLIB,NSUB,NVER,LREL,NFOR,count(*) FROM Library GROUP BY NLIB,NSUB,NVER,LREL,NFOR HAVING count(*)>1;
+--   SELECT MAT,AWR,LFI,LIS,LISO,ELIS_key,STA,count(*) FROM Material GROUP BY MAT,AWR,LFI,LIS,LISO,ELIS_key,STA HAVING count(*)>1;
+--   SELECT MT,material_key,library_key,count(*) FROM CrossSectionInfo GROUP BY MT,material_key,library_key HAVING count(*)>1;
+-- and point the rows referring to the duplicates at one of them before deleting the others
+ALTER TABLE `Library`
+  ADD UNIQUE KEY IF NOT EXISTS `ux_Library_natural` (`NLIB`,`NSUB`,`NVER`,`LREL`,`NFOR`);
+ALTER TABLE `Material`
+  DROP KEY IF EXISTS `ux_Material_natural`;
+ALTER TABLE `Material`
+  ADD UNIQUE KEY IF NOT EXISTS `ux_Material_natural` (`MAT`,`AWR`,`LFI`,`LIS`,`LISO`,`ELIS_key`,`STA`);
+ALTER TABLE `CrossSectionInfo`
+  ADD UNIQUE KEY IF NOT EXISTS `ux_CrossSectionInfo_natural` (`MT`,`material_key`,`library_key`),
+  DROP KEY IF EXISTS `ix_crosssection_mt_mat_lib`;
+
+-- tables added since
+CREATE TABLE IF NOT EXISTS `CrossSectionBlob` (
+  `crosssectioninfo_key` int(11) NOT NULL,
+  `compression` varchar(10) NOT NULL COMMENT 'none or zlib (byte shuffled)',
+  `NR` smallint(6) NOT NULL,
+  `NP` mediumint(9) NOT NULL,
+  `NBT` blob NOT NULL COMMENT 'int32 little-endian',
+  `InterpolationScheme` blob NOT NULL COMMENT 'int32 little-endian',
+  `Energy` longblob NOT NULL COMMENT 'eV, float64 little-endian',
+  `CrossSection` longblob NOT NULL COMMENT 'barns, float64 little-endian',
+  PRIMARY KEY (`crosssectioninfo_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE IF NOT EXISTS `UnionGrid` (
+  `material_key` int(11) NOT NULL,
+  `library_key` int(11) NOT NULL,
+  `compression` varchar(10) NOT NULL COMMENT 'none or zlib (byte shuffled)',
+  `NE` mediumint(9) NOT NULL COMMENT 'points of the unionized energy grid',
+  `NX` smallint(6) NOT NULL COMMENT 'reactions',
+  `NB` mediumint(9) NOT NULL COMMENT 'entries of the log-energy hash table, bins + 1, 0 without one',
+  `Energy` longblob NOT NULL COMMENT 'eV, float64 little-endian',
+  `MT` blob NOT NULL COMMENT 'int32 little-endian',
+  `StartIndex` blob NOT NULL COMMENT 'int32 little-endian, first grid point of each reaction',
+  `CrossSection` longblob NOT NULL COMMENT 'barns, float64 little-endian, each reaction from its start index to the end of the grid',
+  `BinIndex` blob NOT NULL COMMENT 'int32 little-endian, grid interval at the lower edge of each hash bin',
+  PRIMARY KEY (`material_key`,`library_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE IF NOT EXISTS `DerivedEvaluation` (
+  `id` int(11) NOT NULL,
+  `material_key` int(11) NOT NULL,
+  `library_key` int(11) NOT NULL,
+  `TEMP` float NOT NULL COMMENT 'Target temperature (Kelvin) the cross sections were Doppler broadened to',
+  `LDRV` smallint(6) NOT NULL COMMENT 'Special derived material flag, LDRV≥ 1 for derived evaluations',
+  `Description` varchar(500) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  KEY `ix_DerivedEvaluation_mat_lib` (`material_key`,`library_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE IF NOT EXISTS `DerivedCrossSection` (
+  `derived_key` int(11) NOT NULL,
+  `MT` smallint(6) NOT NULL,
+  `compression` varchar(10) NOT NULL COMMENT 'none or zlib (byte shuffled)',
+  `NP` mediumint(9) NOT NULL COMMENT 'points of the lin-lin table',
+  `Energy` longblob NOT NULL COMMENT 'eV, float64 little-endian',
+  `CrossSection` longblob NOT NULL COMMENT 'barns, float64 little-endian',
+  PRIMARY KEY (`derived_key`,`MT`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE IF NOT EXISTS `GroupStructure` (
+  `structure` char(64) NOT NULL COMMENT 'SHA-256 of the boundaries as float64 little-endian',
+  `NG` mediumint(9) NOT NULL COMMENT 'groups',
+  `Bounds` blob NOT NULL COMMENT 'eV, float64 little-endian, the NG+1 ascending group boundaries',
+  PRIMARY KEY (`structure`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
+
+CREATE TABLE IF NOT EXISTS `GroupCrossSection` (
+  `material_key` int(11) NOT NULL,
+  `library_key` int(11) NOT NULL,
+  `MT` smallint(6) NOT NULL,
+  `structure` char(64) NOT NULL COMMENT 'GroupStructure of the groups',
+  `weight` varchar(100) NOT NULL COMMENT 'flat, 1/E, E^q or table:<SHA-256 of the weight TAB1>:<linearization tolerance>',
+  `compression` varchar(10) NOT NULL COMMENT 'none or zlib (byte shuffled)',
+  `NG` mediumint(9) NOT NULL COMMENT 'groups',
+  `CrossSection` blob NOT NULL COMMENT 'barns, float64 little-endian, one value per group',
+  PRIMARY KEY (`material_key`,`library_key`,`MT`,`structure`,`weight`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1 COLLATE=latin1_general_ci;
@@ -6,4 +6,10 @@ TRUNCATE TABLE `Material`;
 TRUNCATE TABLE `Directory`;
 TRUNCATE TABLE `Files`;
 TRUNCATE TABLE `Interpolation`;
+TRUNCATE TABLE `CrossSectionBlob`;
+TRUNCATE TABLE `UnionGrid`;
+TRUNCATE TABLE `DerivedEvaluation`;
+TRUNCATE TABLE `DerivedCrossSection`;
+TRUNCATE TABLE `GroupStructure`;
+TRUNCATE TABLE `GroupCrossSection`;
 alter sequence`id_seq` restart 1;
\ No newline at end of file
@@ -0,0 +1,34 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ENDFGenerator import TapeWriter, write_material
+
+# ENDF with its library in a scratch directory and a scratch SQLite database. ENDF reads ENDF.properties
+# from the working directory when first imported, the library directory is set again for every test
+@pytest.fixture
+def endf(tmp_path, monkeypatch):
+    library = tmp_path / "lib"
+    library.mkdir()
+    (tmp_path / "ENDF.properties").write_text("[endf]\nlibrary_dir = %s\n" % (library))
+    monkeypatch.chdir(tmp_path)
+    import DB
+    DB.set_backend("sqlite", str(tmp_path / "ENDF.sqlite"))
+    import ENDF
+    monkeypatch.setattr(ENDF, "endf_library", str(library))
+    yield ENDF
+    DB.set_backend("sqlite", str(tmp_path / "ENDF.sqlite"))
+
+# Write a tape of one material with an MF3 section per MT of the (X, Y) lin-lin tables, returning its ingestion job
+def write_tape(path, MTs: list, tables: list, LRP: int = 0, MAT: int = 100, ELIS: float = 0.0) -> tuple:
+    with open(path, "w") as file:
+        tape = TapeWriter(file)
+        tape.record("test tape", 1, 0, 0)
+        write_material(tape, MAT, 1002.0, 1.98334, MTs,
+                       [(np.array([len(X)]), np.array([2]), np.asarray(X, dtype=float), np.asarray(Y, dtype=float)) for X, Y in tables], LRP, ELIS)
+        tape.record("", -1, 0, 0)
+    stat = os.stat(path)
+    return (str(path), None, stat.st_size, stat.st_mtime, None)
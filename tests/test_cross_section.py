@@ -0,0 +1,65 @@
+import math
+import numpy as np
+import pytest
+import CrossSection
+
+# scalar ENDF interpolation of a TAB1 at e: 0 outside the table, the right value at a discontinuity
+def reference(table: tuple, e: float) -> float:
+    NBT, INT, X, Y = table
+    if e < X[0] or e > X[-1]:
+        return 0.0
+    i = 0
+    while i + 2 < len(X) and X[i + 1] <= e:
+        i += 1
+    law = INT[next(r for r in range(len(NBT)) if NBT[r] >= i + 2)]
+    x0, x1, y0, y1 = X[i], X[i + 1], Y[i], Y[i + 1]
+    if x1 == x0:
+        return y0
+    if law == 1:
+        return y0 if e < x1 else y1
+    if law == 2:
+        return y0 + (y1 - y0)*(e - x0)/(x1 - x0)
+    if law == 3:
+        return y0 + (y1 - y0)*math.log(e/x0)/math.log(x1/x0)
+    if law == 4:
+        return y0*math.exp(math.log(y1/y0)*(e - x0)/(x1 - x0))
+    return y0*math.exp(math.log(y1/y0)*math.log(e/x0)/math.log(x1/x0))
+
+# five regions, one per law, with a histogram step and a discontinuity at 20 eV
+TABLE = (np.array([4, 7, 10, 13, 16]), np.array([1, 2, 3, 4, 5]),
+         np.array([1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 20.0, 34.0, 55.0, 89.0, 144.0, 233.0, 377.0, 610.0, 987.0]),
+         np.array([4.0, 9.0, 2.0, 6.0, 3.0, 7.0, 5.0, 11.0, 1.0, 8.0, 12.0, 2.0, 9.0, 0.5, 4.0, 6.0]))
+
+@pytest.mark.parametrize("law", [1, 2, 3, 4, 5])
+def test_evaluate_each_law_against_scalar_reference(law):
+    X = TABLE[2]
+    table = (np.array([len(X)]), np.array([law]), X, TABLE[3])
+    E = np.concatenate((np.exp(np.random.default_rng(law).uniform(np.log(0.5), np.log(2000.0), 2000)), X))
+    values = CrossSection.evaluate(table, E)
+    expected = np.array([reference(table, e) for e in E])
+    np.testing.assert_allclose(values, expected, rtol=1e-12, atol=0)
+
+def test_evaluate_regions_steps_and_outside():
+    E = np.concatenate((np.exp(np.random.default_rng(0).uniform(np.log(0.5), np.log(2000.0), 5000)), TABLE[2],
+                        [0.0, 0.999999, 987.000001, 1e7, 1.5, 2.0, 20.0]))
+    values = CrossSection.evaluate(TABLE, E)
+    np.testing.assert_allclose(values, [reference(TABLE, e) for e in E], rtol=1e-12, atol=0)
+    # the histogram keeps its left value up to the next point, the discontinuity takes its right value
+    assert CrossSection.evaluate(TABLE, [1.999999, 2.0, 20.0])[:2].tolist() == [4.0, 9.0]
+    assert CrossSection.evaluate(TABLE, [20.0])[0] == 11.0
+    assert CrossSection.evaluate(TABLE, [0.999999, 987.000001]).tolist() == [0.0, 0.0]
+
+@pytest.mark.parametrize("law", [1, 2, 3, 4, 5])
+@pytest.mark.parametrize("q", [0.0, -1.0, 0.5])
+@pytest.mark.parametrize("ends", [(2.0, 5.0), (5.0, 2.0), (-2.0, 5.0), (2.0, -5.0), (0.0, 5.0), (3.0, 0.0)])
+def test_integrate_matches_quadrature_of_interpolate(law, q, ends):
+    y0, y1 = ends
+    x0, x1 = 1.0, 10.0
+    t, w = np.polynomial.legendre.leggauss(400)
+    u = np.log(x1/x0)*(t + 1)/2
+    e = x0*np.exp(u)
+    n = len(e)
+    values = CrossSection.interpolate(np.full(n, law), np.full(n, x0), np.full(n, x1), np.full(n, y0), np.full(n, y1), e)
+    expected = np.sum(w*values*e**(q + 1))*np.log(x1/x0)/2
+    result = CrossSection.integrate(np.array([law]), [x0], [x1], [y0], [y1], q)[0]
+    assert result == pytest.approx(expected, rel=1e-9, abs=1e-12)
@@ -0,0 +1,154 @@
+import sqlite3
+import numpy as np
+import pytest
+import DB
+from conftest import write_tape
+
+def test_connection_backends_implement_the_abstract_methods():
+    with pytest.raises(TypeError):
+        DB.DBConnection()
+    class Partial(DB.DBConnection):
+        def start_transaction(self) -> None:
+            pass
+        def in_transaction(self) -> bool:
+            return False
+        def is_connected(self) -> bool:
+            return False
+    with pytest.raises(TypeError, match="_reserve_ids"):
+        Partial()
+    for backend in DB.BACKENDS.values():
+        assert not backend.__abstractmethods__
+
+MATERIAL_INSERT = ("INSERT INTO Material(id,MAT,Z,A,AWR,LFI,LIS,LISO,ELIS,ELIS_key,STA) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) "
+                   "ON DUPLICATE KEY UPDATE id=id")
+MATERIAL_SELECT = "SELECT id from Material where MAT=%s and AWR=%s and LFI=%s and LIS=%s and LISO=%s and ELIS_key=%s and STA=%s"
+
+# materials whose ELIS round to the same 0.01 eV share a row, also when the key cache does not know them
+def test_materials_are_keyed_on_rounded_elis(endf, tmp_path):
+    X = np.geomspace(1e-5, 2e7, 20)
+    for name, ELIS in [("a", 0.001), ("b", 0.004), ("c", 0.02)]:
+        DB.key_cache.clear()
+        endf.ingest(write_tape(tmp_path / "lib" / ("%s.dat" % (name)), [1], [(X, np.ones(len(X)))], ELIS=ELIS))
+    conn = DB.DBConnection.getConnection()
+    rows = conn.execute("SELECT ELIS,ELIS_key FROM Material ORDER BY ELIS")
+    assert [(round(ELIS, 6), float(key)) for ELIS, key in rows] == [(0.001, 0.0), (0.02, 0.02)]
+    assert conn.execute("SELECT COUNT(*) FROM CrossSectionInfo")[0][0] == 2
+
+def test_insert_or_select_keeps_the_first_row(endf):
+    conn = DB.DBConnection.getConnection()
+    lookup = DB.material_lookup(100, 1.98334, 0, 0, 0, 0.004, 0)
+    binds = [100, 1, 2, 1.98334, 0, 0, 0, 0.004, lookup[5], 0]
+    first, inserted = conn.insertOrSelect(MATERIAL_SELECT, list(lookup), MATERIAL_INSERT, binds)
+    assert inserted
+    # another connection inserting the same key meanwhile: the insert keeps the row there is
+    conn.execute(MATERIAL_INSERT, [first + 1000] + binds)
+    assert conn.cursor.rowcount == 0
+    assert conn.insertOrSelect(MATERIAL_SELECT, list(lookup), MATERIAL_INSERT, binds) == (first, False)
+    assert conn.execute("SELECT COUNT(*) FROM Material")[0][0] == 1
+    # other errors are not ignored, as they were with INSERT IGNORE
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute(MATERIAL_INSERT, [first + 2000, None] + binds[1:])
+    # CrossSectionInfo is keyed on its natural key too
+    insert = "INSERT INTO CrossSectionInfo(id,MT,material_key,library_key,ZA,AWR,QM,QI,LR,NR,NP) VALUES(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+    conn.execute(insert, [1, 102, first, 7, 1002, 1.98334, 0, 0, 0, 1, 2])
+    with pytest.raises(sqlite3.IntegrityError):
+        conn.execute(insert, [2, 102, first, 7, 1002, 1.98334, 0, 0, 0, 1, 2])
+    conn.rollback()
+
+# keys found by a transaction are read back by it before they are committed, hidden from other connections
+# and dropped again when it rolls back, to its savepoints too
+def test_pending_keys_are_read_by_their_own_transaction(endf):
+    conn = DB.DBConnection.getConnection()
+    other = DB.DBConnection.checkout()
+    try:
+        hits = DB.key_cache.hits
+        conn.start_transaction()
+        conn.cacheKey("Library", ("a",), 1)
+        assert conn.getKey("Library", ("a",)) == 1
+        assert DB.key_cache.hits == hits + 1
+        assert other.getKey("Library", ("a",)) is None
+        conn.savepoint("material")
+        conn.cacheKey("Library", ("b",), 2)
+        conn.rollbackToSavepoint("material")
+        assert conn.getKey("Library", ("b",)) is None
+        assert conn.getKey("Library", ("a",)) == 1
+        conn.rollback()
+        assert conn.getKey("Library", ("a",)) is None
+        assert ("Library", ("a",)) not in DB.key_cache
+
+        conn.start_transaction()
+        conn.cacheKey("Library", ("c",), 3)
+        conn.commit()
+        assert other.getKey("Library", ("c",)) == 3
+    finally:
+        DB.DBConnection.checkin(other)
+
+# a second tape of a material in the same transaction finds all its keys, and only that material's reactions are loaded
+def test_key_cache_within_one_transaction(endf, tmp_path, monkeypatch):
+    monkeypatch.setattr(endf, "commit_materials", 100)
+    X = np.geomspace(1e-5, 2e7, 20)
+    tables = [(X, np.ones(len(X)))]*3
+    endf.ingest(write_tape(tmp_path / "lib" / "other.dat", [1, 2, 102], tables, MAT=200))
+    endf.group.commit(DB.DBConnection.getConnection())
+    DB.key_cache.clear()
+
+    first = endf.ingest(write_tape(tmp_path / "lib" / "a.dat", [1, 2, 102], tables))
+    second = endf.ingest(write_tape(tmp_path / "lib" / "b.dat", [1, 2, 102], tables))
+    assert DB.DBConnection.getConnection().in_transaction()
+    assert first["key_hits"] == 0
+    assert second["key_hits"] >= 5 and second["key_misses"] == 0
+    endf.group.commit(DB.DBConnection.getConnection())
+    material = DB.DBConnection.getConnection().execute("SELECT id FROM Material WHERE MAT=200")[0][0]
+    assert not [key for key in DB.key_cache._keys if key[0] == "CrossSectionInfo" and key[1][1] == material]
+
+# hands out blocks of 10 ids out of order, some adjacent to the previous reservation and some not,
+# and fewer blocks than asked for every other time
+class BlockReserver():
+    def __init__(self, seed: int):
+        self.rng = np.random.default_rng(seed)
+        self.next_val = 1
+        self.calls = 0
+        self.blocks = []
+
+    def _reserve_ids(self, nIds: int) -> tuple:
+        self.calls += 1
+        nBlocks = -(-nIds // 10)
+        if self.calls % 2 == 0 and nBlocks > 1:
+            nBlocks -= 1
+        starts = []
+        for _ in range(nBlocks):
+            self.next_val += 10*int(self.rng.integers(0, 3))
+            starts.append(self.next_val)
+            self.next_val += 10
+        self.blocks += starts
+        return list(self.rng.permutation(starts)), 10
+
+@pytest.mark.parametrize("seed", range(5))
+def test_id_pool_never_hands_out_an_id_twice(seed):
+    reserver = BlockReserver(seed)
+    pool = DB.IdPool()
+    taken = []
+    for nIds in np.random.default_rng(seed).integers(1, 45, 200).tolist():
+        ids = pool.take(reserver, nIds)
+        assert ids.dtype == np.int64 and len(ids) == nIds
+        taken.append(ids)
+    taken = np.concatenate(taken)
+    assert len(np.unique(taken)) == len(taken)
+    reserved = np.concatenate([np.arange(start, start + 10) for start in reserver.blocks])
+    assert np.all(np.isin(taken, reserved))
+    assert len(pool) + len(taken) == len(reserved)
+
+# connections each reserve their own blocks of the shared sequence
+def test_connections_draw_disjoint_ids(endf):
+    conn = DB.DBConnection.getConnection()
+    other = DB.DBConnection.checkout()
+    try:
+        ids = []
+        for nIds in [1, DB.SQLITE_ID_BLOCK + 1, 3, 2*DB.SQLITE_ID_BLOCK]:
+            for dbconn in (conn, other):
+                ids.append(dbconn.idPool().take(dbconn, nIds))
+                dbconn.commit()
+        ids = np.concatenate(ids)
+        assert len(np.unique(ids)) == len(ids)
+    finally:
+        DB.DBConnection.checkin(other)
@@ -0,0 +1,50 @@
+import numpy as np
+from ENDFParser import decode_floats, decode_ints, parseFloat, read_block
+
+# fields as they appear in ENDF-6 tapes, 11 columns each
+FLOAT_FIELDS = [" 1.234567+5", "-1.2345-10", " 1.0E+05", "", "         12", " 1.0D+05", "1.5e+10",
+                "1.234567 +5", "-0.0", " 0.000000+0", "+9.999999+9", "-7.654321-1", "9.99999+10", "1.00000-11",
+                " 5.", "-3", "       .25", "1.0+0", "   12345678", " 6.02214+23", "1.0 E 5"]
+INT_FIELDS = ["          0", "          1", "         -1", "", "  123456789", " -987654321", "+42", "7"]
+
+def line(fields: list) -> str:
+    return "".join(field.rjust(11) for field in fields).ljust(66)
+
+# the scalar parser records were decoded with before, blank fields read as 0
+def reference_floats(fields: list) -> list:
+    return [parseFloat(field) if field.strip() else 0.0 for field in fields]
+
+def test_decode_floats_matches_parse_float():
+    fields = FLOAT_FIELDS + [""]*(-len(FLOAT_FIELDS) % 6)
+    lines = [line(fields[i:i+6]) for i in range(0, len(fields), 6)]
+    decoded = decode_floats(lines)
+    np.testing.assert_array_equal(decoded, reference_floats(fields))
+    assert decoded.dtype == np.float64
+
+def test_decode_floats_of_a_record_block_and_count():
+    fields = FLOAT_FIELDS[:6]
+    record = (line(fields) + "9228 3  1    1\n").encode("ISO-8859-1")
+    block = read_block(record*3)
+    np.testing.assert_array_equal(decode_floats(block, 14), (reference_floats(fields)*3)[:14])
+
+def test_decode_floats_of_random_values():
+    rng = np.random.default_rng(0)
+    values = rng.choice([-1, 1], 600)*10.0**rng.uniform(-30, 30, 600)
+    fields = []
+    for value in values:
+        mantissa, exponent = ("%.6E" % value).split("E")
+        exponent = int(exponent)
+        fields.append(("%s%+d" % (mantissa, exponent)) if abs(exponent) < 10 else ("%.5E" % value).replace("E", ""))
+    lines = [line(fields[i:i+6]) for i in range(0, len(fields), 6)]
+    np.testing.assert_array_equal(decode_floats(lines), reference_floats(fields))
+
+def test_decode_floats_of_lower_case_d_exponents():
+    # parseFloat only knew an upper case D
+    np.testing.assert_array_equal(decode_floats(line([" 2.5d-3", "-1.0d+05"]), 2), [2.5e-3, -1.0e5])
+
+def test_decode_ints_matches_int():
+    fields = INT_FIELDS + [""]*(-len(INT_FIELDS) % 6)
+    lines = [line(fields[i:i+6]) for i in range(0, len(fields), 6)]
+    decoded = decode_ints(lines)
+    np.testing.assert_array_equal(decoded, [int(field) if field.strip() else 0 for field in fields])
+    assert decoded.dtype == np.int64
@@ -0,0 +1,70 @@
+import math
+import numpy as np
+import Doppler
+from ENDFGenerator import synthetic_table
+
+# bound on the tabulated erfc given in Doppler
+ERFC_ERROR = 2e-13
+
+def reference_erfc(a: np.ndarray) -> np.ndarray:
+    return np.array([math.erfc(t) for t in a])
+
+def test_erfc_table_over_broadening_arguments(monkeypatch):
+    arguments = []
+    erfc = Doppler._erfc
+    def recording_erfc(a):
+        arguments.append(np.array(a, dtype=np.float64).ravel())
+        return erfc(a)
+    monkeypatch.setattr(Doppler, "_erfc", recording_erfc)
+    table = synthetic_table(np.random.default_rng(0), 2000, 3)
+    Doppler.broaden(table, 235.0, 1200.0, 293.6)
+    Doppler.broaden(table, 1.0, 3000.0)
+
+    used = np.concatenate(arguments)
+    sample = used[np.random.default_rng(1).choice(len(used), min(len(used), 200000), replace=False)]
+    assert np.abs(erfc(sample) - reference_erfc(sample)).max() < ERFC_ERROR
+    # and everywhere the table is interpolated between the smallest and largest argument, on a grid finer than it
+    a = np.linspace(max(used.min(), -Doppler.ERFC_RANGE), min(used.max(), Doppler.ERFC_RANGE), 1000001)
+    assert np.abs(erfc(a) - reference_erfc(a)).max() < ERFC_ERROR
+
+def test_erfc_table_beyond_its_range():
+    a = np.array([-50.0, -Doppler.ERFC_RANGE - 1e-9, Doppler.ERFC_RANGE + 1e-9, 50.0])
+    assert np.abs(Doppler._erfc(a) - reference_erfc(a)).max() < 3e-17
+
+# what the CUTOFF leaves out of the kernel, relative to the broadened value
+CUTOFF_ERROR = 2e-6
+
+def lin_lin(X: np.ndarray, Y: np.ndarray) -> tuple:
+    return (np.array([len(X)]), np.array([2]), X, Y)
+
+# a 1/v cross section is unchanged by broadening, up to the lin-lin representation of 1/v, within 2e-6 on this grid,
+# and the cutoff. Near the top of the table the constant extension above it takes over
+def test_broaden_keeps_inverse_v():
+    X = np.geomspace(1e-5, 1e7, 6000)
+    Y = 3.0/np.sqrt(X)
+    for AWR, T0, T in [(1.0, 0.0, 3000.0), (235.0, 293.6, 1200.0)]:
+        NBT, INT, BX, BY = Doppler.broaden(lin_lin(X, Y), AWR, T, T0)
+        assert NBT.dtype == np.int64 and np.array_equal(BX, X)
+        below = X < X[-1]/2
+        np.testing.assert_allclose(BY[below], Y[below], rtol=2e-6 + CUTOFF_ERROR)
+
+# a constant s0 broadens to s0*((1 + 1/(2y^2))*erf(y) + exp(-y^2)/(sqrt(pi)*y)) with y^2 = AWR*E/(k*T)
+def test_broaden_constant_matches_analytic():
+    X = np.geomspace(1e-8, 1e7, 400)
+    for AWR, T in [(1.0, 3000.0), (235.0, 1200.0)]:
+        BY = Doppler.broaden(lin_lin(X, np.full(len(X), 2.0)), AWR, T)[3]
+        y = np.sqrt(AWR*X/(Doppler.BOLTZMANN*T))
+        expected = np.array([2.0*((1 + 1/(2*v*v))*math.erf(v) + math.exp(-v*v)/(math.sqrt(math.pi)*v)) for v in y])
+        np.testing.assert_allclose(BY, expected, rtol=CUTOFF_ERROR)
+        # far above 0 the weight is about 1 and only the erfc(CUTOFF) tail is left out
+        far = y > 2*Doppler.CUTOFF
+        np.testing.assert_allclose(BY[far], expected[far], rtol=math.erfc(Doppler.CUTOFF))
+
+# energies of 0 are kept as they are, also when a table has no others
+def test_broaden_tables_without_positive_energies():
+    for X in [np.array([0.0, 0.0]), np.array([-1.0, 0.0, 0.0])]:
+        Y = np.arange(1.0, len(X) + 1)
+        NBT, INT, BX, BY = Doppler.broaden(lin_lin(X, Y), 1.0, 300.0)
+        assert NBT.tolist() == [len(X)] and BX.tolist() == X.tolist() and BY.tolist() == Y.tolist()
+    BY = Doppler.broaden(lin_lin(np.array([0.0, 1.0, 2.0]), np.array([5.0, 1.0, 1.0])), 1.0, 300.0)[3]
+    assert BY[0] == 5.0 and np.all(np.isfinite(BY))
@@ -0,0 +1,137 @@
+import numpy as np
+from ENDFGenerator import REACTIONS
+from conftest import write_tape
+
+def test_failure_comment_of_many_invalid_sections(endf, tmp_path):
+    MTs = [REACTIONS[r % len(REACTIONS)] + 200*(r // len(REACTIONS)) for r in range(5*len(REACTIONS))]
+    X = np.geomspace(1e-5, 2e7, 50)
+    # every energy table steps back once
+    X[20], X[21] = X[21], X[20]
+    job = write_tape(tmp_path / "lib" / "bad.dat", MTs, [(X, np.full(len(X), 1.0))]*len(MTs))
+
+    result = endf.ingest(job)
+
+    conn = endf.DBConnection.getConnection()
+    comment, content_hash = conn.execute("SELECT comment,content_hash FROM Files")[0]
+    assert result["materials"] == 0 and content_hash is None
+    assert len(comment) <= endf.COMMENT_LENGTH
+    assert comment.startswith("Invalid: energy_order in %d sections: MAT 100 MF 3 MT 1 (" % (len(MTs)))
+    assert comment.endswith(", ...")
+    assert not conn.execute("SELECT 1 FROM GeneralInfo")
+
+def test_failure_comment_is_cut_to_column():
+    import ENDF
+    comment = ENDF.failure_comment("Persist", Exception("x"*5000))
+    assert len(comment) == ENDF.COMMENT_LENGTH
+    assert comment.startswith("Persist: xxx") and comment.endswith("...")
+
+def negative_background_tape(path, LRP: int) -> tuple:
+    X = np.geomspace(1e-5, 2e7, 50)
+    background = np.where((X > 1.0) & (X < 100.0), -2.5, 1.0)
+    return write_tape(path, [1, 2, 102], [(X, np.full(len(X), 3.0)), (X, background), (X, np.full(len(X), 2.0))], LRP)
+
+def test_negative_background_with_resonance_parameters_persists(endf, tmp_path):
+    import CrossSection
+    result = endf.ingest(negative_background_tape(tmp_path / "lib" / "lrp1.dat", 1))
+
+    conn = endf.DBConnection.getConnection()
+    assert result["materials"] == 1
+    assert conn.execute("SELECT comment FROM Files")[0][0] is None
+    material_key, library_key, LRP = conn.execute("SELECT material_key,library_key,LRP FROM GeneralInfo")[0]
+    assert LRP == 1
+    NBT, INT, X, Y = CrossSection.read_cross_section(conn, material_key, library_key, 2)
+    assert Y.min() == -2.5
+
+def test_negative_cross_section_without_resonance_parameters_is_rejected(endf, tmp_path):
+    result = endf.ingest(negative_background_tape(tmp_path / "lib" / "lrp0.dat", 0))
+
+    conn = endf.DBConnection.getConnection()
+    assert result["materials"] == 0
+    assert conn.execute("SELECT comment FROM Files")[0][0].startswith("Invalid: negative_xs in 1 sections: MAT 100 MF 3 MT 2 (")
+    assert not conn.execute("SELECT 1 FROM GeneralInfo")
+
+# a material failing after it wrote its rows is rolled back to its savepoint, the materials before and after it
+# in the same transaction are committed
+def test_failing_material_rolls_back_only_its_own_rows(endf, tmp_path, monkeypatch):
+    import DB
+    import ENDFParser
+    from ENDFGenerator import TapeWriter, write_material
+    X = np.geomspace(1e-5, 2e7, 40)
+    path = tmp_path / "lib" / "three.dat"
+    with open(path, "w") as file:
+        tape = TapeWriter(file)
+        tape.record("three materials", 1, 0, 0)
+        for MAT in [100, 101, 102]:
+            write_material(tape, MAT, 1000.0 + MAT, 1.0 + MAT/100, [1, 2], [(np.array([len(X)]), np.array([2]), X, np.full(len(X), float(MAT)))]*2)
+        tape.record("", -1, 0, 0)
+    persist = ENDFParser.ENDFMaterial.persist
+    def failing_persist(material):
+        persist(material)
+        if material.getMaterial() == 101:
+            raise Exception("disk full")
+    monkeypatch.setattr(ENDFParser.ENDFMaterial, "persist", failing_persist)
+    monkeypatch.setattr(endf, "commit_materials", 10)
+    stat = path.stat()
+
+    result = endf.ingest((str(path), None, stat.st_size, stat.st_mtime, None))
+    endf.group.commit(endf.DBConnection.getConnection())
+
+    conn = DB.DBConnection.getConnection()
+    assert result["materials"] == 2
+    assert sorted(MAT for (MAT,) in conn.execute("SELECT MAT FROM Material")) == [100, 102]
+    assert conn.execute("SELECT COUNT(*) FROM GeneralInfo")[0][0] == 2
+    assert conn.execute("SELECT COUNT(*) FROM CrossSectionInfo")[0][0] == 4
+    assert not conn.execute("SELECT 1 FROM CrossSectionInfo c LEFT JOIN Material m ON m.id=c.material_key WHERE m.id IS NULL")
+    comment, content_hash = conn.execute("SELECT comment,content_hash FROM Files")[0]
+    assert comment == "Persist: disk full" and content_hash is None
+    # the rolled back material's keys are not cached either
+    assert not [key for key in DB.key_cache._keys if key[0] == "Material" and key[1][0] == 101]
+
+# an unchanged file is skipped while the settings stay the same, a wider section filter or another linearization
+# ingests it again
+def test_skip_unchanged_follows_the_settings(endf, tmp_path, monkeypatch):
+    import DB
+    X = np.geomspace(1e-5, 2e7, 40)
+    job = write_tape(tmp_path / "lib" / "tape.dat", [1, 2, 102], [(X, np.ones(len(X)))]*3)
+    monkeypatch.setattr(endf, "sections", endf.parseSectionFilter("3:1"))
+    endf.ingest(job)
+    endf.group.commit(DB.DBConnection.getConnection())
+    conn = DB.DBConnection.getConnection()
+    assert conn.execute("SELECT COUNT(*) FROM CrossSectionInfo")[0][0] == 1
+    assert endf.skip_unchanged(conn, [job]) == []
+
+    # the same filter written differently
+    monkeypatch.setattr(endf, "sections", endf.parseSectionFilter("1:451;3:1"))
+    assert endf.skip_unchanged(conn, [job]) == []
+
+    monkeypatch.setattr(endf, "sections", None)
+    assert endf.skip_unchanged(conn, [job]) == [job]
+    endf.ingest(job)
+    endf.group.commit(conn)
+    assert conn.execute("SELECT COUNT(*) FROM CrossSectionInfo")[0][0] == 3
+    assert endf.skip_unchanged(conn, [job]) == []
+
+    monkeypatch.setattr(endf, "linearize_tolerance", 1e-3)
+    assert endf.skip_unchanged(conn, [job]) == [job]
+    monkeypatch.setattr(DB, "xs_storage", "packed")
+    monkeypatch.setattr(endf, "linearize_tolerance", 0)
+    assert endf.skip_unchanged(conn, [job]) == [job]
+
+# records that do not decode fail the material while parsing, before any of it is persisted
+def test_undecodable_section_is_a_parse_failure(endf, tmp_path):
+    import DB
+    X = np.geomspace(1e-5, 2e7, 20)
+    path = tmp_path / "lib" / "broken.dat"
+    job = write_tape(path, [1, 2], [(X, np.ones(len(X)))]*2)
+    lines = path.read_text().splitlines(True)
+    row = next(i for i, line in enumerate(lines) if line[66:80] == " 100 3  2    3")
+    lines[row] = "    twenty!" + lines[row][11:]
+    path.write_text("".join(lines))
+
+    result = endf.ingest(job)
+    endf.group.commit(DB.DBConnection.getConnection())
+    conn = DB.DBConnection.getConnection()
+    comment, content_hash = conn.execute("SELECT comment,content_hash FROM Files")[0]
+    assert comment.startswith("Parse: ") and content_hash is None
+    assert result["materials"] == 0
+    assert conn.execute("SELECT COUNT(*) FROM CrossSectionInfo")[0][0] == 0
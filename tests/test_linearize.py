@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import CrossSection
+
+# five regions, one per law, with a histogram step and a discontinuity at 20 eV
+TABLE = (np.array([4, 7, 10, 13, 16]), np.array([1, 2, 3, 4, 5]),
+         np.array([1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 20.0, 34.0, 55.0, 89.0, 144.0, 233.0, 377.0, 610.0, 987.0]),
+         np.array([4.0, 9.0, 2.0, 6.0, 3.0, 7.0, 5.0, 11.0, 1.0, 8.0, 12.0, 2.0, 9.0, 0.5, 4.0, 6.0]))
+
+def energies(table: tuple, seed: int) -> np.ndarray:
+    X = table[2]
+    return np.concatenate((np.exp(np.random.default_rng(seed).uniform(np.log(X[0]), np.log(X[-1]), 20000)), X))
+
+# the original points appear in the linearized table in their original order
+def assert_points_kept(table: tuple, linear: tuple):
+    X, Y = table[2], table[3]
+    LX, LY = linear[2], linear[3]
+    j = 0
+    for x, y in zip(X, Y):
+        while j < len(LX) and not (LX[j] == x and LY[j] == y):
+            j += 1
+        assert j < len(LX), (x, y)
+        j += 1
+
+@pytest.mark.parametrize("law", [2, 3, 4, 5])
+@pytest.mark.parametrize("tolerance", [1e-2, 1e-3, 1e-5])
+def test_linearize_within_tolerance(law, tolerance):
+    X = TABLE[2]
+    table = (np.array([len(X)]), np.array([law]), X, TABLE[3])
+    linear = CrossSection.linearize(table, tolerance)
+    E = energies(table, law)
+    exact = CrossSection.evaluate(table, E)
+    error = np.abs(CrossSection.evaluate(linear, E) - exact)
+    assert np.all(error <= tolerance*np.abs(exact) + 1e-12)
+    assert linear[2][0] == X[0] and linear[2][-1] == X[-1]
+    assert_points_kept(table, linear)
+
+# cross sections varying by up to a factor e^8 across one interval
+@pytest.mark.parametrize("law", [3, 4, 5])
+@pytest.mark.parametrize("seed", range(20))
+def test_linearize_random_tables_within_tolerance(law, seed):
+    rng = np.random.default_rng(seed)
+    X = np.sort(np.exp(rng.uniform(-2.0, 10.0, 12)))
+    table = (np.array([12]), np.array([law]), X, np.exp(rng.uniform(-4.0, 4.0, 12)))
+    E = energies(table, seed)
+    exact = CrossSection.evaluate(table, E)
+    for tolerance in [1e-1, 1e-2, 1e-3, 1e-4]:
+        linear = CrossSection.linearize(table, tolerance)
+        assert np.all(np.abs(CrossSection.evaluate(linear, E) - exact) <= tolerance*np.abs(exact))
+        assert_points_kept(table, linear)
+
+def test_linearize_regions_steps_and_discontinuities():
+    linear = CrossSection.linearize(TABLE, 1e-4)
+    NBT, INT, X, Y = linear
+    assert NBT.dtype == np.int64 and INT.dtype == np.int64
+    assert NBT.tolist() == [len(X)] and INT.tolist() == [CrossSection.LIN_LIN]
+    assert np.all(np.diff(X) >= 0)
+    assert_points_kept(TABLE, linear)
+    assert (X[0], Y[0], X[-1], Y[-1]) == (1.0, 4.0, 987.0, 6.0)
+
+    # the histogram steps become a constant segment and a vertical jump at the upper energy
+    for x, before, after in [(2.0, 4.0, 9.0), (3.0, 9.0, 2.0)]:
+        assert Y[X == x].tolist() == [before, after]
+    # the discontinuity keeps both values in order
+    assert Y[X == 20.0].tolist() == [5.0, 11.0]
+
+    E = energies(TABLE, 0)
+    exact = CrossSection.evaluate(TABLE, E)
+    assert np.all(np.abs(CrossSection.evaluate(linear, E) - exact) <= 1e-4*np.abs(exact) + 1e-12)
+
+def test_linearize_keeps_lin_lin_tables():
+    X, Y = np.array([1.0, 2.0, 2.0, 4.0]), np.array([1.0, 3.0, 5.0, 2.0])
+    NBT, INT, LX, LY = CrossSection.linearize((np.array([4]), np.array([2]), X, Y))
+    assert NBT.dtype == np.int64 and INT.dtype == np.int64
+    assert LX.tolist() == X.tolist() and LY.tolist() == Y.tolist()
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+import CrossSection
+import Multigroup
+from DB import unpack_array
+from conftest import write_tape
+
+# five regions, one per law, with a histogram step and a discontinuity at 20 eV
+TABLE = (np.array([4, 7, 10, 13, 16]), np.array([1, 2, 3, 4, 5]),
+         np.array([1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 20.0, 20.0, 34.0, 55.0, 89.0, 144.0, 233.0, 377.0, 610.0, 987.0]),
+         np.array([4.0, 9.0, 2.0, 6.0, 3.0, 7.0, 5.0, 11.0, 1.0, 8.0, 12.0, 2.0, 9.0, 0.5, 4.0, 6.0]))
+
+# groups below, across and above the table, with boundaries on a histogram step and on the discontinuity
+BOUNDS = np.array([0.25, 0.5, 1.5, 2.0, 7.0, 20.0, 21.0, 100.0, 500.0, 987.0, 2000.0])
+
+# Gauss-Legendre quadrature in log E of the table times E^q over each group, between the points of the table,
+# divided by the integral of E^q
+def brute_force(table: tuple, bounds: np.ndarray, q: float) -> np.ndarray:
+    t, w = np.polynomial.legendre.leggauss(64)
+    X = table[2]
+    values = []
+    for b0, b1 in zip(bounds[:-1], bounds[1:]):
+        cuts = np.unique(np.concatenate(([b0, b1], X[(X > b0) & (X < b1)])))
+        total = flux = 0.0
+        for x0, x1 in zip(cuts[:-1], cuts[1:]):
+            u0, u1 = np.log(x0), np.log(x1)
+            e = np.exp(u0 + (u1 - u0)*(t + 1)/2)
+            jacobian = (u1 - u0)/2*e**(q + 1)
+            flux += np.sum(w*jacobian)
+            if x0 >= X[0] and x1 <= X[-1]:
+                total += np.sum(w*jacobian*CrossSection.evaluate(table, e))
+        values.append(total/flux)
+    return np.array(values)
+
+def single_law(law: int) -> tuple:
+    return (np.array([len(TABLE[2])]), np.array([law]), TABLE[2], TABLE[3])
+
+@pytest.mark.parametrize("weight", ["flat", "1/E"])
+@pytest.mark.parametrize("law", [1, 2, 3, 4, 5])
+def test_collapse_power_weight_matches_quadrature(law, weight):
+    table = single_law(law)
+    values = Multigroup.collapse([table], BOUNDS, weight)
+    np.testing.assert_allclose(values[0], brute_force(table, BOUNDS, Multigroup.WEIGHTS[weight]), rtol=1e-11, atol=1e-14)
+    assert values[0][0] == 0.0 and values[0][-1] == 0.0
+
+@pytest.mark.parametrize("weight", ["flat", "1/E", 0.5])
+def test_collapse_several_tables_with_regions(weight):
+    tables = [TABLE] + [single_law(law) for law in [1, 2, 3, 4, 5]]
+    values = Multigroup.collapse(tables, BOUNDS, weight)
+    q = Multigroup.WEIGHTS.get(weight, weight)
+    expected = np.array([brute_force(table, BOUNDS, q) for table in tables])
+    np.testing.assert_allclose(values, expected, rtol=1e-11, atol=1e-14)
+
+# a tabulated 1/E weight gives the power weight's groups to the linearization tolerance
+@pytest.mark.parametrize("law", [1, 2, 3, 4, 5])
+def test_collapse_tabulated_weight_matches_power_weight(law):
+    E = np.geomspace(0.1, 5000.0, 4000)
+    weight = (np.array([len(E)]), np.array([CrossSection.LOG_LOG]), E, 1/E)
+    table = single_law(law)
+    values = Multigroup.collapse([table], BOUNDS, weight, 1e-5)
+    np.testing.assert_allclose(values[0], brute_force(table, BOUNDS, -1.0), rtol=1e-4, atol=1e-14)
+
+def test_group_cross_sections_persist_round_trip(endf, tmp_path, monkeypatch):
+    X = np.geomspace(1e-5, 2e7, 200)
+    endf.ingest(write_tape(tmp_path / "lib" / "groups.dat", [1, 2, 102], [(X, 3.0 + np.sin(np.log(X))), (X, np.full(len(X), 2.0)), (X, 1/np.sqrt(X))]))
+    conn = endf.DBConnection.getConnection()
+    material_key, library_key = conn.execute("SELECT material_key,library_key FROM GeneralInfo")[0]
+    bounds = np.geomspace(1e-5, 2e7, 31)
+
+    Multigroup.group_cache.clear()
+    collapsed = Multigroup.group_cross_sections(conn, material_key, library_key, [1, 2, 102, 103], bounds, "1/E", persist=True)
+    conn.commit()
+    assert sorted(collapsed) == [1, 2, 102]
+
+    structure = Multigroup.structure_key(bounds)
+    NG, stored_bounds = conn.execute("SELECT NG,Bounds FROM GroupStructure WHERE structure=%s", [structure])[0]
+    assert NG == 30
+    assert np.array_equal(unpack_array(stored_bounds, "<f8", "none"), bounds)
+    rows = conn.execute("SELECT MT,weight,NG FROM GroupCrossSection ORDER BY MT")
+    assert [tuple(row) for row in rows] == [(1, "1/E", 30), (2, "1/E", 30), (102, "1/E", 30)]
+
+    # read back from the tables, not collapsed again
+    Multigroup.group_cache.clear()
+    def collapse(*args, **kwargs):
+        raise AssertionError("collapsed again")
+    monkeypatch.setattr(Multigroup, "collapse", collapse)
+    stored = Multigroup.group_cross_sections(endf.DBConnection.getConnection(), material_key, library_key, [1, 2, 102], bounds, "1/E")
+    assert sorted(stored) == [1, 2, 102]
+    for MT in stored:
+        assert np.array_equal(stored[MT], collapsed[MT])
+    np.testing.assert_allclose(stored[2], 2.0, rtol=1e-12)
+
+    # persisting again stores nothing twice
+    Multigroup.persist_group_cross_sections(conn, material_key, library_key, collapsed, bounds, structure, "1/E")
+    assert conn.execute("SELECT COUNT(*) FROM GroupCrossSection")[0][0] == 3
+    assert conn.execute("SELECT COUNT(*) FROM GroupStructure")[0][0] == 1
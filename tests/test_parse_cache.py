@@ -0,0 +1,92 @@
+import os
+import numpy as np
+from ENDFParser import ENDFTape, _MF3_FIELDS, _MT451_FIELDS
+from conftest import write_tape
+
+X = np.geomspace(1e-5, 2e7, 300)
+TABLES = [(X, 3.0 + np.sin(np.log(X))), (X, np.full(len(X), 2.0)), (X, 1/np.sqrt(X))]
+
+# the decoded fields and arrays of every section of the tape, in tape order
+def contents(tape: ENDFTape) -> list:
+    sections = []
+    for material in tape.getMaterials():
+        for file in material.getFiles():
+            for section in file.getSections():
+                section.parse()
+                MF = section.getFile()
+                fields = _MT451_FIELDS if MF == 1 else _MF3_FIELDS
+                entry = [section.getMaterial(), MF, section.MT] + [getattr(section, field) for field in fields]
+                if MF == 1:
+                    entry.append(np.asarray(section.section_data).tolist())
+                else:
+                    entry += [np.asarray(getattr(section, name)) for name in ("NBT", "INT", "X", "Y")]
+                sections.append(entry)
+    return sections
+
+def assert_same(cold: list, warm: list):
+    assert len(cold) == len(warm)
+    for a, b in zip(cold, warm):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            if isinstance(x, np.ndarray):
+                assert x.dtype == y.dtype and np.array_equal(x, y), a[:3]
+            else:
+                assert x == y, a[:3]
+
+def parse(path, cache_dir, sections=None) -> ENDFTape:
+    tape = ENDFTape(str(path), sections=sections, cache_dir=None if cache_dir is None else str(cache_dir))
+    tape.parseTape()
+    return tape
+
+# raise if the tape is read for decoding, so a tape can only come from the cache
+def forbid_decoding(monkeypatch):
+    def decode(*args, **kwargs):
+        raise AssertionError("tape decoded instead of loaded from the parse cache")
+    monkeypatch.setattr(ENDFTape, "_rawMaterials", decode)
+
+def test_warm_parse_matches_cold_parse(tmp_path, monkeypatch):
+    path = tmp_path / "tape.dat"
+    cache_dir = tmp_path / "cache"
+    write_tape(path, [1, 2, 102], TABLES)
+    cold = parse(path, cache_dir)
+    assert os.listdir(cache_dir) == [cold.getContentHash()]
+    expected = contents(cold)
+    assert_same(contents(parse(path, None)), expected)
+
+    forbid_decoding(monkeypatch)
+    warm = parse(path, cache_dir)
+    assert warm.getContentHash() == cold.getContentHash()
+    assert (warm.TPID, warm.NTAPE) == (cold.TPID, cold.NTAPE)
+    assert_same(contents(warm), expected)
+
+def test_changed_tape_is_not_loaded_from_the_cache(tmp_path, monkeypatch):
+    path = tmp_path / "tape.dat"
+    cache_dir = tmp_path / "cache"
+    write_tape(path, [1, 2, 102], TABLES)
+    before = parse(path, cache_dir)
+
+    changed = list(TABLES)
+    changed[1] = (X, np.full(len(X), 4.0))
+    write_tape(path, [1, 2, 102], changed)
+    after = parse(path, cache_dir)
+    assert after.getContentHash() != before.getContentHash()
+    assert sorted(os.listdir(cache_dir)) == sorted([before.getContentHash(), after.getContentHash()])
+    assert np.all(after.getMaterials()[0].getFiles()[1].getSections()[1].getTable()[3] == 4.0)
+
+    forbid_decoding(monkeypatch)
+    assert_same(contents(parse(path, cache_dir)), contents(after))
+
+# a tape read with a section filter is cached apart from the whole tape
+def test_section_filter_has_its_own_cache(tmp_path, monkeypatch):
+    path = tmp_path / "tape.dat"
+    cache_dir = tmp_path / "cache"
+    write_tape(path, [1, 2, 102], TABLES)
+    whole = contents(parse(path, cache_dir))
+    only = {3: {102}}
+    filtered = contents(parse(path, cache_dir, only))
+    assert [entry[:3] for entry in filtered] == [[100, 1, 451], [100, 3, 102]]
+    assert len(os.listdir(cache_dir)) == 2
+
+    forbid_decoding(monkeypatch)
+    assert_same(contents(parse(path, cache_dir)), whole)
+    assert_same(contents(parse(path, cache_dir, only)), filtered)
@@ -0,0 +1,55 @@
+import os
+import re
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def read(name: str) -> str:
+    with open(os.path.join(ROOT, name), encoding="utf-8") as file:
+        return file.read()
+
+def create_statements(sql: str) -> dict:
+    return {match.group(1): match.group(0) for match in
+            re.finditer(r"CREATE TABLE (?:IF NOT EXISTS )?`(\w+)` \(.*?\) ENGINE=[^;]*;", sql, re.S)}
+
+def test_reset_truncates_every_table():
+    tables = set(create_statements(read("ENDF_ddl.sql")))
+    truncated = set(re.findall(r"TRUNCATE TABLE `(\w+)`", read("reset_db.sql")))
+    assert truncated == tables
+
+def test_migration_creates_the_added_tables_as_the_ddl_does():
+    ddl = create_statements(read("ENDF_ddl.sql"))
+    migration = create_statements(read("migrate_db.sql"))
+    assert migration
+    for table, statement in migration.items():
+        assert statement.replace("CREATE TABLE IF NOT EXISTS", "CREATE TABLE") == ddl[table]
+
+def test_migration_adds_every_unique_key():
+    migration = read("migrate_db.sql")
+    for key in re.findall(r"UNIQUE KEY `\w+` \([^)]*\)", read("ENDF_ddl.sql")):
+        if "ux_GeneralInfo_mat_lib" not in key:
+            assert key.replace("UNIQUE KEY", "ADD UNIQUE KEY IF NOT EXISTS") in migration
+
+def test_sqlite_schema_translates_the_ddl():
+    import sqlite3
+    import DB
+    ddl = create_statements(read("ENDF_ddl.sql"))
+    schema = DB.sqlite_schema(DB.ddl_file)
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(schema)
+    # and again, as every statement only creates what is missing
+    conn.executescript(schema)
+
+    tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert tables == set(ddl) | {"id_seq"}
+    assert conn.execute("SELECT next_val FROM id_seq").fetchall() == [(1,)]
+    for table, statement in ddl.items():
+        columns = re.findall(r"^  `(\w+)` ", statement, re.M)
+        info = conn.execute("PRAGMA table_info(%s)" % (table)).fetchall()
+        assert [row[1] for row in info] == columns
+        primary = re.search(r"PRIMARY KEY \(([^)]*)\)", statement).group(1).replace("`", "").split(",")
+        assert [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]] == primary
+        indexes = {row[1]: row[2] for row in conn.execute("PRAGMA index_list(%s)" % (table)) if row[3] == "c"}
+        for unique, name, key in re.findall(r"^  (UNIQUE )?KEY `(\w+)` \(([^)]*)\)", statement, re.M):
+            index = "%s_%s" % (table, name)
+            assert indexes[index] == (1 if unique else 0)
+            assert [row[2] for row in conn.execute("PRAGMA index_info(%s)" % (index))] == key.replace("`", "").split(",")
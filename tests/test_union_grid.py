@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+import CrossSection
+from ENDFGenerator import synthetic_table
+from UnionGrid import UnionGrid
+
+# a synthetic reaction and one with a discontinuity at the grid's last energy, so the final energy is repeated
+def grid(seed: int) -> tuple:
+    rng = np.random.default_rng(seed)
+    table = synthetic_table(rng, 400, 3)
+    X = table[2]
+    step = (np.array([4]), np.array([2]), np.array([3*X[0], X[-1]/2, X[-1], X[-1]]), np.array([1.0, 2.0, 3.0, 5.0]))
+    return UnionGrid.build({1: table, 2: step}), {1: table, 2: step}
+
+def energies(E: np.ndarray) -> np.ndarray:
+    return np.concatenate((E, np.nextafter(E, 0), np.nextafter(E, np.inf), [E[0]/2, 2*E[-1], 0.0, -1.0, -np.inf, np.inf, np.nan]))
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("side", ["left", "right"])
+def test_hashed_index_matches_searchsorted(seed, side):
+    union, _ = grid(seed)
+    E = union.E
+    assert E[-1] == E[-2]
+    e = energies(E)
+    expected = np.clip(np.searchsorted(E, e, side=side) - 1, 0, len(E) - 2)
+    assert np.array_equal(union.index(e, side), expected)
+    for nBins in [1, 2, 3, 7, 64, len(E), 5*len(E)]:
+        union.hash(nBins)
+        assert np.array_equal(union.index(e, side), expected), nBins
+        assert np.array_equal(union.index(E[-1:], side), expected[len(E) - 1:len(E)])
+
+@pytest.mark.parametrize("side", ["left", "right"])
+def test_hashed_lookup_matches_unhashed(side):
+    union, tables = grid(0)
+    e = energies(union.E)
+    unhashed = union.lookup(e, side)
+    union.hash(len(union.E)//3)
+    assert np.array_equal(union.lookup(e, side), unhashed, equal_nan=True)
+    if side == "left":
+        return
+    # taking the right values at discontinuities like evaluate, the grid reproduces the reactions to its tolerance
+    inside = (e > union.E[0]) & (e < union.E[-1])
+    for r, MT in enumerate(union.MTs):
+        exact = CrossSection.evaluate(tables[MT], e[inside])
+        assert np.all(np.abs(unhashed[r][inside] - exact) <= 1e-3*np.abs(exact) + 1e-12)